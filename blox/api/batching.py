@@ -0,0 +1,225 @@
+from __future__ import annotations
+from blox.core.compute import Computable
+from blox.api.map import BloxMap
+from concurrent.futures import Future, InvalidStateError
+from collections import deque
+from dataclasses import dataclass
+import typing as tp
+import threading
+import queue
+import time
+import sys
+
+
+@dataclass
+class BatchRecord:
+    """ Statistics of one evaluated batch """
+    size: int
+    wait_time: float        # From the arrival of the first request until the batch was started
+    run_time: float         # The evaluation of the batch
+
+
+def default_collate(values: tp.List[tp.Any]) -> tp.Any:
+    """ Stacks NumPy arrays (and numbers) along a new first axis. Anything else is collected to a list """
+    np = sys.modules.get('numpy')
+    if np is not None and all(isinstance(value, (np.ndarray, np.generic, int, float)) for value in values):
+        return np.stack(values)
+    return list(values)
+
+
+def default_split(value: tp.Any, size: int) -> tp.List[tp.Any]:
+    """ The inverse of default_collate: splits along the first axis """
+    result = list(value)
+    if len(result) != size:
+        raise ValueError(f'Expected a batched result of {size} samples, got {len(result)}')
+    return result
+
+
+class BatchingMap:
+    """
+    Converts a Blox system to a function of single samples, that evaluates the system on batches.
+
+    Calls from concurrent threads are queued and grouped into batches of up to max_batch_size samples.
+    A batch is evaluated as soon as it is full, or max_latency seconds after its first request arrived.
+    The inputs of the samples are combined with collate (per input port), the system is evaluated once,
+    and each output is split back to the samples with split.
+
+    The world may be a Computable (evaluated like BloxMap) or any function of batched inputs.
+    """
+
+    def __init__(self, world: tp.Union[Computable, tp.Callable],
+                 max_batch_size: int = 32,
+                 max_latency: float = 0.005,
+                 collate: tp.Callable[[tp.List[tp.Any]], tp.Any] = default_collate,
+                 split: tp.Callable[[tp.Any, int], tp.List[tp.Any]] = default_split,
+                 history: int = 1000):
+
+        if max_batch_size < 1:
+            raise ValueError(f'max_batch_size must be positive (given {max_batch_size})')
+
+        self.world = world
+        self.fn = BloxMap(world) if isinstance(world, Computable) else world
+        self.num_outputs = len(world.Out) if isinstance(world, Computable) else 1
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.collate = collate
+        self.split = split
+
+        self.records: tp.Deque[BatchRecord] = deque(maxlen=history)
+
+        self._requests = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+        self._error = None      # The error that stopped the serving thread (if any)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def submit(self, *args) -> Future:
+        """ Queues a sample and returns a future of its result """
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError(f'{self.__class__.__name__} is closed') from self._error
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._serve, daemon=True,
+                                                name=f'{self.__class__.__name__}-{id(self)}')
+                self._thread.start()
+            self._requests.put((time.perf_counter(), args, future))
+        return future
+
+    def __call__(self, *args):
+        return self.submit(*args).result()
+
+    def close(self):
+        """ Evaluates the queued samples and stops the serving thread """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            thread = self._thread
+            self._requests.put(None)
+
+        if thread is not None:
+            thread.join()
+
+    # ----------------------------------------------------------------------------------------------------
+    # Serving
+    # ----------------------------------------------------------------------------------------------------
+
+    def _next_batch(self) -> tp.Tuple[tp.List, bool]:
+        """ Returns the requests of the next batch, and whether the map was closed """
+        first = self._requests.get()
+        if first is None:
+            return [], True
+
+        batch = [first]
+        deadline = first[0] + self.max_latency
+
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                request = self._requests.get(timeout=timeout) if timeout > 0 else self._requests.get_nowait()
+            except queue.Empty:
+                break
+
+            if request is None:
+                return batch, True
+            batch.append(request)
+
+        return batch, False
+
+    def _serve(self):
+        closed = False
+        batch = []
+        try:
+            while not closed:
+                batch, closed = self._next_batch()
+
+                # Requests cancelled by their callers are dropped. The others can no longer be cancelled
+                batch = [request for request in batch if request[2].set_running_or_notify_cancel()]
+                if batch:
+                    self._evaluate(batch)
+                batch = []
+
+        except BaseException as e:
+            # Fail the current and the queued requests, and any submitted later, rather than leave them waiting
+            with self._lock:
+                self._closed = True
+                self._error = e
+
+            futures = [future for _, _, future in batch]
+            while True:
+                try:
+                    request = self._requests.get_nowait()
+                except queue.Empty:
+                    break
+                if request is not None:
+                    futures.append(request[2])
+
+            for future in futures:
+                try:
+                    future.set_exception(e)
+                except InvalidStateError:
+                    pass  # Cancelled or already done
+
+    def _run(self, *inputs):
+        """ Evaluates the world on batched inputs (subclasses may e.g. add a context around it) """
+        return self.fn(*inputs)
+
+    def _evaluate(self, batch: tp.List):
+        start = time.perf_counter()
+        futures = [future for _, _, future in batch]
+
+        try:
+            num_inputs = len(batch[0][1])
+            if any(len(args) != num_inputs for _, args, _ in batch):
+                raise TypeError('All the samples of a batch must have the same number of inputs')
+
+            inputs = [self.collate([args[n] for _, args, _ in batch]) for n in range(num_inputs)]
+            result = self._run(*inputs)
+
+            if self.num_outputs == 1:
+                results = self.split(result, len(batch))
+            else:
+                results = list(zip(*(self.split(output, len(batch)) for output in result)))
+
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            results = None
+
+        end = time.perf_counter()
+        self.records.append(BatchRecord(size=len(batch), wait_time=start - batch[0][0], run_time=end - start))
+
+        if results is not None:
+            for future, value in zip(futures, results):
+                future.set_result(value)
+
+    # ----------------------------------------------------------------------------------------------------
+    # Statistics
+    # ----------------------------------------------------------------------------------------------------
+
+    def stats(self) -> tp.Dict[str, float]:
+        """
+        Summarizes the recent batches: their number, the mean batch size, the utilization (the mean fraction
+        of max_batch_size used), and the mean and maximal wait and run times
+        """
+        records = list(self.records)
+        if not records:
+            return dict(batches=0, samples=0, mean_batch_size=0., utilization=0.,
+                        mean_wait_time=0., max_wait_time=0., mean_run_time=0., max_run_time=0.)
+
+        samples = sum(record.size for record in records)
+        return dict(batches=len(records),
+                    samples=samples,
+                    mean_batch_size=samples / len(records),
+                    utilization=samples / (len(records) * self.max_batch_size),
+                    mean_wait_time=sum(record.wait_time for record in records) / len(records),
+                    max_wait_time=max(record.wait_time for record in records),
+                    mean_run_time=sum(record.run_time for record in records) / len(records),
+                    max_run_time=max(record.run_time for record in records))
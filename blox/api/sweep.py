@@ -0,0 +1,171 @@
+from __future__ import annotations
+from blox.core.compute import Computable
+from blox.core.state import State, XPathState
+from blox.core.port import Port
+from blox.core.columnar import ColumnarXPathState
+from itertools import product
+import typing as tp
+
+
+class ParamGrid:
+    """ The cartesian product of parameter values. Keys are xpath keys of block or global parameters """
+
+    def __init__(self, space: tp.Dict[str, tp.Iterable[tp.Any]]):
+        self._keys = list(space.keys())
+        self._values = [list(values) for values in space.values()]
+
+    def __iter__(self) -> tp.Iterator[tp.Dict[str, tp.Any]]:
+        for values in product(*self._values):
+            yield dict(zip(self._keys, values))
+
+    def __len__(self):
+        length = 1
+        for values in self._values:
+            length *= len(values)
+        return length
+
+
+class Sweep:
+    """
+    Evaluates target ports of a system over a space of parameter settings.
+
+    The parameter space is either a ParamGrid or any iterable of dictionaries mapping xpath keys
+    (e.g. "block/param" or "@meta/param") to values. Port values that do not depend on the swept
+    parameters are computed once, for the first point, and shared by all other points.
+    """
+
+    def __init__(self, root_block: Computable,
+                 target_or_targets: tp.Union[str, tp.Iterable[str]],
+                 max_workers: tp.Optional[int] = None):
+        self.root_block = root_block
+        self.targets = [target_or_targets] if isinstance(target_or_targets, str) else list(target_or_targets)
+        self.max_workers = max_workers
+
+    def __call__(self, space: tp.Iterable[tp.Dict[str, tp.Any]],
+                 xpstate: tp.Optional[XPathState] = None) -> ColumnarXPathState:
+        """ Runs the sweep. Returns a table with one row per point holding the point and the targets' values """
+
+        xpstate = xpstate if xpstate is not None else XPathState()
+        points = list(space)
+        results = ColumnarXPathState(meta_prefix=xpstate.meta_prefix)
+
+        if not points:
+            return results
+
+        # The first point is evaluated from scratch. Its unaffected port values are then shared.
+        state = _evaluate_point(self.root_block, xpstate.to_state(self.root_block), points[0], self.targets, xpstate)
+        results.append(_make_row(self.root_block, state, points[0], self.targets, xpstate))
+
+        # Values given in xpstate are kept as they are, even if they are downstream of swept parameters
+        given = {leaf for _, leaf in (xpstate.resolve(key, self.root_block) for key in xpstate.keys())}
+        affected = self._affected_ports({key for point in points for key in point}, xpstate) - given
+
+        # The common starting point of all other points: the given values and the shared port values
+        shared_state = xpstate.to_state(self.root_block)
+        for port in state.ports():
+            if port not in affected:
+                shared_state.set_port(port, state.peek(port))
+
+        if self.max_workers is None or self.max_workers <= 1:
+            for point in points[1:]:
+                state = _evaluate_point(self.root_block, shared_state.fork(), point, self.targets, xpstate)
+                results.append(_make_row(self.root_block, state, point, self.targets, xpstate))
+
+        else:
+            # Workers receive the shared values in the xpath form (ports can't be matched across processes)
+            shared_xpstate = shared_state.to_xpath_state(self.root_block)
+            shared_xpstate.meta_prefix = xpstate.meta_prefix
+
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=self.max_workers,
+                                     initializer=_init_worker,
+                                     initargs=(self.root_block, shared_xpstate, self.targets)) as executor:
+                results.extend(executor.map(_evaluate_in_worker, points[1:]))
+
+        return results
+
+    def _affected_ports(self, keys: tp.Iterable[str], xpstate: XPathState) -> tp.Set[Port]:
+        """ Returns the ports whose values may change when the given parameters change """
+
+        start_ports = []
+        for key in keys:
+            block, _ = xpstate.resolve(key, self.root_block)
+
+            # Global parameters are visible to every block
+            if block is None:
+                return set(self.root_block.descendants(lambda node: isinstance(node, Port)))
+
+            start_ports.extend(block.Out)
+            start_ports.extend(node for node in block.descendants(lambda node: isinstance(node, Port))
+                               if node.tag == 'Out')
+
+        affected = set()
+        ports = list(start_ports)
+        while ports:
+            port = ports.pop()
+            if port in affected:
+                continue
+            affected.add(port)
+
+            for downstream_port in port.downstream:
+                ports.append(downstream_port)
+
+                # Outputs of blocks without children depend on all of their inputs
+                block = downstream_port.block
+                if downstream_port.tag == 'In' and not block.blocks:
+                    ports.extend(block.Out)
+
+        return affected
+
+
+def _apply_point(root_block: Computable, state: State, point: tp.Dict[str, tp.Any], xpstate: XPathState):
+    for key, value in point.items():
+        block, leaf = xpstate.resolve(key, root_block)
+
+        if block is None:
+            state.meta[leaf] = value
+        elif isinstance(leaf, Port):
+            raise TypeError(f'Swept key {key} must be a parameter (given a port)')
+        else:
+            state[block].params[leaf] = value
+
+
+def _evaluate_point(root_block: Computable, state: State, point: tp.Dict[str, tp.Any],
+                    targets: tp.List[str], xpstate: XPathState) -> State:
+    _apply_point(root_block, state, point, xpstate)
+
+    for target in targets:
+        _, port = xpstate.resolve(target, root_block)
+        if not isinstance(port, Port):
+            raise TypeError(f'Target {target} must be a port')
+        state(port)
+
+    return state
+
+
+def _make_row(root_block: Computable, state: State, point: tp.Dict[str, tp.Any],
+              targets: tp.List[str], xpstate: XPathState) -> XPathState:
+    row = XPathState()
+    row.meta_prefix = xpstate.meta_prefix
+    row.update(point)
+
+    for target in targets:
+        _, port = xpstate.resolve(target, root_block)
+        row[target] = state[port]
+
+    return row
+
+
+# The context of the worker processes (set once by the process pool initializer)
+_worker_context = None
+
+
+def _init_worker(root_block: Computable, shared_xpstate: XPathState, targets: tp.List[str]):
+    global _worker_context
+    _worker_context = (root_block, shared_xpstate, targets)
+
+
+def _evaluate_in_worker(point: tp.Dict[str, tp.Any]) -> XPathState:
+    root_block, shared_xpstate, targets = _worker_context
+    state = _evaluate_point(root_block, shared_xpstate.to_state(root_block), point, targets, shared_xpstate)
+    return _make_row(root_block, state, point, targets, shared_xpstate)
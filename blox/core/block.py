@@ -1,8 +1,8 @@
 from __future__ import annotations
-from blox.core.node import NamedNode
+from blox.core.node import NamedNode, TagView
+from blox.core.port import Port
 from blox.etc.loggingclass import LoggerMixin
 from blox.etc.errors import TagMismatchError, PortConnectionError
-from boltons.cacheutils import cachedproperty
 from blox.etc.utils import parse_ports
 from blox.core.transforms import BlockTransformsMixin
 from blox.core.toposort import BlockToposortMixin
@@ -11,9 +11,10 @@ from blox.core.events import NodePreAttach, NodePreDetach
 
 class Block(NamedNode, BlockTransformsMixin):
 
+    __slots__ = ()
+
     def __init__(self, name=None, In=None, Out=None):
         super(Block, self).__init__(name=name, tag='blocks')
-        from blox.core.port import Port
 
         for name in parse_ports(In, default_prefix='in'):
             self.In[name] = Port()
@@ -21,17 +22,18 @@ class Block(NamedNode, BlockTransformsMixin):
         for name in parse_ports(Out, default_prefix='out'):
             self.Out[name] = Port()
 
-    @cachedproperty
+    # The views are light-weight and created on demand (blocks don't store them)
+    @property
     def blocks(self):
-        return SubBlocksView(self, self.children['blocks'], 'blocks')
+        return SubBlocksView(self, 'blocks')
 
-    @cachedproperty
+    @property
     def In(self):
-        return PortsView(self, self.children['In'], 'In')
+        return PortsView(self, 'In')
 
-    @cachedproperty
+    @property
     def Out(self):
-        return PortsView(self, self.children['Out'], 'Out')
+        return PortsView(self, 'Out')
 
     def links(self):
         """ Returns all port links internal to the block.
@@ -99,9 +101,9 @@ class Block(NamedNode, BlockTransformsMixin):
 class SectionView:
     __slots__ = ('_block', '_data', '_tag')
 
-    def __init__(self, block, data, tag):
+    def __init__(self, block, tag):
         self._block = block
-        self._data = data
+        self._data = TagView(block, tag)
         self._tag = tag
 
     def __getitem__(self, name):
@@ -165,8 +167,6 @@ class PortsView(SectionView):
     """ A dict-like interface, for handling ports """
 
     def __setitem__(self, key, value):
-        from blox.core.port import Port
-        
         # Handle the wildcard for setting all ports at once
         if key == '*':
             if len(self) == 0:
@@ -203,7 +203,6 @@ class PortsView(SectionView):
         self[item].parent = None
 
     def __contains__(self, item):
-        from blox.core.port import Port
         if isinstance(item, Port):
             return item in self._data
         else:
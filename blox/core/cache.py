@@ -0,0 +1,295 @@
+""" A content-addressed cache of block results stored in a local directory """
+from __future__ import annotations
+import os
+import sys
+import pickle
+import hashlib
+import tempfile
+import weakref
+import typing as tp
+from types import CodeType, FunctionType
+
+if tp.TYPE_CHECKING:
+    from blox.core.compute import AtomicFunction
+
+
+# The file name suffix of cache entries
+_SUFFIX = '.pkl'
+
+
+def _hash_code(h, code: CodeType):
+    h.update(code.co_code)
+    h.update(repr(code.co_names).encode())
+    for const in code.co_consts:
+        if isinstance(const, CodeType):
+            _hash_code(h, const)
+        elif isinstance(const, frozenset):
+            # The iteration order of sets of strings changes between processes
+            h.update(repr(sorted(map(repr, const))).encode())
+        else:
+            h.update(repr(const).encode())
+
+
+def _functions(attribute) -> tp.Iterator[FunctionType]:
+    """ The functions behind a class attribute (methods, static and class methods and properties) """
+    if isinstance(attribute, (staticmethod, classmethod)):
+        attribute = attribute.__func__
+    if isinstance(attribute, property):
+        yield from (f for f in (attribute.fget, attribute.fset, attribute.fdel) if isinstance(f, FunctionType))
+    elif isinstance(attribute, FunctionType):
+        yield attribute
+
+
+def _hash_function(h, function: FunctionType, seen: tp.Set[CodeType]):
+    """ Hashes the code of the function and of the functions of its module that it refers to by name """
+    code = function.__code__
+    if code in seen:
+        return
+    seen.add(code)
+    _hash_code(h, code)
+
+    for name in code.co_names:
+        helper = function.__globals__.get(name)
+        if isinstance(helper, FunctionType) and helper.__module__ == function.__module__:
+            _hash_function(h, helper, seen)
+
+
+class ResultCache:
+    """
+    Stores the outputs of cacheable blocks (see AtomicFunction.cacheable) in a directory, keyed by a hash of:
+        * The block's class and the code of its methods (and of the module functions they call by name),
+          down to AtomicFunction
+        * The block's cache_token()
+        * The values of its inputs, parameters and global parameters
+
+    The cache can be shared by concurrent processes: entries are written atomically and are never modified.
+    When max_size (in bytes) is exceeded the least recently used entries are removed.
+
+    The digests of outputs are derived from their keys rather than from their contents, so values must not
+    be modified in place once produced (e.g. by NumPy operators with inplace=True).
+
+    To use the cache, set it on the state: state.cache = ResultCache(directory)
+    """
+
+    def __init__(self, directory: str, max_size: tp.Optional[int] = None,
+                 protocol: int = pickle.HIGHEST_PROTOCOL):
+        self.directory = directory
+        self.max_size = max_size
+        self.protocol = protocol
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(directory, exist_ok=True)
+
+        # The digests of the values produced by this cache are derived from their keys, so that large
+        # values don't need to be hashed again downstream. Maps id(value) -> (weak reference, digest)
+        self._digests: tp.Dict[int, tp.Tuple[weakref.ref, bytes]] = dict()
+
+        self._code_digests: tp.Dict[type, bytes] = dict()
+
+        # Approximate total size of the entries (None until the directory is first scanned)
+        self._size: tp.Optional[int] = None
+
+    # ----------------------------------------------------------------------------------------------------
+    # Keys
+    # ----------------------------------------------------------------------------------------------------
+
+    def key(self, block: AtomicFunction, inputs: tp.Sequence[tp.Any],
+            params: tp.Mapping[str, tp.Any], meta: tp.Mapping[str, tp.Any]) -> str:
+        h = hashlib.sha256()
+        h.update(f'{type(block).__module__}.{type(block).__qualname__}'.encode())
+        h.update(self._code_digest(type(block)))
+        h.update(self.digest(block.cache_token()))
+
+        for value in inputs:
+            h.update(self.digest(value))
+
+        for mapping in (params, meta):
+            h.update(self.digest(sorted(mapping.items())))
+
+        return h.hexdigest()
+
+    def _code_digest(self, cls: type) -> bytes:
+        digest = self._code_digests.get(cls)
+        if digest is None:
+            from blox.core.compute import AtomicFunction
+
+            h = hashlib.sha256()
+            h.update(str(getattr(cls, 'cache_version', '')).encode())
+            seen = set()
+            for base in cls.__mro__[:cls.__mro__.index(AtomicFunction)]:
+                for name in sorted(base.__dict__):
+                    for function in _functions(base.__dict__[name]):
+                        h.update(name.encode())
+                        _hash_function(h, function, seen)
+            digest = self._code_digests[cls] = h.digest()
+        return digest
+
+    def digest(self, value: tp.Any) -> bytes:
+        """ Returns a hash of the value's contents """
+        known = self._digests.get(id(value))
+        if known is not None and known[0]() is value:
+            return known[1]
+
+        h = hashlib.sha256()
+        self._update(h, value)
+        return h.digest()
+
+    def _update(self, h, value):
+        # The type is hashed along with the contents so that e.g. 1 and 1.0 differ
+        h.update(type(value).__qualname__.encode())
+
+        if value is None or isinstance(value, (bool, int, float, complex, str)):
+            h.update(repr(value).encode())
+
+        elif isinstance(value, (bytes, bytearray)):
+            h.update(value)
+
+        elif isinstance(value, (tuple, list)):
+            h.update(str(len(value)).encode())
+            for item in value:
+                h.update(self.digest(item))
+
+        # Sets and dicts are hashed in an order that doesn't depend on their insertion order or on the
+        # process (the iteration order of sets of strings does)
+        elif isinstance(value, (set, frozenset)):
+            h.update(b''.join(sorted(self.digest(item) for item in value)))
+
+        elif isinstance(value, dict):
+            h.update(b''.join(sorted(self.digest(key) + self.digest(item) for key, item in value.items())))
+
+        elif _is_ndarray(value) and not value.dtype.hasobject:
+            h.update(f'{value.dtype.str}{value.shape}'.encode())
+            h.update(_as_bytes(value))
+
+        elif _is_tensor(value):
+            h.update(f'{value.dtype}{tuple(value.shape)}'.encode())
+            h.update(_as_bytes(value.detach().cpu().numpy()))
+
+        else:
+            h.update(pickle.dumps(value, protocol=self.protocol))
+
+    def _remember(self, value, digest: bytes):
+        try:
+            key = id(value)
+            self._digests[key] = (weakref.ref(value, lambda _: self._digests.pop(key, None)), digest)
+        except TypeError:
+            pass  # Small built-in values are cheap to hash anyway
+
+    def _remember_outputs(self, key: str, outputs: tp.Tuple):
+        for n, value in enumerate(outputs):
+            self._remember(value, hashlib.sha256(f'{key}:{n}'.encode()).digest())
+
+    # ----------------------------------------------------------------------------------------------------
+    # Storage
+    # ----------------------------------------------------------------------------------------------------
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key + _SUFFIX)
+
+    def __contains__(self, key: str):
+        return os.path.exists(self._path(key))
+
+    def get(self, key: str) -> tp.Tuple[bool, tp.Any]:
+        """ Returns a pair (found, outputs) """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                outputs = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return False, None
+
+        # Mark as recently used
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+        self.hits += 1
+        self._remember_outputs(key, outputs)
+        return True, outputs
+
+    def put(self, key: str, outputs: tp.Tuple):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # An entry with the same key is replaced, so its size no longer counts
+        replaced = 0
+        if self.max_size is not None and self._size is not None:
+            try:
+                replaced = os.path.getsize(path)
+            except FileNotFoundError:
+                pass
+
+        # Write to a temporary file and move it in place, so that readers never see partial entries
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(outputs, f, protocol=self.protocol)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+        self._remember_outputs(key, outputs)
+
+        if self.max_size is not None:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._entries())
+            else:
+                self._size += os.path.getsize(path) - replaced
+
+            if self._size > self.max_size:
+                self.evict()
+
+    def _entries(self) -> tp.Iterator[tp.Tuple[str, int, float]]:
+        """ Yields (path, size, last use time) of all entries """
+        for sub_dir in os.scandir(self.directory):
+            if not sub_dir.is_dir():
+                continue
+            for entry in os.scandir(sub_dir.path):
+                if entry.name.endswith(_SUFFIX):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue  # Removed by another process
+                    yield entry.path, stat.st_size, stat.st_mtime
+
+    def evict(self, max_size: tp.Optional[int] = None):
+        """ Removes the least recently used entries until the cache takes at most max_size bytes """
+        max_size = max_size if max_size is not None else self.max_size
+
+        # Other processes may share the directory, so the entries are always rescanned
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        size = sum(size for _, size, _ in entries)
+
+        for path, entry_size, _ in entries:
+            if size <= max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+
+        self._size = size
+
+    def clear(self):
+        self.evict(max_size=0)
+
+
+def _is_ndarray(value) -> bool:
+    np = sys.modules.get('numpy')
+    return np is not None and isinstance(value, np.ndarray)
+
+
+def _is_tensor(value) -> bool:
+    torch = sys.modules.get('torch')
+    return torch is not None and isinstance(value, torch.Tensor)
+
+
+def _as_bytes(array):
+    """ Returns the array's data as a byte array (without copying contiguous arrays) """
+    import numpy as np
+    return np.ascontiguousarray(array).view(np.uint8)
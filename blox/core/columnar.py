@@ -0,0 +1,227 @@
+from __future__ import annotations
+import typing as tp
+import numbers
+from blox.core.state import State, XPathState
+
+if tp.TYPE_CHECKING:
+    from blox.core.block import Block
+
+
+class _MissingClass:
+    """ Marks the cells of a column for which a state has no value """
+    __slots__ = ()
+
+    def __repr__(self):
+        return 'Missing'
+
+    def __reduce__(self):
+        return 'Missing'
+
+
+Missing = _MissingClass()
+
+# Names of the auxiliary entries used by the file formats
+_KEYS_ENTRY = '__keys__'
+_STATE_IDS_ENTRY = '__state_ids__'
+_META_PREFIX_ENTRY = '__meta_prefix__'
+
+
+class ColumnarXPathState:
+    """ Stores many XPathStates column-wise.
+
+    The xpath keys are kept once in a shared schema and every key holds a single column (a list)
+    with one cell per state. States that lack a key have the Missing marker in its column.
+    """
+
+    def __init__(self, keys: tp.Iterable[str] = (), meta_prefix: str = '@meta'):
+        self.meta_prefix = meta_prefix
+        self._keys: tp.List[str] = []
+        self._index: tp.Dict[str, int] = dict()
+        self._columns: tp.List[tp.List[tp.Any]] = []
+        self._state_ids: tp.List[str] = []
+
+        for key in keys:
+            self._add_key(key)
+
+    @property
+    def keys(self) -> tp.Tuple[str, ...]:
+        return tuple(self._keys)
+
+    @property
+    def state_ids(self) -> tp.Tuple[str, ...]:
+        return tuple(self._state_ids)
+
+    def __len__(self):
+        return len(self._state_ids)
+
+    def __contains__(self, key: str):
+        return key in self._index
+
+    def column(self, key: str) -> tp.List[tp.Any]:
+        """ Returns the column of the given key (one cell per state) """
+        if key not in self._index:
+            raise KeyError(f'No such key {key}')
+        return self._columns[self._index[key]]
+
+    def columns(self) -> tp.Dict[str, tp.List[tp.Any]]:
+        return dict(zip(self._keys, self._columns))
+
+    def _add_key(self, key: str):
+        if not isinstance(key, str):
+            raise TypeError('xpath keys must be strings')
+
+        if key not in self._index:
+            self._index[key] = len(self._keys)
+            self._keys.append(key)
+            self._columns.append([Missing] * len(self))
+
+    def append(self, xpath_state: XPathState):
+        """ Adds a state as the last row """
+        if not isinstance(xpath_state, XPathState):
+            raise TypeError(f'xpath_state must be of type {XPathState.__name__}')
+
+        for key in xpath_state.keys():
+            self._add_key(key)
+
+        for key, column in zip(self._keys, self._columns):
+            column.append(xpath_state.get(key, Missing))
+
+        self._state_ids.append(xpath_state.state_id)
+
+    def extend(self, xpath_states: tp.Iterable[XPathState]):
+        for xpath_state in xpath_states:
+            self.append(xpath_state)
+
+    def __getitem__(self, index: int) -> XPathState:
+        """ Rebuilds the state stored in the given row """
+        state_id = self._state_ids[index]
+
+        xpath_state = XPathState(state_id=state_id)
+        xpath_state.meta_prefix = self.meta_prefix
+        for key, column in zip(self._keys, self._columns):
+            value = column[index]
+            if value is not Missing:
+                xpath_state[key] = value
+
+        return xpath_state
+
+    def __iter__(self) -> tp.Iterator[XPathState]:
+        for index in range(len(self)):
+            yield self[index]
+
+    @classmethod
+    def from_xpath_states(cls, xpath_states: tp.Iterable[XPathState]) -> ColumnarXPathState:
+        xpath_states = iter(xpath_states)
+        first = next(xpath_states, None)
+
+        columnar = cls() if first is None else cls(meta_prefix=first.meta_prefix)
+        if first is not None:
+            columnar.append(first)
+        columnar.extend(xpath_states)
+
+        return columnar
+
+    @classmethod
+    def from_states(cls, states: tp.Iterable[State], root_block: Block) -> ColumnarXPathState:
+        return cls.from_xpath_states(state.to_xpath_state(root_block) for state in states)
+
+    def to_xpath_states(self) -> tp.List[XPathState]:
+        return list(self)
+
+    def to_states(self, root_block: Block) -> tp.List[State]:
+        return [xpath_state.to_state(root_block) for xpath_state in self]
+
+    def save_npz(self, file):
+        """ Saves the columns into a NumPy .npz file.
+
+        Columns holding scalars of a single type or arrays of a common shape and dtype are stored as
+        native arrays. All other columns are stored as object arrays (pickled).
+        """
+        import numpy as np
+
+        arrays = {_KEYS_ENTRY: np.array(self._keys, dtype=str),
+                  _STATE_IDS_ENTRY: np.array(self._state_ids, dtype=str),
+                  _META_PREFIX_ENTRY: np.array(self.meta_prefix, dtype=str)}
+
+        for n, column in enumerate(self._columns):
+            missing = [value is Missing for value in column]
+            if any(missing):
+                arrays[f'mask{n}'] = np.array(missing, dtype=bool)
+                column = [None if value is Missing else value for value in column]
+
+            arrays[f'col{n}'] = _column_to_array(column)
+
+        np.savez(file, **arrays)
+
+    @classmethod
+    def load_npz(cls, file) -> ColumnarXPathState:
+        import numpy as np
+
+        with np.load(file, allow_pickle=True) as arrays:
+            columnar = cls(keys=arrays[_KEYS_ENTRY].tolist(), meta_prefix=str(arrays[_META_PREFIX_ENTRY]))
+            columnar._state_ids = arrays[_STATE_IDS_ENTRY].tolist()
+
+            for n in range(len(columnar._keys)):
+                array = arrays[f'col{n}']
+                column = array.tolist() if array.ndim == 1 and array.dtype != object else list(array)
+
+                if f'mask{n}' in arrays:
+                    column = [Missing if missing else value
+                              for value, missing in zip(column, arrays[f'mask{n}'].tolist())]
+
+                columnar._columns[n] = column
+
+        return columnar
+
+    def save_parquet(self, path):
+        """ Saves the columns into a Parquet file (requires pyarrow). Missing cells are stored as nulls. """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        data = {_STATE_IDS_ENTRY: self._state_ids}
+        for key, column in zip(self._keys, self._columns):
+            data[key] = [None if value is Missing else value for value in column]
+
+        table = pa.Table.from_pydict(data, metadata={_META_PREFIX_ENTRY: self.meta_prefix})
+        pq.write_table(table, path)
+
+    @classmethod
+    def load_parquet(cls, path) -> ColumnarXPathState:
+        import pyarrow.parquet as pq
+
+        table = pq.read_table(path)
+        metadata = table.schema.metadata or {}
+        meta_prefix = metadata.get(_META_PREFIX_ENTRY.encode(), b'@meta').decode()
+
+        keys = [name for name in table.column_names if name != _STATE_IDS_ENTRY]
+        columnar = cls(keys=keys, meta_prefix=meta_prefix)
+        columnar._state_ids = table.column(_STATE_IDS_ENTRY).to_pylist()
+
+        for n, key in enumerate(keys):
+            columnar._columns[n] = [Missing if value is None else value
+                                    for value in table.column(key).to_pylist()]
+
+        return columnar
+
+
+def _column_to_array(column: tp.List[tp.Any]):
+    """ Converts a column to a native NumPy array when it is lossless, otherwise to an object array """
+    import numpy as np
+
+    types = {type(value) for value in column}
+
+    if len(types) == 1:
+        value_type = next(iter(types))
+
+        if issubclass(value_type, (numbers.Number, str, np.generic)):
+            return np.array(column)
+
+        if issubclass(value_type, np.ndarray) and \
+                len({(value.shape, value.dtype) for value in column}) == 1 and column[0].dtype != object:
+            return np.stack(column)
+
+    array = np.empty(len(column), dtype=object)
+    for n, value in enumerate(column):
+        array[n] = value
+
+    return array
@@ -2,12 +2,12 @@ from __future__ import annotations
 from blox.etc.errors import ComputeError
 from blox.core.block import Block
 from blox.core.events import LinkPostConnect, LinkPreDisconnect
-import networkx as nx
+from blox.core.state import resolve, MetaDict, ParamsDict, PortsDict
 import typing as tp
-from collections import deque
+from collections import deque, defaultdict, namedtuple
 
 if tp.TYPE_CHECKING:
-    from blox.core.state import State, MetaDict, ParamsDict, PortsDict
+    from blox.core.state import State
     from blox.core.port import Port
 
 
@@ -29,9 +29,17 @@ class Next(PullResult):
         self.port = port
 
 
+# The part of a composite block that some of its output ports depend on:
+#   inputs   - a tuple of the block's input ports
+#   children - a tuple of pairs (child, frozenset of the child's output ports), in topological order
+Cone = namedtuple('Cone', field_names=['inputs', 'children'])
+
+
 class TopoSort:
     """ Topological sort of children blocks """
 
+    __slots__ = ('_block', '_changed', '_essential_blocks_toposort', '_dangling_blocks_toposort')
+
     def __init__(self, block: Block):
         self._block = block
         self._changed = True
@@ -42,6 +50,8 @@ class TopoSort:
         self._changed = True
 
     def _sort(self):
+        # networkx is slow to import, so it is loaded only when a composite block is first computed
+        import networkx as nx
 
         # Create link graph
         graph = nx.DiGraph()
@@ -84,15 +94,18 @@ class TopoSort:
 class Computable(Block):
     """ Base class for all computable blocks implementing the pull, push, propagate methods """
 
+    __slots__ = ('_toposort', '_cones')
+
     def __init__(self, *args, **kwargs):
         super(Computable, self).__init__(*args, **kwargs)
         self._toposort = TopoSort(self)
+        self._cones: tp.Dict[tp.FrozenSet[Port], Cone] = dict()
 
     def pull(self, port, state):
         """
         Compute a port's value using the pull protocol.
         """
-        assert port in self.In or port in self.Out, f"Port {port} doesn't belong to block {self}"
+        assert port.parent is self, f"Port {port} doesn't belong to block {self}"
 
         stack = deque()
         arrow = Next(port)
@@ -101,8 +114,9 @@ class Computable(Block):
             # We always enter the loop with an arrow
             if isinstance(arrow, Done):
 
+                # Lazy values travel unresolved through the pull chain and are resolved only for the caller
                 if len(stack) == 0:
-                    return arrow.value
+                    return resolve(arrow.value)
 
                 else:
                     arrow = stack[-1].send(arrow.value)
@@ -122,32 +136,44 @@ class Computable(Block):
                 raise ComputeError(f'Got unknown type for pull result {type(arrow)}')
 
     def pull_generator(self, port: Port, state: State):
-        assert port in self.In or port in self.Out, f"Port {port} doesn't belong to block {self}"
+        assert port.parent is self, f"Port {port} doesn't belong to block {self}"
 
-        if port in state:
-            yield Done(state[port])
+        if state.has_port(port):
+            yield Done(state.peek(port))
 
         if port.upstream is None:
             raise ComputeError(f'Trying to pull on port {port} without an upstream')
 
         value = yield Next(port.upstream)
-        state[port] = value
+        state.set_port(port, value)
 
         yield Done(value)
 
     def push(self, port: Port, state: State):
-        assert port in self.In or port in self.Out, f"Port {port} doesn't belong to block {self}"
+        assert port.parent is self, f"Port {port} doesn't belong to block {self}"
 
-        if port not in state:
+        if not state.has_port(port):
             raise ComputeError(f'Trying to push the port {port} that has no value')
 
+        value = state.peek(port)
         for p in port.downstream:
-            state[p] = state[port]
+            state.set_port(p, value)
+
+        if port.get_meta('propagate_cleanup'):
+            state.del_port(port)
 
-        if port.meta.get('propagate_cleanup'):
-            del state[port]
+    def propagate(self, state: State, ports: tp.Optional[tp.Iterable[Port]] = None):
+        """
+        Computes the output ports from the input ports.
+
+        When ports (output ports of self) are given, only the children in their dependency cone are propagated
+        and children whose required outputs are already in the state are skipped.
+        """
+
+        if ports is not None:
+            self._propagate_cone(state, self.dependency_cone(ports))
+            return
 
-    def propagate(self, state: State):
         # Push all inputs
         for port in self.In:
             port.block.push(port, state)
@@ -159,6 +185,66 @@ class Computable(Block):
             for port in child.Out:
                 port.block.push(port, state)
 
+    def _propagate_cone(self, state: State, cone: Cone):
+        for port in cone.inputs:
+            port.block.push(port, state)
+
+        for child, child_ports in cone.children:
+            if not all(state.has_port(port) for port in child_ports):
+
+                # Only composite children are propagated partially
+                if child.blocks:
+                    child.propagate(state, ports=child_ports)
+                else:
+                    child.propagate(state)
+
+            for port in child.Out:
+                if state.has_port(port):
+                    port.block.push(port, state)
+
+    def dependency_cone(self, ports: tp.Iterable[Port]) -> Cone:
+        """ Returns the input ports and the children (with their needed outputs) the given output ports depend on """
+        ports = frozenset(ports)
+
+        cone = self._cones.get(ports)
+        if cone is None:
+            cone = self._cones[ports] = self._compute_dependency_cone(ports)
+
+        return cone
+
+    def _compute_dependency_cone(self, ports: tp.FrozenSet[Port]) -> Cone:
+        inputs = set()
+        children = defaultdict(set)
+
+        # Walk the links backwards from the given ports
+        seen = set()
+        stack = list(ports)
+        while stack:
+            port = stack.pop()
+            if port in seen:
+                continue
+            seen.add(port)
+
+            upstream = port.upstream
+            if upstream is None:
+                continue
+
+            if upstream.block is self:
+                inputs.add(upstream)
+
+            elif upstream not in children[upstream.block]:
+                child = upstream.block
+                children[child].add(upstream)
+
+                if isinstance(child, Computable):
+                    stack.extend(child.dependency_cone([upstream]).inputs)
+                else:
+                    stack.extend(child.In)
+
+        return Cone(inputs=tuple(port for port in self.In if port in inputs),
+                    children=tuple((child, frozenset(children[child])) for child in self._toposort
+                                   if child in children))
+
     def handle(self, event):
         super(Computable, self).handle(event)
 
@@ -172,17 +258,22 @@ class Computable(Block):
             if port1 in self.In or (port1.block in self.blocks and port1 in port1.block.Out):
                 self._toposort.reset()
 
+            # Cones depend on the children's cones as well, so any link change below self resets them
+            self._cones.clear()
+
 
 class Function(Computable):
 
+    __slots__ = ()
+
     def pull_generator(self, port: Port, state: State):
-        assert port in self.In or port in self.Out, f"Port {port} doesn't belong to block {self}"
+        assert port.parent is self, f"Port {port} doesn't belong to block {self}"
 
-        if port in state:
-            yield Done(state[port])
+        if state.has_port(port):
+            yield Done(state.peek(port))
 
         # Input ports are simply pulled
-        if port in self.In:
+        if port.tag == 'In':
             gen = super(Function, self).pull_generator(port, state)
 
             # The following code does the following:
@@ -194,23 +285,33 @@ class Function(Computable):
             while not isinstance(pull_result, Done):
                 pull_result = gen.send((yield pull_result))
 
-        # For output ports we first pull the inputs and then propagate
+        # For output ports we first pull the inputs the port depends on and then propagate
         else:
-            for p in self.In:
+            for p in self.dependency_cone([port]).inputs:
                 gen = super(Function, self).pull_generator(p, state)
 
                 pull_result = next(gen)
                 while not isinstance(pull_result, Done):
                     pull_result = gen.send((yield pull_result))
 
-            self.propagate(state)
+            # Composite blocks compute only the children the port depends on
+            if self.blocks:
+                self.propagate(state, ports=[port])
+            else:
+                self.propagate(state)
 
-        assert port in state
-        yield Done(state[port])
+        assert state.has_port(port)
+        yield Done(state.peek(port))
 
 
 class AtomicFunction(Function):
 
+    __slots__ = ()
+
+    # Blocks whose outputs depend only on their inputs, parameters, global parameters and cache_token()
+    # may set this to True, allowing their results to be stored in the state's ResultCache (if any)
+    cacheable = False
+
     def __init__(self, *args, **kwargs):
         super(AtomicFunction, self).__init__(*args, **kwargs)
 
@@ -220,49 +321,83 @@ class AtomicFunction(Function):
                  params: ParamsDict):
         raise NotImplementedError
 
-    def propagate(self, state: State):
+    def cache_token(self) -> tp.Any:
+        """
+        Returns the configuration of the block (besides its code) that its results depend on.
+        By default these are the block's public attributes.
+        """
+        names = set(getattr(self, '__dict__', ()))
+        for cls in type(self).__mro__:
+            if cls is AtomicFunction:
+                break
+            slots = cls.__dict__.get('__slots__', ())
+            names.update((slots, ) if isinstance(slots, str) else slots)
+
+        return tuple((name, getattr(self, name)) for name in sorted(names)
+                     if not name.startswith('_') and hasattr(self, name))
 
-        from blox.core.state import MetaDict, ParamsDict, PortsDict
+    def dependency_cone(self, ports: tp.Iterable[Port]) -> Cone:
+        # Every output of an atomic function depends on all of its inputs
+        return Cone(inputs=tuple(self.In), children=())
 
-        # Get inputs
+    def propagate(self, state: State, ports: tp.Optional[tp.Iterable[Port]] = None):
+
+        # Get inputs (lazy inputs are resolved only if the callback reads them)
+        in_ports = tuple(self.In)
         ports = PortsDict()
-        for port in self.In:
-            ports[port] = state[port]
+        for port in in_ports:
+            ports.data[port] = state.peek(port)
 
         # Get block parameters
-        params: ParamsDict = state[self].params
+        params: ParamsDict = state.block_state(self).params
 
         # Get global parameters
         meta: MetaDict = state.meta
 
-        # Compute the function
-        result = self.callback(ports=ports, meta=meta, params=params)
+        # Compute the function (or take the result from the cache)
+        cache = state.cache
+        if cache is not None and self.cacheable:
+            single = len(self.Out) == 1
+            key = cache.key(self, [ports[port] for port in in_ports], params, meta)
+            found, outputs = cache.get(key)
+            if found:
+                result = outputs[0] if single else outputs
+            else:
+                result = self.callback(ports=ports, meta=meta, params=params)
+                cache.put(key, (result, ) if single else tuple(result))
+        else:
+            result = self.callback(ports=ports, meta=meta, params=params)
 
         # TODO this parameter should be overridable by params or meta
         # Memory maintenance
-        for port in self.In:
-            if port.meta.get('propagate_cleanup'):
-                del state[port]
+        for port in in_ports:
+            if port.get_meta('propagate_cleanup'):
+                state.del_port(port)
 
         # Set outputs
-        if len(self.Out) == 1:
-            state[self.Out()] = result
+        out_ports = self.Out
+        if len(out_ports) == 1:
+            state.set_port(out_ports(), result)
         else:
-            if len(self.Out) != len(result):
-                raise ComputeError(f"In Function {self}: expected {len(self.Out)} outputs, got {len(result)}")
+            if len(out_ports) != len(result):
+                raise ComputeError(f"In Function {self}: expected {len(out_ports)} outputs, got {len(result)}")
 
-            for out_port, value in zip(self.Out, result):
-                state[out_port] = value
+            for out_port, value in zip(out_ports, result):
+                state.set_port(out_port, value)
 
 
 class Source(Computable):
 
+    __slots__ = ()
+
     def __init__(self, name=None):
         super(Source, self).__init__(name=name, In=None, Out='out')
 
 
 class Sink(Computable):
 
+    __slots__ = ()
+
     def __init__(self, name=None):
         super(Sink, self).__init__(name=name, In='in', Out=None)
 
@@ -7,18 +7,30 @@ from blox.core.events import NodePreRename, NodePostRename, \
     NodePreAttach, NodePostAttach, NodePostDetach, NodePreDetach
 from blox.etc.utils import camel_to_snake
 from blox.etc.errors import NameCollisionError
-from collections import defaultdict, OrderedDict
 from blox.etc.errors import LoopError, TreeError, BadNameError
-from boltons.cacheutils import cachedproperty
 from collections import deque
+from types import MappingProxyType
+
+
+# Stands for the children tables that were not allocated yet
+_EMPTY = MappingProxyType({})
 
 
 class TagView:
+    """ A view of the node's children with a given tag """
 
-    __slots__ = ('_data',)
+    __slots__ = ('_node', '_tag')
 
-    def __init__(self, data):
-        self._data = data
+    def __init__(self, node, tag):
+        self._node = node
+        self._tag = tag
+
+    @property
+    def _data(self):
+        children = self._node._children
+        if children is None:
+            return _EMPTY
+        return children.get(self._tag, _EMPTY)
 
     def __contains__(self, item):
         if isinstance(item, NamedNode):
@@ -53,27 +65,30 @@ class TagView:
 
 class ChildrenView:
 
-    __slots__ = ('_data',)
+    __slots__ = ('_node',)
 
-    def __init__(self, data):
-        self._data = data
+    def __init__(self, node):
+        self._node = node
 
     def __contains__(self, item):
         if isinstance(item, NamedNode):
-            return item.name in self._data[item.tag] and self._data[item.tag][item.name] is item
+            return item in self[item.tag]
         else:
             return False
 
     def __iter__(self):
-        for tag in self._data:
-            yield self[tag]
+        children = self._node._children
+        if children is not None:
+            for tag in list(children):
+                yield self[tag]
 
     def __getitem__(self, tag):
-        return TagView(self._data[tag])
+        return TagView(self._node, tag)
 
 
 class NamedNode:
-    __slots__ = ('_name', '_tag', '_parent', '_children', '_tag_in_full_path', 'meta')
+    # Children tables (a dict of dicts by tag and name) and meta are allocated on first use
+    __slots__ = ('_name', '_tag', '_parent', '_children', '_tag_in_full_path', '_meta')
 
     separator = "/"
 
@@ -81,12 +96,24 @@ class NamedNode:
         self._name = name or camel_to_snake(self.__class__.__name__)
         self._tag = tag or ''
         self._parent = None
-        self._children = defaultdict(OrderedDict)
+        self._children = None
         self._tag_in_full_path = tag_in_full_path
+        self._meta = None
 
         self._check_name(self._name)
 
-        self.meta = dict()  # To handle any extra data associated with the node
+    @property
+    def meta(self) -> tp.Dict[str, tp.Any]:
+        """ To handle any extra data associated with the node """
+        if self._meta is None:
+            self._meta = dict()
+        return self._meta
+
+    def get_meta(self, key, default=None):
+        """ Same as meta.get, without allocating the meta dictionary """
+        if self._meta is None:
+            return default
+        return self._meta.get(key, default)
 
     @property
     def name(self):
@@ -104,9 +131,9 @@ class NamedNode:
     def tag(self):
         return self._tag
 
-    @cachedproperty
+    @property
     def children(self):
-        return ChildrenView(self._children)
+        return ChildrenView(self)
 
     @property
     def parent(self):
@@ -262,6 +289,12 @@ class NamedNode:
                 node.handle(event)
                 seen_nodes.add(id(node))
 
+    def _siblings(self, tag):
+        """ Returns the children table of the given tag (read only) """
+        if self._children is None:
+            return _EMPTY
+        return self._children.get(tag, _EMPTY)
+
     def handle(self, event):
 
         # Handle name collisions when renaming a child
@@ -269,7 +302,7 @@ class NamedNode:
             parent, child, new_name = event.parent, event.node, event.new_name
 
             if parent is self:
-                siblings = self._children[child.tag]
+                siblings = self._siblings(child.tag)
                 if new_name in siblings and siblings[new_name] is not child:
                     raise NameCollisionError(f'Name "{new_name}" with tag "{child.tag}" '
                                              f'exists in {parent}')
@@ -290,15 +323,16 @@ class NamedNode:
         elif isinstance(event, NodePreAttach):
             parent, child = event.parent, event.node
             if parent is self:
-                siblings = self._children[child.tag]
-                if child.name in siblings:
+                if child.name in self._siblings(child.tag):
                     raise NameCollisionError(f'Name "{child.name}" with tag "{child.tag}" exists in {parent}')
 
         # Update child addition in parent
         elif isinstance(event, NodePostAttach):
             parent, child = event.parent, event.node
             if parent is self:
-                siblings = self._children[child.tag]
+                if self._children is None:
+                    self._children = dict()
+                siblings = self._children.setdefault(child.tag, dict())
                 assert child.name not in siblings
                 siblings[child.name] = child
 
@@ -310,3 +344,8 @@ class NamedNode:
                 siblings = self._children[child.tag]
                 assert siblings.pop(child.name) is child
 
+                # Release the emptied tables
+                if not siblings:
+                    del self._children[child.tag]
+                    if not self._children:
+                        self._children = None
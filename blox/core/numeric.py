@@ -0,0 +1,328 @@
+""" Operator blocks working on NumPy arrays """
+from __future__ import annotations
+import typing as tp
+from contextlib import contextmanager
+import numpy as np
+from blox.core.compute import AtomicFunction
+from blox.core.operators import operator_classes
+
+
+class NumpyOperator(AtomicFunction):
+    """
+    Base class for the NumPy operator blocks.
+
+    Parameters
+    ----------
+    dtype
+        The dtype of the result (None keeps NumPy's type promotion).
+
+    preallocate
+        Reuse one output buffer per combination of input shapes and dtypes. Note that each evaluation
+        then overwrites the result of the previous one.
+
+    inplace
+        Write the result into the first input when it is an array of exactly the result's shape and dtype
+        (as determined by the operator's type resolution; operators that change the shape, such as
+        reductions and matmul, never do). Use only when no other block reads that input.
+    """
+
+    __slots__ = ('dtype', 'preallocate', 'inplace', '_buffers')
+
+    def __init__(self, name=None, In=None, Out='out', dtype=None, preallocate=False, inplace=False):
+        super(NumpyOperator, self).__init__(name=name, In=In, Out=Out)
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        self.preallocate = preallocate
+        self.inplace = inplace
+        self._buffers: tp.Dict[tp.Tuple, tp.Union[np.ndarray, tp.Tuple[np.ndarray, ...]]] = dict()
+
+    def compute(self, *args, out=None):
+        raise NotImplementedError
+
+    def callback(self, ports, meta, params):
+        args = tuple(ports[port] for port in self.In)
+
+        if not (self.preallocate or self.inplace):
+            return self.compute(*args)
+
+        key = tuple((arg.shape, arg.dtype) if isinstance(arg, np.ndarray) else type(arg) for arg in args)
+
+        out = self._buffers.get(key)
+        if out is None and self.inplace and args and isinstance(args[0], np.ndarray) and args[0].flags.writeable:
+            out = self._inplace_target(args)
+
+        if out is not None:
+            return self.compute(*args, out=out)
+
+        result = self.compute(*args)
+
+        # Results that are views of the inputs (e.g. a cast to the same dtype) must not be reused as buffers.
+        # Operators with several outputs (divmod) reuse all of them
+        results = result if isinstance(result, tuple) else (result, )
+        if self.preallocate and all(isinstance(r, np.ndarray) for r in results) and \
+                not any(isinstance(arg, np.ndarray) and np.shares_memory(r, arg) for r in results for arg in args):
+            self._buffers[key] = result
+
+        return result
+
+    def _inplace_target(self, args):
+        """ Returns the first input if the result has exactly its shape and dtype """
+        spec = self._result_spec(args)
+        if spec is None:
+            return None
+
+        shape, dtype = spec
+        target = args[0]
+        return target if target.shape == shape and target.dtype == dtype else None
+
+    def _result_spec(self, args) -> tp.Optional[tp.Tuple[tp.Tuple[int, ...], np.dtype]]:
+        """ The shape and dtype of the result, if known in advance (otherwise the result is never in place) """
+        return None
+
+
+def _ufunc_result_spec(ufunc: np.ufunc, args, dtype: tp.Optional[np.dtype]):
+    """ The result shape and dtype of an elementwise ufunc, following its own type resolution """
+    if ufunc.nout != 1 or ufunc.signature is not None or not hasattr(ufunc, 'resolve_dtypes'):
+        return None
+
+    shape = np.broadcast_shapes(*(np.shape(arg) for arg in args))
+    if dtype is not None:
+        return shape, dtype
+
+    # Python scalars are passed by type, so they are treated as weakly typed (as in the computation itself)
+    dtypes = tuple(arg.dtype if hasattr(arg, 'dtype') else type(arg) for arg in args)
+    try:
+        return shape, ufunc.resolve_dtypes(dtypes + (None, ))[-1]
+    except (TypeError, ValueError):
+        return None
+
+
+class NumpyUnaryOperator(NumpyOperator):
+    """ Applies a unary ufunc elementwise """
+
+    __slots__ = ('ufunc', )
+
+    UFUNCS = {
+        'neg': np.negative,
+        'pos': np.positive,
+        'abs': np.absolute,
+        'invert': np.invert,
+        'sqrt': np.sqrt,
+        'exp': np.exp,
+        'log': np.log,
+        'sin': np.sin,
+        'cos': np.cos,
+        'tanh': np.tanh,
+        'floor': np.floor,
+        'ceil': np.ceil,
+        'sign': np.sign,
+        'logical_not': np.logical_not,
+    }
+
+    def __init__(self, op, **kwargs):
+        super(NumpyUnaryOperator, self).__init__(name=op.lower(), In=['in'], **kwargs)
+        self.ufunc = self.UFUNCS[op.lower()]
+
+    def compute(self, x, out=None):
+        return self.ufunc(x, out=out, dtype=self.dtype)
+
+    def _result_spec(self, args):
+        return _ufunc_result_spec(self.ufunc, args, self.dtype)
+
+
+class NumpyBinaryOperator(NumpyOperator):
+    """ Applies a binary ufunc elementwise (with broadcasting) """
+
+    __slots__ = ('ufunc', )
+
+    UFUNCS = {
+        'add': np.add,
+        'sub': np.subtract,
+        'mul': np.multiply,
+        'matmul': np.matmul,
+        'truediv': np.true_divide,
+        'floordiv': np.floor_divide,
+        'mod': np.remainder,
+        'pow': np.power,
+        'lshift': np.left_shift,
+        'rshift': np.right_shift,
+        'and': np.bitwise_and,
+        'xor': np.bitwise_xor,
+        'or': np.bitwise_or,
+        'maximum': np.maximum,
+        'minimum': np.minimum,
+        'less': np.less,
+        'less_equal': np.less_equal,
+        'greater': np.greater,
+        'greater_equal': np.greater_equal,
+        'equal': np.equal,
+        'not_equal': np.not_equal,
+        'logical_and': np.logical_and,
+        'logical_or': np.logical_or,
+        'logical_xor': np.logical_xor,
+    }
+
+    def __init__(self, op, **kwargs):
+        op = op.lower()
+
+        # divmod has two outputs (see NumpyDivmod)
+        if op == 'divmod':
+            raise ValueError('Use NumpyDivmod for divmod')
+
+        super(NumpyBinaryOperator, self).__init__(name=op, In=['in1', 'in2'], **kwargs)
+        self.ufunc = self.UFUNCS[op]
+
+    def compute(self, x, y, out=None):
+        return self.ufunc(x, y, out=out, dtype=self.dtype)
+
+    def _result_spec(self, args):
+        # Generalized ufuncs (matmul) have core dimensions, so their results are never in place
+        return _ufunc_result_spec(self.ufunc, args, self.dtype)
+
+
+class NumpyDivmod(NumpyOperator):
+    """ Computes the quotient and the remainder (with broadcasting). In place, the quotient replaces the first input """
+
+    __slots__ = ()
+
+    def __init__(self, name='divmod', **kwargs):
+        super(NumpyDivmod, self).__init__(name=name, In=['in1', 'in2'], Out=['quotient', 'remainder'], **kwargs)
+
+    def compute(self, x, y, out=None):
+        return np.divmod(x, y, out=out if out is not None else (None, None), dtype=self.dtype)
+
+    def _inplace_target(self, args):
+        """ Returns the first input and a new remainder if the quotient has exactly the input's shape and dtype """
+        if not hasattr(np.divmod, 'resolve_dtypes'):
+            return None
+
+        shape = np.broadcast_shapes(*(np.shape(arg) for arg in args))
+        if self.dtype is not None:
+            quotient_dtype = remainder_dtype = self.dtype
+        else:
+            dtypes = tuple(arg.dtype if hasattr(arg, 'dtype') else type(arg) for arg in args)
+            try:
+                *_, quotient_dtype, remainder_dtype = np.divmod.resolve_dtypes(dtypes + (None, None))
+            except (TypeError, ValueError):
+                return None
+
+        target = args[0]
+        if target.shape != shape or target.dtype != quotient_dtype:
+            return None
+        return target, np.empty(shape, dtype=remainder_dtype)
+
+
+class Reduce(NumpyOperator):
+    """ Reduces an array along the given axis """
+
+    __slots__ = ('op', 'function', 'axis', 'keepdims')
+
+    FUNCTIONS = {
+        'sum': np.sum,
+        'prod': np.prod,
+        'mean': np.mean,
+        'std': np.std,
+        'var': np.var,
+        'min': np.min,
+        'max': np.max,
+        'any': np.any,
+        'all': np.all,
+        'argmin': np.argmin,
+        'argmax': np.argmax,
+    }
+
+    # These don't accept the dtype argument
+    _NO_DTYPE = ('min', 'max', 'any', 'all', 'argmin', 'argmax')
+
+    def __init__(self, op, axis=None, keepdims=False, name=None, **kwargs):
+        op = op.lower()
+        super(Reduce, self).__init__(name=name or op, In=['in'], **kwargs)
+        self.op = op
+        self.function = self.FUNCTIONS[op]
+        self.axis = axis
+        self.keepdims = keepdims
+
+    def compute(self, x, out=None):
+        # A result of a custom dtype is converted after the reduction, so there is no buffer to write into
+        if self.dtype is not None and self.op in self._NO_DTYPE:
+            out = None
+
+        kwargs = dict(axis=self.axis, out=out, keepdims=self.keepdims)
+        if self.op not in self._NO_DTYPE:
+            kwargs.update(dtype=self.dtype)
+
+        result = self.function(x, **kwargs)
+
+        if self.dtype is not None and self.op in self._NO_DTYPE:
+            result = result.astype(self.dtype, copy=False)
+
+        return result
+
+
+class Where(NumpyOperator):
+    """ Selects elements from in1 where cond holds and from in2 elsewhere """
+
+    __slots__ = ()
+
+    def __init__(self, name='where', **kwargs):
+        super(Where, self).__init__(name=name, In=['cond', 'in1', 'in2'], **kwargs)
+
+    def compute(self, cond, x, y, out=None):
+        if out is None:
+            result = np.where(cond, x, y)
+            return result if self.dtype is None else result.astype(self.dtype, copy=False)
+
+        np.copyto(out, y, casting='unsafe')
+        np.copyto(out, x, casting='unsafe', where=np.asarray(cond, dtype=bool))
+        return out
+
+
+class Clip(NumpyOperator):
+    """ Limits the values of an array to [a_min, a_max] """
+
+    __slots__ = ('a_min', 'a_max')
+
+    def __init__(self, a_min=None, a_max=None, name='clip', **kwargs):
+        super(Clip, self).__init__(name=name, In=['in'], **kwargs)
+        self.a_min = a_min
+        self.a_max = a_max
+
+    def compute(self, x, out=None):
+        return np.clip(x, self.a_min, self.a_max, out=out, dtype=self.dtype)
+
+    def _result_spec(self, args):
+        x = args[0]
+        bounds = [bound for bound in (self.a_min, self.a_max) if bound is not None]
+        return np.shape(x), self.dtype if self.dtype is not None else np.result_type(x, *bounds)
+
+
+class Cast(NumpyOperator):
+    """ Converts an array to the given dtype """
+
+    __slots__ = ()
+
+    def __init__(self, dtype, name='cast', **kwargs):
+        super(Cast, self).__init__(name=name, In=['in'], dtype=dtype, **kwargs)
+
+    def compute(self, x, out=None):
+        if out is None:
+            return np.asarray(x).astype(self.dtype, copy=False)
+
+        np.copyto(out, x, casting='unsafe')
+        return out
+
+
+def _numpy_binary_operator(op):
+    # divmod has two outputs, so divmod(port1, port2) returns the (quotient, remainder) ports
+    if op.lower() == 'divmod':
+        return NumpyDivmod()
+    return NumpyBinaryOperator(op)
+
+
+@contextmanager
+def numpy_operators():
+    """ Within this context port operators (e.g. port1 + port2) create NumPy operator blocks """
+    token = operator_classes.set((_numpy_binary_operator, NumpyUnaryOperator))
+    try:
+        yield
+    finally:
+        operator_classes.reset(token)
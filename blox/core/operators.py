@@ -1,6 +1,35 @@
+from __future__ import annotations
+import typing as tp
+from contextvars import ContextVar
+
+
+# The (binary, unary) operator block factories (classes or functions of the operator name) used by the port
+# operators. None stands for the default classes (BinaryOperator and UnaryOperator).
+# See blox.core.numeric.numpy_operators for an example.
+operator_classes: ContextVar[tp.Optional[tp.Tuple[tp.Callable, tp.Callable]]] = ContextVar('operator_classes', default=None)
+
+
 class PortOperatorsMixin:
     """ Allow operations between ports """
 
+    __slots__ = ()
+
+    @staticmethod
+    def _binary_operator(op):
+        classes = operator_classes.get()
+        if classes is None:
+            from blox.core.special import BinaryOperator
+            return BinaryOperator(op)
+        return classes[0](op)
+
+    @staticmethod
+    def _unary_operator(op):
+        classes = operator_classes.get()
+        if classes is None:
+            from blox.core.special import UnaryOperator
+            return UnaryOperator(op)
+        return classes[1](op)
+
     @staticmethod
     def _make_port(other):
         """ Convert non-port values to Const blocks """
@@ -12,133 +41,101 @@ class PortOperatorsMixin:
             return other
 
     def __add__(self, other):
-        from blox.core.special import BinaryOperator
-        return BinaryOperator('add')(self, self._make_port(other))
+        return self._binary_operator('add')(self, self._make_port(other))
 
     def __sub__(self, other):
-        from blox.core.special import BinaryOperator
-        return BinaryOperator('sub')(self, self._make_port(other))
+        return self._binary_operator('sub')(self, self._make_port(other))
 
     def __mul__(self, other):
-        from blox.core.special import BinaryOperator
-        return BinaryOperator('mul')(self, self._make_port(other))
+        return self._binary_operator('mul')(self, self._make_port(other))
 
     def __matmul__(self, other):
-        from blox.core.special import BinaryOperator
-        return BinaryOperator('matmul')(self, self._make_port(other))
+        return self._binary_operator('matmul')(self, self._make_port(other))
 
     def __truediv__(self, other):
-        from blox.core.special import BinaryOperator
-        return BinaryOperator('truediv')(self, self._make_port(other))
+        return self._binary_operator('truediv')(self, self._make_port(other))
 
     def __floordiv__(self, other):
-        from blox.core.special import BinaryOperator
-        return BinaryOperator('floordiv')(self, self._make_port(other))
+        return self._binary_operator('floordiv')(self, self._make_port(other))
 
     def __mod__(self, other):
-        from blox.core.special import BinaryOperator
-        return BinaryOperator('mod')(self, self._make_port(other))
+        return self._binary_operator('mod')(self, self._make_port(other))
 
     def __divmod__(self, other):
-        from blox.core.special import BinaryOperator
-        return BinaryOperator('divmod')(self, self._make_port(other))
+        return self._binary_operator('divmod')(self, self._make_port(other))
 
     def __pow__(self, other):
-        from blox.core.special import BinaryOperator
-        return BinaryOperator('pow')(self, self._make_port(other))
+        return self._binary_operator('pow')(self, self._make_port(other))
 
     def __lshift__(self, other):
-        from blox.core.special import BinaryOperator
-        return BinaryOperator('lshift')(self, self._make_port(other))
+        return self._binary_operator('lshift')(self, self._make_port(other))
 
     def __rshift__(self, other):
-        from blox.core.special import BinaryOperator
-        return BinaryOperator('rshift')(self, self._make_port(other))
+        return self._binary_operator('rshift')(self, self._make_port(other))
 
     def __and__(self, other):
-        from blox.core.special import BinaryOperator
-        return BinaryOperator('and')(self, self._make_port(other))
+        return self._binary_operator('and')(self, self._make_port(other))
 
     def __xor__(self, other):
-        from blox.core.special import BinaryOperator
-        return BinaryOperator('xor')(self, self._make_port(other))
+        return self._binary_operator('xor')(self, self._make_port(other))
 
     def __or__(self, other):
-        from blox.core.special import BinaryOperator
-        return BinaryOperator('or')(self, self._make_port(other))
+        return self._binary_operator('or')(self, self._make_port(other))
 
     def __radd__(self, other):
-        from blox.core.special import BinaryOperator
-        return BinaryOperator('add')(self._make_port(other), self)
+        return self._binary_operator('add')(self._make_port(other), self)
 
     def __rsub__(self, other):
-        from blox.core.special import BinaryOperator
-        return BinaryOperator('sub')(self._make_port(other), self)
+        return self._binary_operator('sub')(self._make_port(other), self)
 
     def __rmul__(self, other):
-        from blox.core.special import BinaryOperator
-        return BinaryOperator('mul')(self._make_port(other), self)
+        return self._binary_operator('mul')(self._make_port(other), self)
 
     def __rmatmul__(self, other):
-        from blox.core.special import BinaryOperator
-        return BinaryOperator('matmul')(self._make_port(other), self)
+        return self._binary_operator('matmul')(self._make_port(other), self)
 
     def __rtruediv__(self, other):
-        from blox.core.special import BinaryOperator
-        return BinaryOperator('truediv')(self._make_port(other), self)
+        return self._binary_operator('truediv')(self._make_port(other), self)
 
     def __rfloordiv__(self, other):
-        from blox.core.special import BinaryOperator
-        return BinaryOperator('floordiv')(self._make_port(other), self)
+        return self._binary_operator('floordiv')(self._make_port(other), self)
 
     def __rmod__(self, other):
-        from blox.core.special import BinaryOperator
-        return BinaryOperator('mod')(self._make_port(other), self)
+        return self._binary_operator('mod')(self._make_port(other), self)
 
     def __rdivmod__(self, other):
-        from blox.core.special import BinaryOperator
-        return BinaryOperator('divmod')(self._make_port(other), self)
+        return self._binary_operator('divmod')(self._make_port(other), self)
 
     def __rpow__(self, other):
-        from blox.core.special import BinaryOperator
-        return BinaryOperator('pow')(self._make_port(other), self)
+        return self._binary_operator('pow')(self._make_port(other), self)
 
     def __rlshift__(self, other):
-        from blox.core.special import BinaryOperator
-        return BinaryOperator('lshift')(self._make_port(other), self)
+        return self._binary_operator('lshift')(self._make_port(other), self)
 
     def __rrshift__(self, other):
-        from blox.core.special import BinaryOperator
-        return BinaryOperator('rshift')(self._make_port(other), self)
+        return self._binary_operator('rshift')(self._make_port(other), self)
 
     def __rand__(self, other):
-        from blox.core.special import BinaryOperator
-        return BinaryOperator('and')(self._make_port(other), self)
+        return self._binary_operator('and')(self._make_port(other), self)
 
     def __rxor__(self, other):
-        from blox.core.special import BinaryOperator
-        return BinaryOperator('xor')(self._make_port(other), self)
+        return self._binary_operator('xor')(self._make_port(other), self)
 
     def __ror__(self, other):
-        from blox.core.special import BinaryOperator
-        return BinaryOperator('or')(self._make_port(other), self)
+        return self._binary_operator('or')(self._make_port(other), self)
 
     # Unary operators
     def __neg__(self):
-        from blox.core.special import UnaryOperator
-        return UnaryOperator('neg')(self)
+        return self._unary_operator('neg')(self)
 
     def __pos__(self):
-        from blox.core.special import UnaryOperator
-        return UnaryOperator('pos')(self)
+        return self._unary_operator('pos')(self)
 
     def __abs__(self):
-        from blox.core.special import UnaryOperator
-        return UnaryOperator('abs')(self)
+        return self._unary_operator('abs')(self)
 
     def __invert__(self):
-        from blox.core.special import UnaryOperator
-        return UnaryOperator('invert')(self)
+        return self._unary_operator('invert')(self)
 
     # Functional operators
 
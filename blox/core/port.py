@@ -1,9 +1,8 @@
 from __future__ import annotations
 import typing as tp
 from blox.etc.loggingclass import LoggerMixin
-from blox.core.node import NamedNode
+from blox.core.node import NamedNode, _EMPTY
 from blox.etc.errors import PortConnectionError
-from boltons.cacheutils import cachedproperty
 from blox.core.operators import PortOperatorsMixin
 from blox.core.events import NodePreAttach, NodePreDetach
 from blox.core.events import LinkPostDisconnect, LinkPostConnect, LinkPreConnect, LinkPreDisconnect
@@ -11,12 +10,29 @@ from blox.core.events import LinkPostDisconnect, LinkPostConnect, LinkPreConnect
 
 class Port(NamedNode, LoggerMixin, PortOperatorsMixin):
 
+    # The downstream table is allocated on the first downstream connection
+    __slots__ = ('_upstream', '_downstream')
+
     def __init__(self, name=None, tag=None):
         super(Port, self).__init__(name, tag=tag, tag_in_full_path=True)
 
         self._upstream = None
-        self._downstream = dict()
-        
+        self._downstream = None
+
+    def __setstate__(self, state):
+        # The downstream table is keyed by id, which changes when the port is unpickled
+        attributes, slots = state
+        if attributes:
+            # Subclasses without __slots__ keep their own attributes in an instance __dict__
+            self.__dict__.update(attributes)
+
+        downstream = slots.get('_downstream')
+        if downstream is not None:
+            slots['_downstream'] = {id(port): port for port in downstream.values()}
+
+        for name, value in slots.items():
+            setattr(self, name, value)
+
     @property
     def block(self):
         return self.parent
@@ -25,9 +41,9 @@ class Port(NamedNode, LoggerMixin, PortOperatorsMixin):
     def upstream(self):
         return self._upstream
 
-    @cachedproperty
+    @property
     def downstream(self):
-        return DownstreamView(self, self._downstream)
+        return DownstreamView(self)
 
     @property
     def upstream_block(self):
@@ -58,7 +74,10 @@ class Port(NamedNode, LoggerMixin, PortOperatorsMixin):
 
             self.bubble(LinkPreDisconnect(self.upstream, self), start_nodes=[self, upstream])
 
-            del getattr(self.upstream, '_downstream')[id(self)]
+            downstream = getattr(upstream, '_downstream')
+            del downstream[id(self)]
+            if not downstream:
+                setattr(upstream, '_downstream', None)
             self._upstream = None
 
             self.bubble(LinkPostDisconnect(self.upstream, self), start_nodes=[self, upstream])
@@ -78,6 +97,8 @@ class Port(NamedNode, LoggerMixin, PortOperatorsMixin):
 
             # Set upstream
             self._upstream = port
+            if getattr(port, '_downstream') is None:
+                setattr(port, '_downstream', dict())
             getattr(port, '_downstream')[id(self)] = self
 
             self.bubble(LinkPostConnect(port, self), start_nodes=[port, self])
@@ -131,12 +152,16 @@ class Port(NamedNode, LoggerMixin, PortOperatorsMixin):
 class DownstreamView:
     """ A set-like view of a port's downstream """
 
-    __slots__ = ('_data', '_port')
+    __slots__ = ('_port', )
 
-    def __init__(self, port, data):
-        self._data = data
+    def __init__(self, port):
         self._port = port
 
+    @property
+    def _data(self):
+        data = getattr(self._port, '_downstream')
+        return data if data is not None else _EMPTY
+
     def __contains__(self, item):
         return id(item) in self._data
 
@@ -0,0 +1,121 @@
+""" Serializers of port values to files (used e.g. by SpillingState) """
+from __future__ import annotations
+import sys
+import pickle
+import typing as tp
+from abc import ABC, abstractmethod
+
+
+class Serializer(ABC):
+    """ Writes values of some types to files and reads them back """
+
+    # The file name suffix
+    suffix = ''
+
+    @abstractmethod
+    def can_serialize(self, value: tp.Any) -> bool:
+        pass
+
+    @abstractmethod
+    def dump(self, value: tp.Any, path: str):
+        pass
+
+    @abstractmethod
+    def load(self, path: str) -> tp.Any:
+        pass
+
+
+class PickleSerializer(Serializer):
+    """ Handles any picklable value. Used as the fallback """
+
+    suffix = '.pkl'
+
+    def __init__(self, protocol: int = pickle.HIGHEST_PROTOCOL):
+        self.protocol = protocol
+
+    def can_serialize(self, value):
+        return True
+
+    def dump(self, value, path):
+        with open(path, 'wb') as f:
+            pickle.dump(value, f, protocol=self.protocol)
+
+    def load(self, path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+
+class NumpySerializer(Serializer):
+    """
+    Handles NumPy arrays (except object arrays).
+
+    With mmap the arrays are loaded as copy-on-write memory maps of the files, so only the parts
+    that are read are brought into memory.
+    """
+
+    suffix = '.npy'
+
+    def __init__(self, mmap: bool = True):
+        self.mmap = mmap
+
+    def can_serialize(self, value):
+        # If numpy isn't imported the value can't be an array (this keeps numpy optional)
+        np = sys.modules.get('numpy')
+        return np is not None and type(value) is np.ndarray and not value.dtype.hasobject
+
+    def dump(self, value, path):
+        import numpy as np
+        with open(path, 'wb') as f:
+            np.save(f, value, allow_pickle=False)
+
+    def load(self, path):
+        import numpy as np
+        return np.load(path, mmap_mode='c' if self.mmap else None, allow_pickle=False)
+
+
+class TorchSerializer(Serializer):
+    """ Handles torch tensors (loaded to the device they were saved from) """
+
+    suffix = '.pt'
+
+    def can_serialize(self, value):
+        torch = sys.modules.get('torch')
+        return torch is not None and isinstance(value, torch.Tensor)
+
+    def dump(self, value, path):
+        import torch
+        torch.save(value.detach(), path)
+
+    def load(self, path):
+        import torch
+        return torch.load(path)
+
+
+def default_serializers() -> tp.List[Serializer]:
+    return [NumpySerializer(), TorchSerializer(), PickleSerializer()]
+
+
+def select_serializer(serializers: tp.Iterable[Serializer], value: tp.Any) -> Serializer:
+    """ Returns the first serializer that can handle the value """
+    for serializer in serializers:
+        if serializer.can_serialize(value):
+            return serializer
+    raise TypeError(f'No serializer can handle values of type {type(value).__name__}')
+
+
+def estimate_size(value: tp.Any) -> int:
+    """ Returns the approximate memory size of a value in bytes """
+
+    # NumPy arrays and anything else exposing nbytes
+    nbytes = getattr(value, 'nbytes', None)
+    if isinstance(nbytes, int):
+        return nbytes
+
+    torch = sys.modules.get('torch')
+    if torch is not None and isinstance(value, torch.Tensor):
+        return value.element_size() * value.nelement()
+
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return len(value)
+
+    return sys.getsizeof(value)
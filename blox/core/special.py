@@ -28,6 +28,8 @@ class UnaryOps(Enum):
 
 class UnaryOperator(AtomicFunction):
 
+    __slots__ = ('op', )
+
     OPS = {
         'neg': '__neg__',
         'pos': '__pos__',
@@ -46,6 +48,8 @@ class UnaryOperator(AtomicFunction):
 
 class BinaryOperator(AtomicFunction):
 
+    __slots__ = ('op', )
+
     OPS = {
         'add': '__add__',
         'sub': '__sub__',
@@ -84,6 +88,8 @@ class BinaryOperator(AtomicFunction):
 
 class Const(AtomicFunction):
 
+    __slots__ = ('_value', )
+
     def __init__(self, value):
         super(Const, self).__init__(name=None, Out='out')
         self._value = value
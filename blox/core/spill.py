@@ -0,0 +1,303 @@
+""" A State that keeps port values within a memory budget by spilling them to files """
+from __future__ import annotations
+import os
+import tempfile
+import typing as tp
+import weakref
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from concurrent.futures import Future
+from functools import partial
+from blox.core.state import State, BlockState, PortsDict, LazyValue, _BlockStates
+from blox.core.serializers import Serializer, default_serializers, select_serializer, estimate_size
+
+if tp.TYPE_CHECKING:
+    from blox.core.port import Port
+
+
+def _remove_file(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _identity(value):
+    return value
+
+
+class SpilledValue(LazyValue):
+    """ A port value that was written to a file. It is read back on every resolve (and not cached) """
+
+    __slots__ = ('path', 'serializer', '_directory', '__weakref__')
+
+    def __init__(self, path: str, serializer: Serializer,
+                 directory: tp.Optional[tempfile.TemporaryDirectory] = None):
+        super(SpilledValue, self).__init__(serializer.load, path)
+        self.path = path
+        self.serializer = serializer
+
+        # The temporary directory of the file (if any) is removed only after the handles in it are gone,
+        # even when they outlive the state that spilled them (e.g. in a fork)
+        self._directory = directory
+
+        # The file lives as long as some port holds the handle
+        weakref.finalize(self, _remove_file, path)
+
+    @property
+    def resolved(self) -> bool:
+        return False
+
+    def resolve(self):
+        return self.serializer.load(self.path)
+
+    def __reduce__(self):
+        # The files are local, so spilled values are pickled as their contents
+        return _identity, (self.resolve(), )
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.path!r})'
+
+
+class _Entry:
+    """ A value in memory, its estimated size and the ports holding it """
+
+    __slots__ = ('value', 'size', 'holders')
+
+    def __init__(self, value, size: int):
+        self.value = value
+        self.size = size
+
+        # (id(ports), port) -> ports
+        self.holders: tp.Dict[tp.Tuple[int, Port], _TrackedPorts] = dict()
+
+
+class _Spiller:
+    """
+    Tracks the memory taken by port values and spills the least recently used ones. Values are counted
+    (and spilled) once, however many ports hold them.
+    """
+
+    def __init__(self, memory_budget: int, directory: tp.Optional[str],
+                 serializers: tp.List[Serializer], min_size: int):
+        self.memory_budget = memory_budget
+        self.memory_used = 0
+        self.directory = directory
+        self.serializers = serializers
+        self.min_size = min_size
+
+        # id(value) -> entry in the order of use
+        self._entries: tp.Dict[int, _Entry] = OrderedDict()
+
+        # (id(ports), port) -> id(value)
+        self._holders: tp.Dict[tp.Tuple[int, Port], int] = dict()
+
+        # id(value) -> (weak reference to value, handle). Values held by several ports are written once
+        self._handles: tp.Dict[int, tp.Tuple[weakref.ref, SpilledValue]] = dict()
+
+        self._temp_dir = None
+
+    def add(self, ports: _TrackedPorts, port: Port, value):
+        size = estimate_size(value)
+        if size < self.min_size:
+            return
+
+        # The entry holds the value, so its id can't be reused while the entry exists
+        entry = self._entries.get(id(value))
+        if entry is None:
+            entry = self._entries[id(value)] = _Entry(value, size)
+            self.memory_used += size
+        else:
+            self._entries.move_to_end(id(value))
+
+        key = (id(ports), port)
+        entry.holders[key] = ports
+        self._holders[key] = id(value)
+        self._spill()
+
+    def discard(self, ports: _TrackedPorts, port: Port):
+        key = (id(ports), port)
+        value_id = self._holders.pop(key, None)
+        if value_id is None:
+            return
+
+        entry = self._entries[value_id]
+        del entry.holders[key]
+        if not entry.holders:
+            del self._entries[value_id]
+            self.memory_used -= entry.size
+
+    def touch(self, ports: _TrackedPorts, port: Port):
+        value_id = self._holders.get((id(ports), port))
+        if value_id is not None:
+            self._entries.move_to_end(value_id)
+
+    def _spill(self):
+        while self.memory_used > self.memory_budget and self._entries:
+            _, entry = self._entries.popitem(last=False)
+            self.memory_used -= entry.size
+
+            handle = self._dump(entry.value)
+            for key, ports in entry.holders.items():
+                del self._holders[key]
+                ports.data[key[1]] = handle
+
+    def _dump(self, value) -> SpilledValue:
+        entry = self._handles.get(id(value))
+        if entry is not None and entry[0]() is value:
+            return entry[1]
+
+        serializer = select_serializer(self.serializers, value)
+        fd, path = tempfile.mkstemp(suffix=serializer.suffix, dir=self._get_directory())
+        os.close(fd)
+        serializer.dump(value, path)
+        handle = SpilledValue(path, serializer, directory=self._temp_dir)
+
+        try:
+            key = id(value)
+            self._handles[key] = (weakref.ref(value, lambda _: self._handles.pop(key, None)), handle)
+        except TypeError:
+            pass  # Not weak-referenceable (e.g. bytes), so not shared
+
+        return handle
+
+    def _get_directory(self) -> str:
+        if self.directory is not None:
+            return self.directory
+
+        # Removed (with all the files) when the state and all the handles in it are garbage-collected
+        if self._temp_dir is None:
+            self._temp_dir = tempfile.TemporaryDirectory(prefix='blox-spill-')
+        return self._temp_dir.name
+
+
+class _TrackedPorts(MutableMapping):
+    """ The storage of SpillingPortsDict. Reports writes, reads and deletions to the spiller """
+
+    __slots__ = ('data', '_spiller')
+
+    def __init__(self, spiller: _Spiller):
+        self.data = dict()
+        self._spiller = spiller
+
+    def __getitem__(self, port):
+        value = self.data[port]
+        self._spiller.touch(self, port)
+        return value
+
+    def __setitem__(self, port, value):
+        self._spiller.discard(self, port)
+        self.data[port] = value
+
+        # Lazy values take no memory until resolved
+        if not isinstance(value, (LazyValue, Future)):
+            self._spiller.add(self, port, value)
+
+    def __delitem__(self, port):
+        del self.data[port]
+        self._spiller.discard(self, port)
+
+    def __contains__(self, port):
+        return port in self.data
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+
+class SpillingPortsDict(PortsDict):
+    """ Spilled values are read back on access but are not put back into memory """
+
+    def __init__(self, spiller: _Spiller):
+        super(SpillingPortsDict, self).__init__()
+        self.data = _TrackedPorts(spiller)
+
+    def __getitem__(self, port: Port):
+        value = self.data[port]
+        if isinstance(value, SpilledValue):
+            return value.resolve()
+        return super(SpillingPortsDict, self).__getitem__(port)
+
+
+def _spilling_block_state(spiller: _Spiller) -> BlockState:
+    block_state = BlockState()
+    block_state._ports = SpillingPortsDict(spiller)
+    return block_state
+
+
+class SpillingState(State):
+    """
+    A state that keeps its port values within a memory budget.
+
+    When the budget is exceeded the least recently used values are written to files and replaced
+    by SpilledValue handles, which travel through the graph like lazy values and are read back when
+    a block reads them. Values read back are not kept in memory, so a value read once is never
+    loaded again.
+
+    Parameters
+    ----------
+    memory_budget
+        The memory (in bytes) port values may take before spilling.
+
+    directory
+        Where the files are written (by default a temporary directory removed with the state).
+
+    serializers
+        Tried in order for each spilled value (see blox.core.serializers). By default NumPy arrays are
+        stored as .npy files and loaded memory-mapped, torch tensors with torch.save and anything
+        else is pickled.
+
+    min_size
+        Values smaller than this (in bytes) are neither counted nor spilled.
+    """
+
+    def __init__(self, memory_budget: int,
+                 directory: tp.Optional[str] = None,
+                 serializers: tp.Optional[tp.List[Serializer]] = None,
+                 min_size: int = 1 << 16,
+                 state_id: tp.Optional[str] = None):
+        super(SpillingState, self).__init__(state_id=state_id)
+
+        self._spiller = _Spiller(memory_budget=memory_budget,
+                                 directory=directory,
+                                 serializers=serializers if serializers is not None else default_serializers(),
+                                 min_size=min_size)
+        self._block_states = _BlockStates(factory=partial(_spilling_block_state, self._spiller))
+
+    @property
+    def memory_budget(self) -> int:
+        return self._spiller.memory_budget
+
+    @property
+    def memory_used(self) -> int:
+        """ The estimated memory taken by the port values that are not spilled (each value counted once) """
+        return self._spiller.memory_used
+
+    def fork(self, state_id: tp.Optional[str] = None) -> SpillingState:
+        """
+        Returns a spilling state (with the same budget and settings) holding the same port values, parameters
+        and meta. The values themselves are shared: spilled values refer to the same files, which are only
+        read and are kept until neither state holds them, and values in memory are referenced by both states and count towards both budgets. Unlike
+        State.fork, the tables of values are copied, in O(number of values).
+        """
+        spiller = self._spiller
+        child = SpillingState(memory_budget=spiller.memory_budget,
+                              directory=spiller.directory,
+                              serializers=spiller.serializers,
+                              min_size=spiller.min_size,
+                              state_id=state_id)
+        child.cache = self.cache
+        child.meta.update(self.meta)
+
+        for block, block_state in self._block_states.all_items():
+            child_block_state = child.block_state(block)
+            child_block_state.params.update(block_state.params)
+
+            # The stored values are copied as they are, without reading back spilled ones
+            ports = block_state.ports.data
+            for port in ports:
+                child_block_state.ports.data[port] = ports.data[port]
+
+        return child
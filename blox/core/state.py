@@ -2,13 +2,13 @@ from __future__ import annotations
 from abc import ABC, abstractmethod
 import typing as tp
 from collections import UserDict
-from scalpl import Cut
+from collections.abc import MutableMapping
 from collections import namedtuple, defaultdict
 from uuid import uuid4
-
-if tp.TYPE_CHECKING:
-    from blox.core.port import Port
-    from blox.core.block import Block
+from concurrent.futures import Future
+from blox.core.port import Port
+from blox.core.block import Block
+from blox.core.filters import block_filter
 
 # ExportResult = namedtuple('ExportResult', field_names=['ports', 'meta', 'params'])
 #
@@ -143,11 +143,153 @@ class _NoDefaultClass:
 _NoDefault = _NoDefaultClass()
 
 
+class LazyValue:
+    """ A port value that is computed on first read. The result is cached (and shared by all ports holding it) """
+
+    __slots__ = ('_fn', '_args', '_kwargs', '_value')
+
+    def __init__(self, fn: tp.Callable, *args, **kwargs):
+        self._fn = fn
+        self._args = args
+        self._kwargs = kwargs
+        self._value = _NoDefault
+
+    @property
+    def resolved(self) -> bool:
+        return self._value is not _NoDefault
+
+    def resolve(self):
+        if self._value is _NoDefault:
+            self._value = self._fn(*self._args, **self._kwargs)
+
+            # Release the references held by the thunk
+            self._fn = self._args = self._kwargs = None
+
+        return self._value
+
+    def __repr__(self):
+        if self.resolved:
+            return f'{self.__class__.__name__}({self._value!r})'
+        return f'{self.__class__.__name__}(<pending>)'
+
+
+def resolve(value):
+    """ Returns the actual value of lazy values (LazyValue or Future) and the value itself otherwise """
+    if isinstance(value, LazyValue):
+        return value.resolve()
+    elif isinstance(value, Future):
+        return value.result()
+    return value
+
+
+# Marks keys deleted from a LayeredDict that still exist in its base
+_DELETED = object()
+
+# Chains of forks are flattened once they reach this many layers, which bounds the cost of lookups
+# (at an amortized cost of copying 1 / _MAX_DEPTH of the contents per fork)
+_MAX_DEPTH = 16
+
+
+class LayeredDict(MutableMapping):
+    """
+    A dictionary on top of a read-only base mapping. Lookups fall through to the base and writes
+    and deletions are recorded in the layer only, so the base is shared, not copied.
+    """
+
+    __slots__ = ('_base', '_layer', '_depth')
+
+    def __init__(self, base: tp.Mapping):
+        self._base = base
+        self._layer = dict()
+        self._depth = base.depth + 1 if isinstance(base, LayeredDict) else 1
+
+    @property
+    def depth(self) -> int:
+        """ The number of layers down to the first plain mapping """
+        return self._depth
+
+    @property
+    def changed(self) -> bool:
+        """ Whether the layer differs from the base """
+        return bool(self._layer)
+
+    def __getitem__(self, key):
+        try:
+            value = self._layer[key]
+        except KeyError:
+            return self._base[key]
+
+        if value is _DELETED:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._layer[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+
+        if key in self._base:
+            self._layer[key] = _DELETED
+        else:
+            del self._layer[key]
+
+    def __contains__(self, key):
+        if key in self._layer:
+            return self._layer[key] is not _DELETED
+        return key in self._base
+
+    def __iter__(self):
+        # Keys keep the base order
+        for key in self._base:
+            if self._layer.get(key) is not _DELETED:
+                yield key
+
+        for key, value in self._layer.items():
+            if value is not _DELETED and key not in self._base:
+                yield key
+
+    def __len__(self):
+        length = len(self._base)
+        for key, value in self._layer.items():
+            if key not in self._base:
+                length += 1
+            elif value is _DELETED:
+                length -= 1
+        return length
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({dict(self)!r})'
+
+
+def _fork_data(data: tp.MutableMapping) -> tp.MutableMapping:
+    """
+    Returns a new layer on top of data. Unchanged layers are not stacked on top of each other,
+    and long chains of layers are flattened.
+    """
+    if isinstance(data, LayeredDict):
+        if not data.changed:
+            return LayeredDict(data._base)
+        if data.depth >= _MAX_DEPTH:
+            return LayeredDict(dict(data))
+    return LayeredDict(data)
+
+
 class PortsDict(UserDict):
+    """ Maps ports to their values. Lazy values are resolved (and replaced by the result) on read """
 
-    def __setitem__(self, port: Port, value: tp.Any):
-        from blox.core.port import Port
+    def __getitem__(self, port: Port):
+        value = self.data[port]
+        if isinstance(value, (LazyValue, Future)):
+            value = self.data[port] = resolve(value)
+        return value
 
+    def peek(self, port: Port):
+        """ Returns the stored value without resolving it """
+        return self.data[port]
+
+    def __setitem__(self, port: Port, value: tp.Any):
         if not isinstance(port, Port):
             raise TypeError(f'port must be of type {Port.__name__}')
         super(PortsDict, self).__setitem__(port, value)
@@ -187,19 +329,113 @@ class BlockState:
     def ports(self):
         return self._ports
 
+    @property
+    def changed(self) -> bool:
+        """ Whether a forked block state differs from the one it was forked from (or a new one is not empty) """
+        return any(data.changed if isinstance(data, LayeredDict) else bool(data)
+                   for data in (self._params.data, self._ports.data))
+
+    def fork(self) -> BlockState:
+        """ Returns a block state sharing the values of self. Self must not be modified afterwards """
+        block_state = BlockState()
+        block_state._params.data = _fork_data(self._params.data)
+        block_state._ports.data = _fork_data(self._ports.data)
+        return block_state
+
+
+class _BlockStates(dict):
+    """
+    Maps blocks to their states. Block states found in the base are forked on first access,
+    others are created by the factory.
+    """
+
+    __slots__ = ('_base', '_factory', '_depth')
+
+    def __init__(self, base: tp.Optional[_BlockStates] = None,
+                 factory: tp.Callable[[], BlockState] = BlockState):
+        super(_BlockStates, self).__init__()
+        self._base = base
+        self._factory = factory
+        self._depth = base._depth + 1 if base is not None else 0
+
+    def __missing__(self, block: Block) -> BlockState:
+        base_state = self._base.lookup(block) if self._base is not None else None
+        block_state = self[block] = self._factory() if base_state is None else base_state.fork()
+        return block_state
+
+    def lookup(self, block: Block) -> tp.Optional[BlockState]:
+        """ Returns the block state without forking or creating it """
+        block_state = self.get(block)
+        if block_state is None and self._base is not None:
+            return self._base.lookup(block)
+        return block_state
+
+    def all_items(self) -> tp.Iterator[tp.Tuple[Block, BlockState]]:
+        """ Yields the block states of self and of the base (except those overridden by self) """
+        yield from self.items()
+        if self._base is not None:
+            for block, block_state in self._base.all_items():
+                if block not in self:
+                    yield block, block_state
+
+    @property
+    def changed(self) -> bool:
+        return any(block_state.changed for block_state in self.values())
+
+    def frozen(self) -> _BlockStates:
+        """
+        Returns the block states to be shared by forks: self, or, for long chains of forks, a single layer
+        holding all the block states (which are shared, not copied)
+        """
+        if self._depth < _MAX_DEPTH:
+            return self
+
+        flat = _BlockStates(factory=self._factory)
+        flat.update(self.all_items())
+        return flat
+
+    def fork(self) -> _BlockStates:
+        # Avoid stacking unchanged layers, so that forking the same state repeatedly stays cheap
+        if self._base is not None and not self.changed:
+            return _BlockStates(self._base, self._factory)
+        return _BlockStates(self, self._factory)
+
 
 class State:
     """ This class represents the computation state of the entire system. """
 
     def __init__(self, state_id: tp.Optional[str]=None):
-        self._block_states: tp.Dict[Block, BlockState] = defaultdict(BlockState)
+        self._block_states = _BlockStates()
         self._meta = MetaDict(state_id=state_id)
 
+        # An optional ResultCache (see blox.core.cache) used by cacheable blocks
+        self.cache = None
+
+    def fork(self, state_id: tp.Optional[str] = None) -> State:
+        """
+        Returns a child state sharing the values of self copy-on-write. It costs O(1) and later changes to
+        either of the states are not seen by the other.
+
+        Block states obtained from self (e.g. by state[block]) before forking must not be modified afterwards.
+        Lookups go through one layer per fork with changes, up to _MAX_DEPTH layers, after which the layers
+        are flattened.
+        """
+        base = self._block_states.frozen()
+        self._block_states = base.fork()
+
+        child = State(state_id=state_id)
+        child._block_states = base.fork()
+        child.cache = self.cache
+
+        # The meta dictionary object itself is kept so that references to it stay valid
+        meta_base = self._meta.data
+        self._meta.data = _fork_data(meta_base)
+        child._meta.data = _fork_data(meta_base)
+
+        return child
+
     def __getitem__(self, item: tp.Union[str, Port, Block]):
         """ Gets a value depending on the type """
-        from blox.core.port import Port
-        from blox.core.block import Block
-
         # For block it returns the block state
         if isinstance(item, Block):
             return self._block_states[item]
@@ -215,8 +451,6 @@ class State:
             return self._meta[item]
 
     def __setitem__(self, item: tp.Union[str, Port], value):
-        from blox.core.port import Port
-
         # When a port is given set its value
         if isinstance(item, Port):
             self._block_states[item.block].ports[item] = value
@@ -225,11 +459,9 @@ class State:
         else:
             if not isinstance(item, str):
                 raise TypeError('Meta parameter names must be strings')
-            return self._meta[item]
+            self._meta[item] = value
 
     def __contains__(self, item: tp.Union[str, Port]):
-        from blox.core.port import Port
-
         if isinstance(item, Port):
             return item in self._block_states[item.block].ports
 
@@ -237,16 +469,39 @@ class State:
             return item in self._meta
 
     def __delitem__(self, item: tp.Union[str, Port]):
-        from blox.core.port import Port
-
         if isinstance(item, Port):
             del self._block_states[item.block].ports[item]
         else:
             del self._meta[item]
 
-    def __call__(self, port_or_ports: tp.Union[Port, tp.Iterable[Port]]):
-        from blox.core.port import Port
+    # Typed accessors. Unlike the polymorphic methods above these don't dispatch on the key's type
+    # and are used by the compute engine
+
+    def block_state(self, block: Block) -> BlockState:
+        return self._block_states[block]
+
+    def get_port(self, port: Port):
+        return self._block_states[port.block].ports[port]
+
+    def set_port(self, port: Port, value):
+        self._block_states[port.block].ports.data[port] = value
+
+    def has_port(self, port: Port) -> bool:
+        # Doesn't create (or fork) a state for the port's block
+        block_state = self._block_states.lookup(port.block)
+        return block_state is not None and port in block_state.ports.data
 
+    def del_port(self, port: Port):
+        del self._block_states[port.block].ports.data[port]
+
+    def peek(self, port: Port):
+        """ Returns the value stored for the port without resolving lazy values """
+        block_state = self._block_states.lookup(port.block)
+        if block_state is None:
+            raise KeyError(port)
+        return block_state.ports.data[port]
+
+    def __call__(self, port_or_ports: tp.Union[Port, tp.Iterable[Port]]):
         # The case when a single port is given
         if isinstance(port_or_ports, Port):
             port = port_or_ports
@@ -269,9 +524,6 @@ class State:
         return self._meta
 
     def to_xpath_state(self, root_block: Block) -> XPathState:
-        from blox.core.block import Block
-        from blox.core.filters import block_filter
-
         if not isinstance(root_block, Block):
             raise TypeError(f'root_block must be of type {Block.__name__}')
 
@@ -305,7 +557,7 @@ class State:
 
     # A generator of all ports contained in the state
     def ports(self):
-        for block_state in self._block_states.values():
+        for _, block_state in self._block_states.all_items():
             for port in block_state.ports.keys():
                 yield port
 
@@ -322,40 +574,53 @@ class XPathState(UserDict):
     def state_id(self):
         return self._state_id
 
-    def to_state(self, root_block: Block) -> State:
-        from blox.core.port import Port
+    def resolve(self, key: str, root_block: Block) -> tp.Tuple[tp.Optional[Block], tp.Union[Port, str]]:
+        """
+        Resolves an xpath key relative to root_block.
 
-        state = State(state_id=self.state_id)
+        Returns a pair (block, leaf) where leaf is either a port or a parameter name of the block.
+        For global parameters block is None and leaf is the parameter name.
+        """
 
-        for key, value in self.items():
+        path = key.split(root_block.separator)
 
-            path = key.split(root_block.separator)
+        # Handle global parameters
+        if path[0] == self.meta_prefix:
+            return None, root_block.separator.join(path[1:])
 
-            # Handle global parameters
-            if path[0] == self.meta_prefix:
-                state.meta[root_block.separator.join(path[1:])] = value
+        # Handle everything else (ports and block parameters)
+        path, leaf_element = path[:-1], path[-1]
 
-            # Handle everything else (ports and block parameters)
-            else:
-                path, leaf_element = path[:-1], path[-1]
+        # Get the deepest block and the associated leaf
+        block = root_block
+        for element in path:
+            block = block.blocks[element]
 
-                # Get the deepest block and the associated leaf
-                block = root_block
-                for element in path:
-                    block = block.blocks[element]
+        # Check whether the leaf element is a port:
+        if leaf_element in block:
+            port = block[leaf_element]
+            if not isinstance(port, Port):
+                raise TypeError(f'{leaf_element} must be an instance of {Port.__name__}')
+            return block, port
 
-                # Check whether the leaf element is a port:
-                if leaf_element in block:
-                    port = block[leaf_element]
-                    if not isinstance(port, Port):
-                        raise TypeError(f'{leaf_element} must be an instance of {Port.__name__}')
+        # If it is not a port then it must be a parameter
+        return block, leaf_element
 
-                    # Set the port value in the state
-                    state[port] = value
+    def to_state(self, root_block: Block) -> State:
+        state = State(state_id=self.state_id)
 
-                # If it is not a port then it must be a parameter
-                else:
-                    state[block].params[leaf_element] = value
+        for key, value in self.items():
+            block, leaf = self.resolve(key, root_block)
 
-        return state
+            # Handle global parameters
+            if block is None:
+                state.meta[leaf] = value
 
+            # Set the port value in the state
+            elif isinstance(leaf, Port):
+                state[leaf] = value
+
+            else:
+                state[block].params[leaf] = value
+
+        return state
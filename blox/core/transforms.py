@@ -1,12 +1,13 @@
 from itertools import chain
 from blox.etc.errors import BlockCompositionError
-from more_itertools import prepend
 from blox.etc.utils import remove_trailing_digits
 
 
 class BlockTransformsMixin:
     """ Adds structural transformations to the Block class """
 
+    __slots__ = ()
+
     def __call__(self, *args, **kwargs):
         """
         This method allows composing blocks over ports.
@@ -24,8 +25,8 @@ class BlockTransformsMixin:
         # It is either the downstream block of one of the input ports
         try:
             parent = next(iter(filter(lambda x: x is not None,
-                                      prepend(self.parent,
-                                              map(lambda x: x.downstream_block, chain(args, kwargs.values()))))))
+                                      chain([self.parent],
+                                            map(lambda x: x.downstream_block, chain(args, kwargs.values()))))))
         except StopIteration:
             raise BlockCompositionError('Could not figure out the parent block')
 
@@ -1,12 +1,12 @@
 from __future__ import annotations
 import logging
-from blox.etc.utils import get_dynamic_attribute
 
 
 class LoggerMixin:
 
+    __slots__ = ()
+
     @property
     def logger(self) -> logging.Logger:
-        return get_dynamic_attribute(self, '_logger',
-                                     default=logging.getLogger(f'{self.__class__.__module__}.'
-                                                               f'{self.__class__.__name__}'))
+        # Loggers are cached by the logging module, so nothing is stored on the instance
+        return logging.getLogger(f'{self.__class__.__module__}.{self.__class__.__name__}')
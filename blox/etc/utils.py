@@ -1,7 +1,5 @@
 import re
 from collections import UserDict
-from events import Events
-import re
 import typing as tp
 
 
@@ -10,13 +8,6 @@ RE_PORT_RANGE_LETTERS = re.compile('(?P<start>[a-zA-Z])-(?P<end>[a-zA-Z])')
 RE_PORT_RANGE_INDICES = re.compile('(?P<prefix>[a-zA-Z]+)(?P<start>[0-9]+)-(?P<end>[0-9]+)')
 
 
-def get_dynamic_attribute(obj, name: str, default=None):
-    """ Returns the property with the given name. Sets it if doesn't exist """
-    if not hasattr(obj, name):
-        setattr(obj, name, default)
-    return getattr(obj, name)
-
-
 def set_dynamic_attribute(obj, name, value):
     setattr(obj, name, value)
 
@@ -104,6 +104,10 @@ class BlockBase(NamedNodeMixin, BlockPickleMixin, BlockTransformsMixin, BlockSum
             The parent block. If left none the block is created 'floating'
         """
 
+        # Changes whenever the port graph of this block or of any block below it changes (see graph_version).
+        # Set before the ports, whose creation may already change the port graph
+        self._graph_version = 0
+
         # This handles all that has to do with ports. See BlockPortsHub docs.
         from blox_old.block.base.block_ports_hub import PortsHub
         self._ports = PortsHub(block=self)
@@ -116,6 +120,9 @@ class BlockBase(NamedNodeMixin, BlockPickleMixin, BlockTransformsMixin, BlockSum
         from blox_old.block.base.port_graph import PortGraph
         self._port_graph = PortGraph(block=self)
 
+        # Changes whenever blocks are attached or detached anywhere below this block (see subtree_version)
+        self._subtree_version = 0
+
         # This is a mechanism to handle naming collision in the parent.
         # The provided name serves as a base to which a counter (called name modifier) is appended
         # In case of a name collision.
@@ -220,6 +227,7 @@ class BlockBase(NamedNodeMixin, BlockPickleMixin, BlockTransformsMixin, BlockSum
 
     def _post_detach(self, parent: BlockBase):
         parent.post_detach_child_check(self)
+        parent.subtree_changed__()
 
         self._name_modifier = 0  # When blocks are in the root level, they regain their original name
 
@@ -260,6 +268,30 @@ class BlockBase(NamedNodeMixin, BlockPickleMixin, BlockTransformsMixin, BlockSum
 
         # Let the parent's port graph know that there is another block around
         parent.port_graph__.set_changed()
+        parent.subtree_changed__()
+
+    @property
+    def subtree_version(self) -> int:
+        """ A counter that changes whenever blocks are attached to or detached from the subtree of the block.
+        Allows caching information about the subtree (e.g. the torch parameters it contains) """
+        return self._subtree_version
+
+    def subtree_changed__(self):
+        for block in self.iter_path_reverse():
+            if isinstance(block, BlockBase):
+                block._subtree_version += 1
+
+    @property
+    def graph_version(self) -> int:
+        """ A counter that changes whenever ports are connected or disconnected, or blocks are attached or
+        detached, anywhere in the subtree of the block. Allows caching information about the connections
+        (e.g. the torch modules upstream of a port) on the root """
+        return self._graph_version
+
+    def graph_changed__(self):
+        for block in self.iter_path_reverse():
+            if isinstance(block, BlockBase):
+                block._graph_version += 1
 
     # Hooks to be called from the parent block
     def pre_attach_child_check(self, child: BlockBase):
@@ -27,6 +27,7 @@ class PortGraph:
 
     def set_changed(self):
         self._changed = True
+        self.block.graph_changed__()
         self.block.on_port_graph_change()
 
     def add_edge(self, *args, **kwargs):
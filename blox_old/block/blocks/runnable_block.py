@@ -180,13 +180,16 @@ class FunctionExecutorType(Enum):
 class Function(Block):
     """ Upon output pulling, first get the inputs and then use the propagate method """
 
-    def __init__(self, *args, executor=None, **kwargs):
+    def __init__(self, *args, executor=None, checkpoint=False, **kwargs):
         super(Function, self).__init__(*args, **kwargs)
 
         # Where the propagate method will run upon pull
         self.__executor = None
         self.executor = executor
 
+        # Whether the inner activations are recomputed during backward instead of being kept (see btorch.compile)
+        self.__checkpoint = bool(checkpoint)
+
     @property
     def executor(self):
         return maybe_bind(self.__executor, lambda x: x.name)
@@ -195,6 +198,14 @@ class Function(Block):
     def executor(self, value):
         self.__executor = maybe_bind(value, lambda x: FunctionExecutorType[x.upper()])
 
+    @property
+    def checkpoint(self) -> bool:
+        return self.__checkpoint
+
+    @checkpoint.setter
+    def checkpoint(self, value: bool):
+        self.__checkpoint = bool(value)
+
     # async def pull(self, port: Port, session: Session) -> T.Any:
     #
     #     if port not in self:
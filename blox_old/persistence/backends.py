@@ -1,4 +1,9 @@
 from .base import PersisterBackend, PersisterError
+from collections import OrderedDict
+import typing as tp
+import threading
+import sqlite3
+import pickle
 import shelve
 
 
@@ -30,3 +35,255 @@ class Shelve(PersisterBackend):
     def __getitem__(self, item):
         self.__check_init()
         return self._shelve_instance[item]
+
+    def flush(self):
+        self.__check_init()
+        self._shelve_instance.sync()
+
+
+class Sqlite(PersisterBackend):
+    """
+    Stores pickled values in an SQLite database in WAL mode. Bulk reads and writes take a single
+    transaction, which is much faster than shelve for many small values (e.g. the tensors of a model).
+    """
+
+    # SQLite limits the number of variables in a statement
+    _CHUNK_SIZE = 500
+
+    def __init__(self, filepath, protocol=pickle.HIGHEST_PROTOCOL):
+        self.filepath = filepath
+        self.protocol = protocol
+        self._connection = None
+
+        # The connection may be used by other threads (see WriteBehind)
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self._connection = sqlite3.connect(self.filepath, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value BLOB NOT NULL)')
+        self._connection.commit()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._connection.close()
+        self._connection = None
+
+    def __check_init(self):
+        if self._connection is None:
+            raise PersisterError("Sqlite connection must be opened first")
+
+    def __contains__(self, item):
+        self.__check_init()
+        with self._lock:
+            return self._connection.execute('SELECT 1 FROM kv WHERE key = ?', (item, )).fetchone() is not None
+
+    def __getitem__(self, item):
+        self.__check_init()
+        with self._lock:
+            row = self._connection.execute('SELECT value FROM kv WHERE key = ?', (item, )).fetchone()
+        if row is None:
+            raise KeyError(item)
+        return pickle.loads(row[0])
+
+    def __setitem__(self, key, value):
+        self.set_many([(key, value)])
+
+    def get_many(self, keys):
+        self.__check_init()
+        keys = list(keys)
+        result = dict()
+
+        with self._lock:
+            for start in range(0, len(keys), self._CHUNK_SIZE):
+                chunk = keys[start: start + self._CHUNK_SIZE]
+                rows = self._connection.execute(f'SELECT key, value FROM kv WHERE key IN '
+                                                f'({", ".join("?" * len(chunk))})', chunk)
+                result.update(rows)
+
+        # Keep the order of the keys
+        return {key: pickle.loads(result[key]) for key in keys if key in result}
+
+    def set_many(self, items):
+        self.__check_init()
+        items = items.items() if isinstance(items, tp.Mapping) else items
+
+        # Values are pickled before taking the lock
+        rows = [(key, pickle.dumps(value, protocol=self.protocol)) for key, value in items]
+
+        with self._lock, self._connection:
+            self._connection.executemany('INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)', rows)
+
+
+class WriteBehind(PersisterBackend):
+    """
+    Buffers the writes to another backend and flushes them in batches (using set_many) on a background
+    thread. Reads see the buffered values. Values must not be modified after they are written.
+
+    The wrapped backend is only accessed under a lock, so it needn't be thread-safe. Values whose write
+    failed stay buffered (and are retried with the next batch); the error is raised by the next flush
+    (or on exit).
+
+    Parameters
+    ----------
+    backend
+        The backend written to.
+
+    max_pending
+        The number of buffered values after which the writer stops waiting for the interval to end.
+
+    interval
+        The maximal time (in seconds) between the flushes.
+    """
+
+    def __init__(self, backend: PersisterBackend, max_pending=256, interval=1.):
+        self.backend = backend
+        self.max_pending = max_pending
+        self.interval = interval
+
+        self._pending = OrderedDict()
+
+        # Values taken by the writer that were not written yet. They are still visible to readers
+        self._writing = dict()
+
+        self._condition = threading.Condition()
+
+        # Serializes all access to the wrapped backend (the writer thread and the readers)
+        self._backend_lock = threading.RLock()
+
+        self._thread = None
+        self._closing = False
+        self._flushing = 0
+        self._error = None
+
+    def __enter__(self):
+        self.backend.__enter__()
+        self._closing = False
+        self._thread = threading.Thread(target=self._run, name=f'{self.__class__.__name__}-writer', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            with self._condition:
+                self._closing = True
+                self._condition.notify_all()
+            self._thread.join()
+            self._thread = None
+            self.__raise_error()
+        finally:
+            self.backend.__exit__(exc_type, exc_val, exc_tb)
+
+    def __check_init(self):
+        if self._thread is None:
+            raise PersisterError("WriteBehind backend must be opened first")
+
+    def __raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise PersisterError("Writing to the backend failed") from error
+
+    def _run(self):
+        while True:
+            with self._condition:
+                # After a failure the writes are retried once per interval (or when flushed)
+                self._condition.wait_for(lambda: self._closing or self._flushing or
+                                         (self._error is None and len(self._pending) >= self.max_pending),
+                                         timeout=self.interval)
+                if not self._pending:
+                    if self._closing:
+                        return
+                    continue
+
+                self._writing, self._pending = self._pending, OrderedDict()
+
+            failed = False
+            try:
+                with self._backend_lock:
+                    self.backend.set_many(self._writing)
+            except BaseException as error:
+                # Reported on the next flush
+                self._error = error
+                failed = True
+            else:
+                # The values of a failed write were written after all
+                self._error = None
+
+            with self._condition:
+                if failed:
+                    # The values stay pending, unless overwritten in the meanwhile
+                    writing, self._pending = self._pending, OrderedDict(self._writing)
+                    for key, value in writing.items():
+                        self._pending.pop(key, None)
+                        self._pending[key] = value
+
+                self._writing = dict()
+                self._condition.notify_all()
+
+                if failed and self._closing:
+                    return
+
+    def __contains__(self, item):
+        self.__check_init()
+        with self._condition:
+            if item in self._pending or item in self._writing:
+                return True
+        with self._backend_lock:
+            return item in self.backend
+
+    def __getitem__(self, item):
+        self.__check_init()
+        with self._condition:
+            for buffer in (self._pending, self._writing):
+                if item in buffer:
+                    return buffer[item]
+        with self._backend_lock:
+            return self.backend[item]
+
+    def __setitem__(self, key, value):
+        self.set_many([(key, value)])
+
+    def get_many(self, keys):
+        self.__check_init()
+        keys = list(keys)
+        result = dict()
+
+        with self._condition:
+            for key in keys:
+                for buffer in (self._pending, self._writing):
+                    if key in buffer:
+                        result[key] = buffer[key]
+                        break
+
+        with self._backend_lock:
+            result.update(self.backend.get_many([key for key in keys if key not in result]))
+        return {key: result[key] for key in keys if key in result}
+
+    def set_many(self, items):
+        self.__check_init()
+        items = items.items() if isinstance(items, tp.Mapping) else items
+
+        with self._condition:
+            for key, value in items:
+                # Keep the order of writes
+                self._pending.pop(key, None)
+                self._pending[key] = value
+
+            if len(self._pending) >= self.max_pending:
+                self._condition.notify_all()
+
+    def flush(self):
+        """ Waits until all buffered values are written. Raises the error of a failed write (if any) """
+        self.__check_init()
+        with self._condition:
+            self._flushing += 1
+            self._condition.notify_all()
+            try:
+                self._condition.wait_for(lambda: not self._writing and
+                                         (not self._pending or self._error is not None))
+            finally:
+                self._flushing -= 1
+        self.__raise_error()
+        with self._backend_lock:
+            self.backend.flush()
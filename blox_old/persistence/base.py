@@ -32,6 +32,21 @@ class PersisterBackend(ABC):
     def __exit__(self, exc_type, exc_val, exc_tb):
         pass
 
+    # Bulk operations. Backends should override these when they can do better than one key at a time
+
+    def get_many(self, keys: tp.Iterable[str]) -> tp.Dict[str, tp.Any]:
+        """ Returns the values of the given keys. Missing keys are omitted from the result """
+        return {key: self[key] for key in keys if key in self}
+
+    def set_many(self, items: tp.Union[tp.Mapping[str, tp.Any], tp.Iterable[tp.Tuple[str, tp.Any]]]):
+        items = items.items() if isinstance(items, tp.Mapping) else items
+        for key, value in items:
+            self[key] = value
+
+    def flush(self):
+        """ Makes sure all writes so far reached the storage """
+        pass
+
 
 class Persister(ABC):
     """ The base class all persisters derive from """
@@ -0,0 +1,349 @@
+from __future__ import annotations
+from blox_old.core.block.base import Block, BlockError
+from blox_old.core.block.base.ports.port import Port
+from blox_old.core.block.blocks.runnable_block import Const, Src, NoDefault
+from blox_old.btorch.module import TorchModule, torch_modules
+from more_itertools import prepend
+from blox_old.utils import raise_if
+import torch
+from torch import nn
+import typing as T
+import operator
+import re
+
+
+class CompileError(BlockError):
+    pass
+
+
+def _as_port(obj: T.Union[Port, Block]) -> Port:
+    """ Blocks with a single output (e.g. Src) may be given instead of their output port """
+    if isinstance(obj, Block):
+        raise_if(len(obj.Out) != 1, CompileError(f"The block {obj} must have exactly one output"))
+        return obj.Out()
+    return obj
+
+
+def _is_checkpointed(block) -> bool:
+    return not block.atomic and getattr(block, 'checkpoint', False)
+
+
+def _source(port: Port, expand: T.Optional[Block] = None) -> Port:
+    """
+    Follows the upstream connections to the port that produces the value. The outputs of checkpointed
+    functions (other than expand) produce their values as a whole, so they are not followed into
+    """
+    while port.upstream() is not None:
+        if not port.is_in and port.block is not expand and _is_checkpointed(port.block):
+            break
+        port = port.upstream()
+    return port
+
+
+class _BlockCall(nn.Module):
+    """ Calls the function of an atomic block (that isn't a torch module) """
+
+    def __init__(self, block):
+        super(_BlockCall, self).__init__()
+        self.block_fn = block.fn
+
+    def forward(self, *args, **kwargs):
+        return self.block_fn(*args, **kwargs)
+
+
+class _ConstCall(nn.Module):
+    """ Returns the current value of a Const (or the default of a Src) """
+
+    def __init__(self, get_value):
+        super(_ConstCall, self).__init__()
+        self.get_value = get_value
+
+    def forward(self):
+        return self.get_value()
+
+
+class _Checkpoint(nn.Module):
+    """ Calls a compiled subgraph without keeping its inner activations (they are recomputed in backward) """
+
+    def __init__(self, graph: CompiledGraph):
+        super(_Checkpoint, self).__init__()
+        self.graph = graph
+
+    def forward(self, *inputs):
+        if not torch.is_grad_enabled():
+            return self.graph(*inputs)
+
+        from torch.utils.checkpoint import checkpoint
+        return checkpoint(self.graph, *inputs, use_reentrant=False)
+
+
+class _Step:
+    """ A call of a module: reads the argument slots and writes the output slots """
+
+    __slots__ = ('name', 'fn', 'args', 'kwargs', 'outs')
+
+    def __init__(self, name, fn, args, kwargs, outs):
+        self.name = name
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.outs = outs
+
+
+class CompiledGraph(nn.Module):
+    """
+    A blox subgraph flattened into a single torch module.
+
+    The atomic blocks between the inputs and the outputs are ordered once, and forward() calls them
+    directly, skipping the sessions and port pulls of the block machinery. The torch modules of the
+    TorchModule blocks are registered as submodules (the very same objects), so the parameters are
+    shared with the block tree: training either one trains the other.
+
+    Functions with checkpoint=True are compiled to nested graphs that run with torch.utils.checkpoint:
+    only their inputs are kept for backward, and their inner activations are recomputed.
+
+    Use trace() to obtain an FX graph module (or a TorchScript module) of the same computation.
+    """
+
+    def __init__(self, outputs: T.Union[Port, Block, T.Sequence[T.Union[Port, Block]]],
+                 inputs: T.Sequence[T.Union[Port, Block]] = (), _expand: T.Optional[Block] = None):
+        super(CompiledGraph, self).__init__()
+
+        # The checkpointed function that this graph computes (whose inner blocks are compiled)
+        self.__expand = _expand
+
+        self.__single_output = isinstance(outputs, (Port, Block))
+        outputs = [outputs] if self.__single_output else list(outputs)
+
+        # The torch modules of the blocks, and wrappers calling the other blocks
+        self.torch_modules = nn.ModuleDict()
+        self.calls = nn.ModuleDict()
+
+        self.__slots = dict()           # Source port -> slot index
+        self.__steps: T.List[_Step] = []
+
+        self.__input_slots = [self.__slot(self.__source(_as_port(port))) for port in inputs]
+        self.__build([self.__source(_as_port(port)) for port in outputs])
+        self.__output_slots = [self.__slots[self.__source(_as_port(port))] for port in outputs]
+
+    def __source(self, port: Port) -> Port:
+        return _source(port, expand=self.__expand)
+
+    def __slot(self, port: Port) -> int:
+        if port not in self.__slots:
+            self.__slots[port] = len(self.__slots)
+        return self.__slots[port]
+
+    def __add_step(self, block, module_dict: nn.ModuleDict, module: nn.Module, args=(), kwargs=None, outs=()):
+        name = re.sub(r'\W', '_', block.full_name)
+        while name in module_dict:
+            name += '_'
+        module_dict[name] = module
+
+        prefix = 'torch_modules' if module_dict is self.torch_modules else 'calls'
+        self.__steps.append(_Step(name=f'{prefix}.{name}', fn=module, args=list(args), kwargs=kwargs or {},
+                                  outs=outs))
+
+    def __build(self, outputs: T.List[Port]):
+        """ Orders the atomic blocks computing the outputs (a depth first post-order) """
+        done = set(self.__slots)
+        visiting = set()
+        stack = [(port, False) for port in reversed(outputs)]
+
+        while stack:
+            port, expanded = stack.pop()
+            if port in done:
+                continue
+
+            block = port.block
+
+            if expanded:
+                visiting.discard(block)
+                self.__add_block(block)
+                done.update(self.__source(p) for p in block.Out)
+                continue
+
+            raise_if(block in visiting, CompileError(f"The graph has a cycle through {block}"))
+            raise_if(port.is_in, CompileError(f"The port {port} is not connected to anything"))
+            raise_if(not block.atomic and not _is_checkpointed(block),
+                     CompileError(f"The port {port} of the non-atomic block {block} is not connected to anything"))
+
+            visiting.add(block)
+            stack.append((port, True))
+            stack.extend((self.__source(p), False) for p in reversed(list(block.In)))
+
+    def __add_block(self, block: Block):
+        outs = [self.__slot(port) for port in block.Out]
+
+        if _is_checkpointed(block):
+            outputs = block.Out() if len(block.Out) == 1 else list(block.Out)
+            graph = CompiledGraph(outputs=outputs, inputs=list(block.In), _expand=block)
+            args = [self.__slots[self.__source(port)] for port in block.In]
+            self.__add_step(block, self.calls, _Checkpoint(graph), args=args, outs=outs)
+            return
+
+        if isinstance(block, Const):
+            # Read on every call, so that Const.set() still applies
+            self.__add_step(block, self.calls, _ConstCall(lambda b=block: b.value), outs=outs)
+            return
+
+        if isinstance(block, Src):
+            raise_if(block.default is NoDefault(),
+                     CompileError(f"The source {block} has no default, so it must be given as an input"))
+            self.__add_step(block, self.calls, _ConstCall(lambda b=block: b.default), outs=outs)
+            return
+
+        raise_if(not hasattr(block, 'fn'), CompileError(f"The block {block} cannot be compiled "
+                                                        f"(only atomic functions are supported)"))
+
+        port_map = getattr(block, 'port_map', None) or {}
+        args = [self.__slots[self.__source(block.In[name])] for name in block.In.keys() if name not in port_map]
+        kwargs = {arg_name: self.__slots[self.__source(block.In[name])] for name, arg_name in port_map.items()}
+
+        # Torch modules are called directly (rather than through TorchModule.fn), so that hooks apply
+        if isinstance(block, TorchModule):
+            self.__add_step(block, self.torch_modules, block.module__, args=args, kwargs=kwargs, outs=outs)
+        else:
+            self.__add_step(block, self.calls, _BlockCall(block), args=args, kwargs=kwargs, outs=outs)
+
+    @property
+    def num_inputs(self) -> int:
+        return len(self.__input_slots)
+
+    def forward(self, *inputs):
+        raise_if(len(inputs) != len(self.__input_slots),
+                 CompileError(f"Expected {len(self.__input_slots)} inputs, got {len(inputs)}"))
+
+        values = [None] * len(self.__slots)
+        for slot, value in zip(self.__input_slots, inputs):
+            values[slot] = value
+
+        for step in self.__steps:
+            result = step.fn(*[values[slot] for slot in step.args],
+                             **{name: values[slot] for name, slot in step.kwargs.items()})
+
+            if len(step.outs) == 1:
+                values[step.outs[0]] = result
+            else:
+                raise_if(len(result) != len(step.outs),
+                         CompileError(f"Expected {len(step.outs)} outputs, got {len(result)}"))
+                for slot, value in zip(step.outs, result):
+                    values[slot] = value
+
+        outputs = tuple(values[slot] for slot in self.__output_slots)
+        return outputs[0] if self.__single_output else outputs
+
+    def to_fx(self):
+        """
+        Returns a torch.fx.GraphModule of the same computation, sharing the modules (and the parameters).
+        Every block is a call_module node, so graph passes (e.g. fusion) can work on the torch modules
+        """
+        import torch.fx
+
+        graph = torch.fx.Graph()
+        nodes = dict()
+        for n, slot in enumerate(self.__input_slots):
+            nodes[slot] = graph.placeholder(f'input_{n}')
+
+        for step in self.__steps:
+            node = graph.call_module(step.name,
+                                     args=tuple(nodes[slot] for slot in step.args),
+                                     kwargs={name: nodes[slot] for name, slot in step.kwargs.items()})
+            if len(step.outs) == 1:
+                nodes[step.outs[0]] = node
+            else:
+                for n, slot in enumerate(step.outs):
+                    nodes[slot] = graph.call_function(operator.getitem, (node, n))
+
+        outputs = [nodes[slot] for slot in self.__output_slots]
+        graph.output(outputs[0] if self.__single_output else tuple(outputs))
+
+        return torch.fx.GraphModule(self, graph)
+
+    def trace(self, mode='fx', example_inputs: T.Optional[T.Sequence] = None) -> nn.Module:
+        """
+        Returns a traced module of the same computation, sharing the parameters:
+            * 'fx': a torch.fx.GraphModule (see to_fx)
+            * 'script': a TorchScript module traced with the example inputs
+        """
+        if mode == 'fx':
+            return self.to_fx()
+
+        if mode == 'script':
+            import torch.jit
+            raise_if(example_inputs is None, CompileError("Tracing to TorchScript requires example inputs"))
+            return torch.jit.trace(self, tuple(example_inputs))
+
+        raise CompileError(f"Unknown trace mode {mode}")
+
+
+def compile_graph(outputs, inputs=(), trace=None, example_inputs=None) -> nn.Module:
+    """ Flattens the subgraph from the inputs to the outputs into a torch module (see CompiledGraph) """
+    compiled = CompiledGraph(outputs=outputs, inputs=inputs)
+    return compiled if trace is None else compiled.trace(mode=trace, example_inputs=example_inputs)
+
+
+def _nbytes(value) -> int:
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    if isinstance(value, (list, tuple)):
+        return sum(map(_nbytes, value))
+    if isinstance(value, T.Mapping):
+        return sum(map(_nbytes, value.values()))
+    return 0
+
+
+def activation_sizes(block: Block, inputs, example_inputs) -> T.Dict[TorchModule, int]:
+    """ Measures the size (in bytes) of the outputs of every TorchModule under the block on the example inputs """
+    modules = torch_modules(block)
+    sizes = dict()
+
+    def recorder(module_block):
+        def hook(module, args, output):
+            sizes[module_block] = sizes.get(module_block, 0) + _nbytes(output)
+        return hook
+
+    handles = [module.module__.register_forward_hook(recorder(module)) for module in modules]
+    try:
+        outputs = block.Out() if len(block.Out) == 1 else list(block.Out)
+        with torch.no_grad():
+            CompiledGraph(outputs=outputs, inputs=inputs)(*example_inputs)
+    finally:
+        for handle in handles:
+            handle.remove()
+
+    return sizes
+
+
+def choose_checkpoints(block: Block, memory_budget: int, inputs, example_inputs) -> T.List[Block]:
+    """
+    Sets checkpoint=True on functions under the block until the activations kept for backward are estimated
+    to fit in memory_budget (in bytes). Returns the checkpointed functions.
+
+    The activations are measured on the example inputs (see activation_sizes). Checkpointing a function
+    saves its inner activations except for the largest one, which is rebuilt during its recomputation.
+    Functions saving the most are chosen first, and nested functions are never both chosen.
+    """
+    sizes = activation_sizes(block, inputs, example_inputs)
+    total = sum(sizes.values())
+
+    candidates = []
+    for node in prepend(block, block.blocks.descendants):
+        if node is block or node.atomic or not hasattr(node, 'checkpoint'):
+            continue
+        inner = [size for module, size in sizes.items() if module is node or node in module.ancestors]
+        if len(inner) > 1:
+            candidates.append((sum(inner) - max(inner), node))
+
+    chosen = []
+    for saving, node in sorted(candidates, key=lambda candidate: candidate[0], reverse=True):
+        if total <= memory_budget:
+            break
+        if any(node in other.ancestors or other in node.ancestors for other in chosen):
+            continue
+
+        node.checkpoint = True
+        chosen.append(node)
+        total -= saving
+
+    return chosen
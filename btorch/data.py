@@ -1,8 +1,13 @@
+import torch
 import torch.utils.data as torch_util_data
 from blox_old.core.block.base import AtomicFunction
 from blox_old.core.block.blocks.generator import Generator
 import typing as T
+import threading
+import queue
+import time
 from blox_old.utils import maybe_or
+from blox_old.btorch.device import to_device
 
 
 class AtomicDataLoader(AtomicFunction):
@@ -63,3 +68,210 @@ class DataLoader(Generator):
                                          batch_sampler=batch_sampler,
                                          task_delay=task_delay,
                                          **kwargs)
+
+
+class _Slot:
+    """ A reusable set of host buffers holding one batch """
+
+    def __init__(self):
+        self.batch = None
+        self.event = None       # Set when the batch is copied asynchronously to a device
+
+
+class _Failure:
+    def __init__(self, exception):
+        self.exception = exception
+
+
+def _fill(buffer, batch, pin_memory):
+    """ Copies the batch into the buffer (of the same structure). Returns the buffer (reallocated on mismatch) """
+
+    if isinstance(batch, torch.Tensor):
+        if not isinstance(buffer, torch.Tensor) or buffer.shape != batch.shape or buffer.dtype != batch.dtype:
+            buffer = torch.empty(batch.shape, dtype=batch.dtype, pin_memory=pin_memory)
+        buffer.copy_(batch)
+        return buffer
+
+    if isinstance(batch, T.Mapping):
+        buffer = buffer if isinstance(buffer, T.Mapping) else {}
+        return type(batch)((key, _fill(buffer.get(key), value, pin_memory)) for key, value in batch.items())
+
+    if isinstance(batch, (list, tuple)):
+        buffer = buffer if isinstance(buffer, (list, tuple)) and len(buffer) == len(batch) else [None] * len(batch)
+        items = [_fill(b, value, pin_memory) for b, value in zip(buffer, batch)]
+        return items if isinstance(batch, list) else \
+            type(batch)(*items) if hasattr(batch, '_fields') else type(batch)(items)
+
+    # Anything else (e.g. strings) is passed as is
+    return batch
+
+
+class PrefetchDataLoader(AtomicFunction):
+    """
+    A data source block that keeps batches ready ahead of the consumer.
+
+    The batches are produced by a torch DataLoader (with num_workers worker processes) and are copied
+    by a background thread into a fixed pool of host buffers, which are allocated once and reused
+    (pinned with pin_memory, so that copies to the GPU can be asynchronous). Up to `prefetch` batches
+    are kept ready.
+
+    With reuse_buffers a batch returned by the block is valid only until the next batch is requested,
+    since its buffers are then refilled. With device the batches are copied (asynchronously when pinned)
+    to the given device, so the outputs are not affected. This holds for device='cpu' as well, where
+    the batches are copied out of the (host) buffers.
+
+    Errors of the data loader (including an epoch without batches) stop the prefetching and are raised
+    by fn(), and by every later call.
+
+    The metrics() method reports the number of ready batches and the time spent waiting for them.
+    """
+
+    def __init__(self,
+                 dataset,
+                 batch_size=1,
+                 shuffle=False,
+                 sampler=None,
+                 num_workers=0,
+                 collate_fn=None,
+                 pin_memory=False,
+                 drop_last=False, worker_init_fn=None,
+                 prefetch=2, reuse_buffers=True, device=None,
+                 name=None, Out=None):
+        super(PrefetchDataLoader, self).__init__(name=name, In=(), Out=Out)
+
+        # The host buffers are pinned here rather than by the DataLoader, which would copy every batch again
+        loader_kwargs = dict(persistent_workers=True, prefetch_factor=prefetch) if num_workers > 0 else {}
+        self.__data_loader = torch_util_data.DataLoader(dataset=dataset, batch_size=batch_size,
+                                                        shuffle=shuffle, sampler=sampler,
+                                                        num_workers=num_workers, collate_fn=collate_fn,
+                                                        pin_memory=False,
+                                                        drop_last=drop_last, worker_init_fn=worker_init_fn,
+                                                        **loader_kwargs)
+
+        self.lock_ports = True
+
+        self.prefetch = max(int(prefetch), 1)
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.reuse_buffers = reuse_buffers
+        self.device = None if device is None else torch.device(device)
+
+        # Slots cycle between the producer thread (free -> ready) and the consumer (ready -> current -> free).
+        # Besides the (at most prefetch) ready ones, one slot is being filled and one is held by the consumer
+        self.__free = queue.Queue()
+        self.__ready = queue.Queue(maxsize=self.prefetch)
+        for _ in range(self.prefetch + 2):
+            self.__free.put(_Slot())
+
+        self.__current = None
+
+        # The producer stops on the first error, which is then raised by every call
+        self.__failure = None
+        self.__stop = threading.Event()
+        self.__thread = None
+
+        self.__batches = 0
+        self.__stall_time = 0.
+        self.__last_stall_time = 0.
+
+    def __start(self):
+        self.__thread = threading.Thread(target=self.__produce, name=f'{self.__class__.__name__}-{self.name}',
+                                         daemon=True)
+        self.__thread.start()
+
+    def __produce(self):
+        try:
+            while not self.__stop.is_set():
+                empty = True
+                for batch in self.__data_loader:
+                    empty = False
+                    slot = self.__free.get()
+                    if slot is None or self.__stop.is_set():
+                        return
+
+                    if self.reuse_buffers or self.pin_memory:
+                        buffer = slot.batch if self.reuse_buffers else None
+                        slot.batch = _fill(buffer, batch, self.pin_memory)
+                    else:
+                        slot.batch = batch
+
+                    self.__ready.put(slot)
+
+                if empty:
+                    raise ValueError(f"The data loader of {self.name} produced no batches")
+
+        except Exception as e:
+            self.__ready.put(_Failure(e))
+
+    def __release(self, slot):
+        if slot.event is not None:
+            # The asynchronous copy must be done before the buffers are refilled
+            slot.event.synchronize()
+            slot.event = None
+        if not self.reuse_buffers:
+            slot.batch = None
+        self.__free.put(slot)
+
+    def fn(self):
+        if self.__failure is not None:
+            raise self.__failure.exception
+
+        if self.__thread is None:
+            self.__start()
+
+        # The previous batch is no longer used
+        if self.__current is not None:
+            self.__release(self.__current)
+            self.__current = None
+
+        start = time.perf_counter()
+        slot = self.__ready.get()
+        self.__last_stall_time = time.perf_counter() - start
+        self.__stall_time += self.__last_stall_time
+
+        if isinstance(slot, _Failure):
+            self.__failure = slot
+            raise slot.exception
+
+        self.__batches += 1
+        self.__current = slot
+
+        if self.device is None:
+            return slot.batch
+
+        # The buffers are on the host, where moving the batch would return the buffers themselves
+        batch = to_device(slot.batch, self.device, non_blocking=True,
+                          copy=self.reuse_buffers and self.device.type == 'cpu')
+        if self.device.type == 'cuda':
+            slot.event = torch.cuda.Event()
+            slot.event.record()
+        return batch
+
+    @property
+    def queue_depth(self) -> int:
+        """ The number of batches that are ready """
+        return self.__ready.qsize()
+
+    def metrics(self) -> T.Dict[str, T.Any]:
+        return {'batches': self.__batches,
+                'queue_depth': self.queue_depth,
+                'stall_time': self.__stall_time,
+                'last_stall_time': self.__last_stall_time,
+                'mean_stall_time': self.__stall_time / max(self.__batches, 1)}
+
+    def close(self):
+        """ Stops the background thread """
+        if self.__thread is None:
+            return
+
+        self.__stop.set()
+        self.__free.put(None)
+
+        # Drain the ready batches so that the producer is never blocked
+        while self.__thread.is_alive():
+            try:
+                self.__ready.get_nowait()
+            except queue.Empty:
+                pass
+            self.__thread.join(timeout=0.1)
+
+        self.__thread = None
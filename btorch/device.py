@@ -15,6 +15,26 @@ def if_instance_map(x, t, fn):
     return fn(x) if isinstance(x, t) else x
 
 
+def to_device(value: T.Any, device, non_blocking=False, copy=False):
+    """
+    Moves the tensors in (possibly nested) tuples, lists and dicts to the device. With copy the tensors are
+    copied even when they are already on the device (otherwise they are returned as they are)
+    """
+    if isinstance(value, torch.Tensor):
+        return value.to(device, non_blocking=non_blocking, copy=copy)
+
+    if isinstance(value, T.Mapping):
+        return type(value)((key, to_device(item, device, non_blocking, copy)) for key, item in value.items())
+
+    if isinstance(value, (list, tuple)):
+        items = [to_device(item, device, non_blocking, copy) for item in value]
+        if isinstance(value, list):
+            return items
+        return type(value)(*items) if hasattr(value, '_fields') else type(value)(items)
+
+    return value
+
+
 class TorchCuda(BlockDevice):
 
     _instances = {}
@@ -0,0 +1,180 @@
+from __future__ import annotations
+from blox_old.core.block.base import Block
+from blox_old.btorch.module import TorchModule, TorchModuleError, torch_modules, replace_blocks
+from blox_old.utils import raise_if
+from torch import nn
+import typing as T
+import copy
+import torch
+
+
+class FusionError(TorchModuleError):
+    pass
+
+
+_CONVS = (nn.Conv1d, nn.Conv2d, nn.Conv3d)
+
+
+def _is_conv(module: nn.Module) -> bool:
+    # The detectron2 wrappers may contain a norm and an activation of their own, which are folded separately
+    return isinstance(module, _CONVS) and getattr(module, 'norm', None) is None and \
+        getattr(module, 'activation', None) is None
+
+
+def _is_batch_norm(module: nn.Module) -> bool:
+    """ Batch norms of torch and their frozen variants (e.g. detectron2's FrozenBatchNorm2d) """
+    if isinstance(module, nn.modules.batchnorm._BatchNorm):
+        return module.track_running_stats
+    return 'BatchNorm' in type(module).__name__ and \
+        all(hasattr(module, attr) for attr in ('running_mean', 'running_var', 'eps'))
+
+
+def fold_batch_norm(conv: nn.Module, bn: nn.Module) -> nn.Module:
+    """ Returns a copy of the convolution that computes bn(conv(x)) with the batch norm in inference mode """
+    raise_if(conv.out_channels != bn.running_mean.numel(),
+             FusionError(f"The batch norm has {bn.running_mean.numel()} channels, "
+                         f"the convolution {conv.out_channels}"))
+
+    fused = copy.deepcopy(conv)
+
+    with torch.no_grad():
+        weight = bn.weight if getattr(bn, 'weight', None) is not None else torch.ones_like(bn.running_mean)
+        bias = bn.bias if getattr(bn, 'bias', None) is not None else torch.zeros_like(bn.running_mean)
+        scale = weight / torch.sqrt(bn.running_var + bn.eps)
+
+        fused.weight.copy_(conv.weight * scale.reshape([-1] + [1] * (conv.weight.dim() - 1)))
+
+        conv_bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+        fused_bias = (conv_bias - bn.running_mean) * scale + bias
+        if fused.bias is None:
+            fused.bias = nn.Parameter(fused_bias.to(conv.weight.dtype))
+        else:
+            fused.bias.copy_(fused_bias)
+
+    return fused
+
+
+class FusedConv(TorchModule):
+    """ A convolution with a folded batch norm, optionally followed by an activation """
+
+    def __init__(self, conv: nn.Module, activation: T.Optional[nn.Module] = None, name=None):
+        module = conv if activation is None else nn.Sequential(conv, activation)
+        super(FusedConv, self).__init__(name=name, module=module, In=1, Out=1)
+        self.lock_ports = True
+
+
+def _single_consumer(block: Block) -> T.Optional[TorchModule]:
+    """ The block that alone reads the output of the block, if it's a sibling torch module """
+    downstream = list(block.Out().downstream)
+    if len(downstream) != 1:
+        return None
+
+    port = downstream[0]
+    consumer = port.block
+    if not port.is_in or not isinstance(consumer, TorchModule) or consumer.parent is not block.parent or \
+            len(consumer.In) != 1 or len(consumer.Out) != 1:
+        return None
+
+    return consumer
+
+
+def _input_size(conv: nn.Module) -> T.List[int]:
+    """ A spatial input size for which the convolution has outputs (at least 8 per dimension) """
+    dims = conv.weight.dim() - 2
+    padding = conv.padding if not isinstance(conv.padding, str) else (0, ) * dims
+    return [max(8, dilation * (kernel - 1) + 1 - 2 * pad + stride)
+            for kernel, dilation, pad, stride in zip(conv.kernel_size, conv.dilation, padding, conv.stride)]
+
+
+def _check(original: T.Sequence[nn.Module], fused: nn.Module, conv: nn.Module, rtol, atol):
+    """ Compares the chain with its fusion on a random input """
+    shape = [2, conv.in_channels] + _input_size(conv)
+    x = torch.randn(shape, dtype=conv.weight.dtype, device=conv.weight.device)
+
+    with torch.no_grad():
+        expected = x
+        for module in original:
+            expected = module(expected)
+        actual = fused(x)
+
+    if not torch.allclose(actual, expected, rtol=rtol, atol=atol):
+        error = (actual - expected).abs().max().item()
+        raise FusionError(f"The fused convolution differs from the original by {error}")
+
+
+def _fuse_wrapper(block: TorchModule, verify, rtol, atol) -> bool:
+    """ Folds the batch norm inside a detectron2-style convolution wrapper (conv.norm) """
+    conv = block.module__
+    if not isinstance(conv, _CONVS) or not _is_batch_norm(getattr(conv, 'norm', None) or nn.Identity()):
+        return False
+
+    training = conv.training
+    conv.eval()
+    fused = fold_batch_norm(conv, conv.norm)
+    fused.norm = None
+    if verify:
+        try:
+            _check([conv], fused, conv, rtol, atol)
+        except FusionError:
+            conv.train(training)
+            raise
+
+    conv.weight.data = fused.weight.data
+    conv.bias = fused.bias
+    conv.norm = None
+    return True
+
+
+def fuse_conv_bn_relu(block: Block, verify=True, rtol=1e-4, atol=1e-5) -> T.List[Block]:
+    """
+    Rewrites Conv→BatchNorm(→ReLU) chains of TorchModule blocks under the block into single FusedConv blocks,
+    for inference. Only chains of sibling blocks where each output is read by the next block alone are fused.
+    Batch norms inside detectron2 convolution wrappers are folded in place.
+
+    The batch norms are folded using their running statistics, so the modules are put in eval mode.
+    With verify, each fusion is compared with the original chain on a random input before the graph is
+    changed (a failed comparison raises FusionError and restores the modules' modes). Returns the fused blocks.
+    """
+    fused_blocks = []
+
+    for conv_block in list(torch_modules(block)):
+        if conv_block.parent is None:
+            continue
+
+        conv = conv_block.module__
+        if _fuse_wrapper(conv_block, verify, rtol, atol):
+            fused_blocks.append(conv_block)
+            continue
+
+        if not _is_conv(conv) or len(conv_block.In) != 1 or len(conv_block.Out) != 1:
+            continue
+
+        bn_block = _single_consumer(conv_block)
+        if bn_block is None or not _is_batch_norm(bn_block.module__):
+            continue
+
+        relu_block = _single_consumer(bn_block)
+        if relu_block is not None and not isinstance(relu_block.module__, nn.ReLU):
+            relu_block = None
+
+        chain = [conv_block, bn_block] + ([relu_block] if relu_block is not None else [])
+        training = [b.module__.training for b in chain]
+        for b in chain:
+            b.module__.eval()
+
+        activation = nn.ReLU() if relu_block is not None else None
+        fused = FusedConv(fold_batch_norm(conv, bn_block.module__), activation=activation, name=conv_block.name)
+        fused.eval()
+
+        if verify:
+            try:
+                _check([b.module__ for b in chain], fused.module__, conv, rtol, atol)
+            except FusionError:
+                # The graph is left as it was
+                for b, mode in zip(chain, training):
+                    b.module__.train(mode)
+                raise
+
+        fused_blocks.append(replace_blocks(chain, fused))
+
+    return fused_blocks
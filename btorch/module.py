@@ -43,10 +43,62 @@ class BufferIterator:
 
     def __iter__(self):
         for param in self.block.descendants:
-            if isinstance(param, BufferIterator):
+            if isinstance(param, BufferProxy):
                 yield param
 
 
+def torch_modules(block: Block) -> T.List[TorchModule]:
+    """
+    Returns the TorchModule blocks in the subtree of the block (including itself) in a stable order.
+    The result is cached on the block until blocks are attached or detached below it
+    """
+    cached = block.__dict__.get('_torch_modules_cache')
+    if cached is not None and cached[0] == block.subtree_version:
+        return cached[1]
+
+    modules = [node for node in prepend(block, block.blocks.descendants) if isinstance(node, TorchModule)]
+    block._torch_modules_cache = (block.subtree_version, modules)
+    return modules
+
+
+def param_groups(modules: T.Iterable[TorchModule],
+                 options: T.Optional[T.Mapping[T.Union[Block, str], T.Dict]] = None) -> T.List[T.Dict]:
+    """
+    Splits the parameters of the modules into optimizer parameter groups.
+
+    The options map blocks (or their full names) to optimizer options (e.g. dict(lr=0.1, weight_decay=0)).
+    The parameters of a module are put in the group of its nearest ancestor (or itself) that has options,
+    or in the default group (first, without options). Empty groups are omitted.
+
+    Each parameter belongs to one group only. A parameter shared by several modules (e.g. when the torch module
+    of one block is a submodule of another's) belongs to the innermost one: the module that holds it at
+    the smallest submodule depth, and the first of them in the given order on a tie. The order of the groups
+    and of the parameters in them follows the first appearance of the parameters, so it is stable.
+    """
+    options = options or {}
+    by_block = {block.full_name if isinstance(block, Block) else block: opts for block, opts in options.items()}
+
+    # id(param) -> (depth, owner, param) in the order of first appearance
+    owners = dict()
+
+    for module in modules:
+        owner = next((node.full_name for node in module.iter_path_reverse()
+                      if isinstance(node, Block) and node.full_name in by_block), None)
+
+        for name, param in module.module__.named_parameters():
+            depth = name.count('.')
+            current = owners.get(id(param))
+            if current is None or depth < current[0]:
+                owners[id(param)] = (depth, owner, param)
+
+    groups = {None: []}
+    for _, owner, param in owners.values():
+        groups.setdefault(owner, []).append(param)
+
+    return [dict(params=params, **(by_block[owner] if owner is not None else {}))
+            for owner, params in groups.items() if params]
+
+
 def set_mode(block: Block, train: bool):
     for block in prepend([block], block.blocks.descendants):
         if isinstance(block, TorchModule):
@@ -56,6 +108,33 @@ def set_mode(block: Block, train: bool):
                 block.eval()
 
 
+def replace_blocks(chain: T.Sequence[Block], block: Block) -> Block:
+    """
+    Puts the block in place of a chain of sibling blocks (each feeding the next): it is attached to their
+    parent and connected to the chain's input and to the readers of its output. The chain must start with
+    a single input and end with a single output, as must the block.
+    """
+    for b, section in ((chain[0], 'In'), (chain[-1], 'Out'), (block, 'In'), (block, 'Out')):
+        raise_if(len(getattr(b, section)) != 1,
+                 TorchModuleError(f"Block {b.full_name} must have a single {section} port to be replaced"))
+
+    parent = chain[0].parent
+    upstream = chain[0].In().upstream()
+    downstream = list(chain[-1].Out().downstream)
+
+    # Detaching the blocks also clears their connections
+    for old in chain:
+        old.parent = None
+
+    block.parent = parent
+    if upstream is not None:
+        block.In[0] = upstream
+    for port in downstream:
+        port.section[port.name] = block.Out()
+
+    return block
+
+
 def set_trainable(parameters: T.Iterable[ParameterProxy], train: bool):
     for param in parameters:
         raise_if(not isinstance(param, ParameterProxy),
@@ -2,12 +2,14 @@ from __future__ import annotations
 # from torch.optim import SGD, Adam, Adagrad, Adadelta, AdamW, SparseAdam, \
 #     Adamax, ASGD, LBFGS, RMSprop, Rprop
 
+import torch
 import torch.optim as torch_opt
+from contextlib import nullcontext
 from blox_old.core.block.base import Sink
 import typing as T
 from blox_old.utils import maybe_or, maybe_error, const
 from collections import deque
-from blox_old.btorch.module import TorchModule, ParameterIterator
+from blox_old.btorch.module import TorchModule, param_groups
 from functools import partial
 from blox_old.core.engine import SessionError
 from blox_old.btorch.scheduler import TorchScheduler, LambdaLR
@@ -17,21 +19,79 @@ class TorchOptimizerError(SessionError):
     pass
 
 
+def _grad_scaler(device_type):
+    # torch.amp.GradScaler supports all devices in recent versions of torch
+    if hasattr(torch, 'amp') and hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler(device_type)
+    return torch.cuda.amp.GradScaler()
+
+
 class TorchOptimizer(Sink):
 
-    def __init__(self, *args, optimizer_fn, scheduler: T.Optional[TorchScheduler]=None, **kwargs):
+    def __init__(self, *args, optimizer_fn, scheduler: T.Optional[TorchScheduler]=None,
+                 param_options: T.Optional[T.Mapping] = None,
+                 accumulate: int = 1,
+                 autocast: T.Optional[torch.dtype] = None,
+                 loss_scale: T.Optional[bool] = None,
+                 set_to_none: bool = True, **kwargs):
+        """
+        Parameters
+        ----------
+        param_options
+            Maps blocks (or their full names) to per-block optimizer options (see param_groups).
+
+        accumulate
+            The number of micro-batches (calls of step) whose gradients are accumulated before each optimizer
+            and scheduler step. The losses are divided by it, so the gradients are averaged.
+
+        autocast
+            Computes the loss with automatic mixed precision in the given dtype (e.g. torch.bfloat16 on
+            the cpu). The device type is that of the parameters.
+
+        loss_scale
+            Scales the loss to avoid gradient underflow (see torch GradScaler). Defaults to whether autocast
+            is torch.float16 (bfloat16 has the range of float32 and doesn't need it).
+
+        set_to_none
+            Resets the gradients to None rather than zeroing them, which saves a memset per parameter.
+        """
         super(TorchOptimizer, self).__init__(*args, **kwargs)
 
+        if accumulate < 1:
+            raise ValueError(f"accumulate must be positive (given {accumulate})")
+
         self.__optimizer_fn = optimizer_fn
+        self.__param_options = param_options
         self.__optimizer = None
+        self.__compiled = None
+        self.__upstream_modules = None
         self.__scheduler = maybe_or(scheduler, LambdaLR(lr_lambda=const(1.), last_epoch=-1))
 
-    def init(self):
-        """ Searches for all torch parameters that might influence the input """
+        self.accumulate = accumulate
+        self.autocast = autocast
+        self.loss_scale = maybe_or(loss_scale, autocast == torch.float16)
+        self.set_to_none = set_to_none
+
+        self.__device_type = 'cpu'
+        self.__scaler = None
+        self.__micro_step = 0
+
+    def upstream_modules(self) -> T.List[TorchModule]:
+        """
+        Returns the TorchModule blocks that might influence the input, in the order of discovery. The result is
+        cached until ports are connected or blocks are attached or detached anywhere in the tree of the optimizer
+        """
+        root = self.root
+        if self.__upstream_modules is not None:
+            cached_root, version, modules = self.__upstream_modules
+            if cached_root is root and version == root.graph_version:
+                return modules
 
         seen_ports = set()
         next_ports = deque([self.In()])
-        parameters = set()
+
+        # In the order of discovery, so that the parameter order (and the optimizer state) is reproducible
+        modules = dict()
 
         while next_ports:
 
@@ -53,20 +113,83 @@ class TorchOptimizer(Sink):
 
             # Add parameters if the block has them
             if isinstance(block, TorchModule):
-                parameters.update(map(lambda x: x.tensor, ParameterIterator(block)))
+                modules[block] = None
+
+        modules = list(modules)
+        self.__upstream_modules = (root, root.graph_version, modules)
+        return modules
+
+    def init(self):
+        """ Searches for all torch parameters that might influence the input """
 
         # Sets the optimizer and initializes the LR scheduler
-        self.__optimizer = self.__optimizer_fn(parameters)
+        groups = param_groups(self.upstream_modules(), self.__param_options)
+        self.__optimizer = self.__optimizer_fn(groups)
         self.__scheduler.init(self.__optimizer)
 
-    def step(self, session):
+        # Autocast and loss scaling work per device type
+        if groups and groups[0]['params']:
+            self.__device_type = groups[0]['params'][0].device.type
+        self.__scaler = _grad_scaler(self.__device_type) if self.loss_scale else None
+        self.__micro_step = 0
+
+    @property
+    def pending_micro_steps(self) -> int:
+        """ The number of micro-batches whose gradients were accumulated since the last optimizer step """
+        return self.__micro_step
+
+    def __run_step(self, compute_loss):
         maybe_error(self.__optimizer, TorchOptimizerError("The optimizer was not initialized"))
-        self.__optimizer.zero_grad()
-        loss = self.get(session)
-        loss.backward()
 
-        self.__optimizer.step()
+        if self.__micro_step == 0:
+            self.__optimizer.zero_grad(set_to_none=self.set_to_none)
+
+        context = nullcontext() if self.autocast is None else \
+            torch.autocast(device_type=self.__device_type, dtype=self.autocast)
+        with context:
+            loss = compute_loss()
+
+        # The losses are averaged over the micro-batches
+        scaled_loss = loss / self.accumulate if self.accumulate > 1 else loss
+        if self.__scaler is not None:
+            scaled_loss = self.__scaler.scale(scaled_loss)
+        scaled_loss.backward()
+
+        self.__micro_step += 1
+        if self.__micro_step < self.accumulate:
+            return loss.detach()
+        self.__micro_step = 0
+
+        if self.__scaler is not None:
+            # Skips the step if the gradients overflowed, and adjusts the scale
+            self.__scaler.step(self.__optimizer)
+            self.__scaler.update()
+        else:
+            self.__optimizer.step()
+
         self.__scheduler.step()
+        return loss.detach()
+
+    def step(self, session):
+        return self.__run_step(lambda: self.get(session))
+
+    def compile(self, inputs, trace=None, example_inputs=None):
+        """
+        Flattens the subgraph from the given input ports (or sources) to the loss into a torch module
+        (see btorch.compile), which is then used by train_step(). The parameters stay shared with the blocks
+        """
+        from blox_old.btorch.compile import compile_graph
+        self.__compiled = compile_graph(outputs=self.In(), inputs=inputs, trace=trace, example_inputs=example_inputs)
+        return self.__compiled
+
+    @property
+    def compiled(self):
+        return self.__compiled
+
+    def train_step(self, *inputs):
+        """ Same as step(), but computes the loss of the given inputs with the compiled module """
+        maybe_error(self.__compiled, TorchOptimizerError("The optimizer was not compiled"))
+        return self.__run_step(lambda: self.__compiled(*inputs))
 
 
 class Adagrad(TorchOptimizer):
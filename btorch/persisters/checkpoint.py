@@ -0,0 +1,304 @@
+from blox_old.core.block.base import Block
+from blox_old.core.exceptions import PersisterError
+from blox_old.utils import join_not_none, raise_if, second_or
+from blox_old.btorch.module import NNModuleProxy
+from blox_old.btorch.persisters.mmap import MmapTensorBackend
+from concurrent.futures import ThreadPoolExecutor
+from more_itertools import prepend
+import typing as T
+import torch
+import hashlib
+import heapq
+import json
+import os
+import tempfile
+import uuid
+
+
+# The manifest of a checkpoint lists its shards (file name, size and checksum) and, for every tensor,
+# the shard holding it along with its dtype and shape. It is written last, so a checkpoint exists
+# only once all its shards are complete: an interrupted save leaves the previous checkpoint intact.
+_MANIFEST_VERSION = 1
+_CHUNK_SIZE = 1 << 20
+
+
+def _file_checksum(path) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _nbytes(tensor: torch.Tensor) -> int:
+    return tensor.numel() * tensor.element_size()
+
+
+def _partition(sizes: T.Mapping[str, int], num_shards: int) -> T.List[T.List[str]]:
+    """ Splits the keys into (at most) num_shards groups of roughly equal total size (largest first) """
+    shards = [[] for _ in range(min(num_shards, len(sizes)))]
+    heap = [(0, n) for n in range(len(shards))]
+
+    for key in sorted(sizes, key=lambda k: sizes[k], reverse=True):
+        total, n = heapq.heappop(heap)
+        shards[n].append(key)
+        heapq.heappush(heap, (total + sizes[key], n))
+
+    return shards
+
+
+class CheckpointManager:
+    """
+    Saves and loads all the torch modules under a block as a sharded checkpoint.
+
+    The tensors (parameters and buffers) of every NNModuleProxy under the block are split into shards of
+    roughly equal size, which are written and read in parallel threads. Each shard is a file in the format
+    of MmapTensorBackend, so loading reads only the shards that hold the requested tensors.
+
+    A checkpoint is identified by its tag and consists of the shard files and a manifest (<tag>.json)
+    with their checksums. Saving is atomic: the manifest is replaced only after all the shards are written.
+    """
+
+    def __init__(self, block: Block, directory, num_shards: T.Optional[int] = None, max_workers: int = 4,
+                 alignment: int = 64):
+        self.block = block
+        self.directory = directory
+        self.max_workers = max_workers
+        self.num_shards = num_shards if num_shards is not None else max_workers
+        self.alignment = alignment
+
+        os.makedirs(directory, exist_ok=True)
+
+    def modules(self) -> T.Iterator[NNModuleProxy]:
+        """ The outermost module proxies under the block (their state dicts cover the nested ones) """
+        for node in prepend(self.block, self.block.descendants):
+            if isinstance(node, NNModuleProxy) and not isinstance(node.parent, NNModuleProxy):
+                yield node
+
+    def _module_name(self, module_proxy: NNModuleProxy) -> T.Optional[str]:
+        rel_name = module_proxy.rel_name(self.block)
+        raise_if(rel_name is None,
+                 PersisterError(f"The module {module_proxy} is not a descendant of the block {self.block}"))
+        return second_or(rel_name.split(self.block.separator, maxsplit=1), default=None)
+
+    def _key(self, module_name, state_key) -> str:
+        return join_not_none(self.block.separator, [module_name, *state_key.split('.')])
+
+    def state_dict(self) -> T.Dict[str, torch.Tensor]:
+        """ All the tensors of the checkpoint keyed by their names relative to the block """
+        state_dict = dict()
+        for module_proxy in self.modules():
+            module_name = self._module_name(module_proxy)
+            for state_key, tensor in module_proxy.state_dict().items():
+                state_dict[self._key(module_name, state_key)] = tensor
+        return state_dict
+
+    # ----------------------------------------------------------------------------------------------------
+    # Files
+    # ----------------------------------------------------------------------------------------------------
+
+    def _path(self, filename) -> str:
+        return os.path.join(self.directory, filename)
+
+    def _manifest_path(self, tag) -> str:
+        return self._path(f'{tag}.json')
+
+    def manifest(self, tag='latest') -> T.Dict:
+        path = self._manifest_path(tag)
+        raise_if(not os.path.exists(path), PersisterError(f"No checkpoint {tag} in {self.directory}"))
+
+        with open(path, 'r') as f:
+            manifest = json.load(f)
+
+        raise_if(manifest.get('version') != _MANIFEST_VERSION,
+                 PersisterError(f"Unsupported checkpoint manifest version {manifest.get('version')}"))
+        return manifest
+
+    def _write_manifest(self, tag, manifest):
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(manifest, f, indent=1)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self._manifest_path(tag))
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    def _remove_shards(self, tag, keep: T.Collection[str]):
+        """ Removes the shard files of earlier saves of the tag (and of interrupted ones) """
+        prefix = f'{tag}.'
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith(prefix) and entry.name.endswith('.shard') and entry.name not in keep:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+    # ----------------------------------------------------------------------------------------------------
+    # Save
+    # ----------------------------------------------------------------------------------------------------
+
+    def _save_shard(self, filename, tensors: T.Mapping[str, torch.Tensor]) -> T.Dict:
+        path = self._path(filename)
+        with MmapTensorBackend(path, alignment=self.alignment) as backend:
+            backend.set_many(tensors)
+
+        with open(path, 'rb+') as f:
+            os.fsync(f.fileno())
+
+        return {'file': filename, 'size': os.path.getsize(path), 'sha256': _file_checksum(path)}
+
+    def save(self, tag='latest') -> T.Dict:
+        """ Writes all the tensors under the block and returns the manifest """
+        raise_if(os.sep in str(tag), PersisterError(f"Invalid checkpoint tag {tag}"))
+
+        # The tensors are copied to the cpu up front, so that training may continue while the shards are written
+        tensors = {key: tensor.detach().to('cpu', copy=True) for key, tensor in self.state_dict().items()}
+        shards = _partition({key: _nbytes(tensor) for key, tensor in tensors.items()}, self.num_shards)
+
+        # A unique token keeps the shards of this save apart from those of the checkpoint being replaced
+        token = uuid.uuid4().hex[:8]
+        filenames = [f'{tag}.{token}.{n:05d}-of-{len(shards):05d}.shard' for n in range(len(shards))]
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            shard_entries = list(executor.map(
+                lambda filename, keys: self._save_shard(filename, {key: tensors[key] for key in keys}),
+                filenames, shards))
+
+        manifest = {
+            'version': _MANIFEST_VERSION,
+            'shards': shard_entries,
+            'tensors': {key: {'shard': n,
+                              'dtype': str(tensors[key].dtype).replace('torch.', ''),
+                              'shape': list(tensors[key].shape)}
+                        for n, keys in enumerate(shards) for key in keys},
+        }
+
+        self._write_manifest(tag, manifest)
+        self._remove_shards(tag, keep=set(filenames))
+        return manifest
+
+    # ----------------------------------------------------------------------------------------------------
+    # Load
+    # ----------------------------------------------------------------------------------------------------
+
+    def verify(self, tag='latest', keys: T.Optional[T.Iterable[str]] = None) -> T.List[str]:
+        """
+        Checks the shards holding the given keys (by default all of them) against the manifest.
+        Returns a list of problems (empty if the checkpoint is intact)
+        """
+        manifest = self.manifest(tag)
+        shard_ids, problems = self._shards_of(manifest, keys)
+
+        def check(n):
+            entry = manifest['shards'][n]
+            path = self._path(entry['file'])
+            if not os.path.exists(path):
+                return f"Shard {entry['file']} is missing"
+            if os.path.getsize(path) != entry['size']:
+                return f"Shard {entry['file']} has size {os.path.getsize(path)} (expected {entry['size']})"
+            if _file_checksum(path) != entry['sha256']:
+                return f"Shard {entry['file']} is corrupted (checksum mismatch)"
+            return None
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            problems.extend(problem for problem in executor.map(check, sorted(shard_ids)) if problem is not None)
+
+        return problems
+
+    @staticmethod
+    def _shards_of(manifest, keys) -> T.Tuple[T.Set[int], T.List[str]]:
+        if keys is None:
+            return set(range(len(manifest['shards']))), []
+
+        shard_ids, problems = set(), []
+        for key in keys:
+            entry = manifest['tensors'].get(key)
+            if entry is None:
+                problems.append(f"Tensor {key} is not in the checkpoint")
+            else:
+                shard_ids.add(entry['shard'])
+        return shard_ids, problems
+
+    def _read_shard(self, filename, keys) -> T.Dict[str, torch.Tensor]:
+        with MmapTensorBackend(self._path(filename), alignment=self.alignment) as backend:
+            return backend.get_many(keys)
+
+    def load(self, tag='latest', strict=True, verify=True, zero_copy=False):
+        """
+        Loads the tensors of all the modules under the block.
+
+        With strict, every tensor of the modules must be in the checkpoint with the same shape (otherwise
+        the modules present in the checkpoint are loaded and the rest are left as they are).
+        With verify, the checksums of the shards that are read are checked before anything is loaded.
+        With zero_copy, loaded tensors that match the device and dtype of the targets become their data, so
+        the parameters view the memory-mapped shard files (see ParameterPersister).
+        """
+        manifest = self.manifest(tag)
+
+        # The target tensors of every module, keyed by their checkpoint names
+        targets = dict()
+        for module_proxy in self.modules():
+            module_name = self._module_name(module_proxy)
+            for state_key, tensor in module_proxy.state_dict().items():
+                targets[self._key(module_name, state_key)] = (module_proxy, state_key, tensor)
+
+        problems = []
+        for key, (_, _, tensor) in targets.items():
+            entry = manifest['tensors'].get(key)
+            if entry is None:
+                if strict:
+                    problems.append(f"Tensor {key} is not in the checkpoint")
+            elif list(tensor.shape) != entry['shape']:
+                problems.append(f"Tensor shape mismatch for {key}: given {entry['shape']} "
+                                f"expected {list(tensor.shape)}")
+
+        keys = [key for key in targets if key in manifest['tensors']]
+        if verify:
+            problems.extend(self.verify(tag, keys=keys))
+
+        raise_if(len(problems) > 0, PersisterError(f"Cannot load checkpoint {tag}:\n" + '\n'.join(problems)))
+
+        # Read the needed shards in parallel
+        by_shard = dict()
+        for key in keys:
+            by_shard.setdefault(manifest['tensors'][key]['shard'], []).append(key)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self._read_shard, manifest['shards'][n]['file'], shard_keys)
+                       for n, shard_keys in by_shard.items()]
+            values = dict()
+            for future in futures:
+                values.update(future.result())
+
+        # Group the tensors per module
+        state_dicts = dict()
+        for key in keys:
+            module_proxy, state_key, tensor = targets[key]
+            state_dicts.setdefault(module_proxy, dict())[state_key] = values[key]
+
+        for module_proxy, state_dict in state_dicts.items():
+            self._load_module(module_proxy, state_dict, strict=strict, zero_copy=zero_copy)
+
+    @staticmethod
+    def _load_module(module_proxy: NNModuleProxy, state_dict, strict, zero_copy):
+        module = module_proxy.module__
+        current = module_proxy.state_dict()
+
+        # Restore the tensors on the current target devices
+        state_dict = {key: tensor.to(current[key].device) for key, tensor in state_dict.items()}
+
+        if zero_copy:
+            targets = dict(module.named_parameters())
+            targets.update(module.named_buffers())
+
+            for key, tensor in list(state_dict.items()):
+                target = targets.get(key)
+                if target is not None and tensor.device == target.device and tensor.dtype == target.dtype:
+                    target.data = state_dict.pop(key)
+
+        # Whatever is left (everything, without zero_copy) is copied
+        if state_dict:
+            module.load_state_dict(state_dict=state_dict, strict=strict and not zero_copy)
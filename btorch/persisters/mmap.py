@@ -0,0 +1,168 @@
+from blox_old.core.persistence.base import PersisterBackend
+from blox_old.core.exceptions import PersisterError
+import torch
+import typing as T
+import mmap
+import json
+import os
+import struct
+import tempfile
+
+
+# File layout:
+#   magic (8 bytes) | index size (8 bytes, little endian) | index (JSON) | padding | tensor data
+# The index maps keys to the dtype, shape, offset (relative to the data start) and size of each tensor.
+# Every tensor starts at an aligned offset, so that it can be viewed in place.
+_MAGIC = b'BLOXTNS1'
+_HEADER = struct.Struct('<8sQ')
+
+
+def _align(offset, alignment):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def _dtype_from_name(name: str) -> torch.dtype:
+    dtype = getattr(torch, name, None)
+    if not isinstance(dtype, torch.dtype):
+        raise PersisterError(f"Unknown tensor dtype {name}")
+    return dtype
+
+
+class MmapTensorBackend(PersisterBackend):
+    """
+    Stores tensors in a single file with an index, and reads them as views of the memory-mapped file.
+
+    Reading a tensor doesn't copy it: the returned tensor shares memory with the (copy-on-write) mapping,
+    so its pages are read from disk only when used and are never written back to the file.
+    Combined with ParameterPersister(zero_copy=True) the parameters of a module become views of the
+    checkpoint file.
+
+    Writes are collected and the file is rewritten (atomically) on flush() and when the backend is closed.
+    """
+
+    def __init__(self, filepath, alignment=64):
+        self.filepath = filepath
+        self.alignment = alignment
+
+        self._mmap = None
+        self._index = None
+        self._data_offset = 0
+        self._pending = dict()
+
+    def __enter__(self):
+        self._open()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if exc_type is None:
+                self.flush()
+        finally:
+            # The mapping is not closed explicitly: tensors viewing it keep it alive
+            self._mmap = None
+            self._index = None
+            self._pending = dict()
+
+    def __check_init(self):
+        if self._index is None:
+            raise PersisterError("MmapTensorBackend must be opened first")
+
+    def _open(self):
+        self._mmap = None
+        self._index = dict()
+        self._data_offset = 0
+
+        if not os.path.exists(self.filepath) or os.path.getsize(self.filepath) == 0:
+            return
+
+        with open(self.filepath, 'rb') as f:
+            magic, index_size = _HEADER.unpack(f.read(_HEADER.size))
+            if magic != _MAGIC:
+                raise PersisterError(f"{self.filepath} is not a tensor checkpoint file")
+
+            self._index = json.loads(f.read(index_size).decode('utf-8'))
+            self._data_offset = _align(_HEADER.size + index_size, self.alignment)
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    def _view(self, key) -> torch.Tensor:
+        entry = self._index[key]
+        dtype = _dtype_from_name(entry['dtype'])
+        shape = entry['shape']
+
+        if entry['nbytes'] == 0:
+            return torch.empty(shape, dtype=dtype)
+
+        count = entry['nbytes'] // torch.empty((), dtype=dtype).element_size()
+        return torch.frombuffer(self._mmap, dtype=dtype, count=count,
+                                offset=self._data_offset + entry['offset']).view(shape)
+
+    def __contains__(self, item):
+        self.__check_init()
+        return item in self._pending or item in self._index
+
+    def __getitem__(self, item):
+        self.__check_init()
+        if item in self._pending:
+            return self._pending[item]
+        if item not in self._index:
+            raise KeyError(item)
+        return self._view(item)
+
+    def __setitem__(self, key, value):
+        self.__check_init()
+        if not isinstance(value, torch.Tensor):
+            raise PersisterError(f"{self.__class__.__name__} only stores tensors (given {type(value)})")
+        self._pending[key] = value.detach()
+
+    def get_many(self, keys):
+        return {key: self[key] for key in keys if key in self}
+
+    def set_many(self, items):
+        items = items.items() if isinstance(items, T.Mapping) else items
+        for key, value in items:
+            self[key] = value
+
+    def flush(self):
+        """ Writes the collected tensors (along with the previously stored ones) to the file """
+        self.__check_init()
+        if not self._pending:
+            return
+
+        tensors = {key: self._view(key) for key in self._index if key not in self._pending}
+        tensors.update(self._pending)
+
+        index = dict()
+        offset = 0
+        for key, tensor in tensors.items():
+            nbytes = tensor.numel() * tensor.element_size()
+            index[key] = {'dtype': str(tensor.dtype).replace('torch.', ''),
+                          'shape': list(tensor.shape),
+                          'offset': offset,
+                          'nbytes': nbytes}
+            offset = _align(offset + nbytes, self.alignment)
+
+        index_bytes = json.dumps(index).encode('utf-8')
+        data_offset = _align(_HEADER.size + len(index_bytes), self.alignment)
+
+        # Write to a temporary file and move it in place. Existing mappings keep viewing the old file
+        directory = os.path.dirname(os.path.abspath(self.filepath))
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(_HEADER.pack(_MAGIC, len(index_bytes)))
+                f.write(index_bytes)
+
+                for key, tensor in tensors.items():
+                    f.seek(data_offset + index[key]['offset'])
+                    if index[key]['nbytes'] > 0:
+                        data = tensor.detach().to('cpu').contiguous().view(-1).view(torch.uint8)
+                        f.write(memoryview(data.numpy()))
+
+                f.truncate(data_offset + offset)
+            os.replace(temp_path, self.filepath)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+        self._pending = dict()
+        self._open()
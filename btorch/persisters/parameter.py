@@ -2,10 +2,74 @@ from blox_old.core.persistence.base import Persister
 from blox_old.core.exceptions import PersisterError
 from blox_old.utils import join_not_none, raise_if
 
-from blox_old.btorch.module import NNModuleProxy, TensorProxy
+from blox_old.btorch.module import NNModuleProxy, TensorProxy, ParameterProxy
+
+
+def _version(tensor):
+    """ Changes whenever the tensor is modified in place or its storage is replaced """
+    return tensor.data_ptr(), tensor._version
+
+
+def _as_tags(tag):
+    """ A tag or a sequence of tags (the base checkpoint first, followed by the deltas) """
+    return list(tag) if isinstance(tag, (list, tuple)) else [tag]
 
 
 class ParameterPersister(Persister):
+    """
+    Saves and loads parameters and buffers of torch modules.
+
+    With zero_copy, loaded tensors that are already on the target device and of the target dtype
+    (e.g. memory-mapped views returned by MmapTensorBackend) become the parameters' data instead of
+    being copied into them.
+
+    With incremental, a save writes only the tensors that were modified since they were last saved
+    (or loaded), which is tracked by the tensors' version counters. Frozen parameters are therefore
+    written once. With skip_frozen, parameters that don't require gradients are never written (and are
+    left as they are on load), e.g. for backbones that are loaded from pretrained weights anyway.
+
+    To restore from incremental saves, load with a sequence of tags: the base checkpoint first followed
+    by the deltas. Each tensor is loaded from the last tag it was saved with.
+    """
+
+    def __init__(self, *args, zero_copy=False, incremental=False, skip_frozen=False, **kwargs):
+        super(ParameterPersister, self).__init__(*args, **kwargs)
+        self.zero_copy = zero_copy
+        self.incremental = incremental
+        self.skip_frozen = skip_frozen
+
+        # Maps the keys (without tags) to the versions of the tensors when they were last saved or loaded
+        self._versions = dict()
+
+    def reset_versions(self):
+        """ Makes the next save write all the tensors (e.g. when switching to a new backend) """
+        self._versions = dict()
+
+    def _unchanged(self, key, tensor) -> bool:
+        return self.incremental and self._versions.get(key) == _version(tensor)
+
+    def _frozen_keys(self, module_proxy):
+        """ The state dict keys of the parameters skipped due to skip_frozen """
+        if not self.skip_frozen:
+            return set()
+        return {key for key, param in module_proxy.module__.named_parameters() if not param.requires_grad}
+
+    def _get_tagged(self, keys, tag):
+        """ Reads the given keys (without tags) from the last of the tags that has each of them """
+        values = dict()
+        remaining = list(keys)
+        for t in reversed(_as_tags(tag)):
+            if not remaining:
+                break
+            tagged = {join_not_none(self.block.separator, [key, t]): key for key in remaining}
+            for tagged_key, value in self.backend.get_many(list(tagged)).items():
+                values[tagged[tagged_key]] = value
+            remaining = [key for key in remaining if key not in values]
+        return values
+
+    def _can_share(self, tensor, target):
+        return self.zero_copy and tensor.device == target.device and tensor.dtype == target.dtype and \
+               tensor.shape == target.shape
 
     def can_save(self, obj, *args, **kwargs):
         return super(ParameterPersister, self).can_save(obj, *args, **kwargs) and \
@@ -40,44 +104,90 @@ class ParameterPersister(Persister):
     def _save_module_proxy(self, module_proxy, tag):
         # We'll handle module proxies using Torch's state dict interface
         state_dict = module_proxy.state_dict()
+        frozen = self._frozen_keys(module_proxy)
+
+        keys = {key: join_not_none(self.block.separator, [self.get_obj_name(module_proxy), *key.split('.')])
+                for key in state_dict if key not in frozen}
+        keys = {key: name for key, name in keys.items() if not self._unchanged(name, state_dict[key])}
+
+        # Store the tensors as if they were on the cpu. They are copied, since buffering backends
+        # (e.g. WriteBehind) may write them after training has modified the originals
+        items = {join_not_none(self.block.separator, [name, tag]): state_dict[key].detach().to('cpu', copy=True)
+                 for key, name in keys.items()}
 
-        for key, tensor in state_dict.items():
-            key = join_not_none(self.block.separator, [self.get_obj_name(module_proxy), *key.split('.'), tag])
+        # A single bulk write instead of one write per tensor
+        self.backend.set_many(items)
 
-            # Store the tensors as if they were on the cpu
-            self.backend[key] = tensor.detach().cpu()
+        for key, name in keys.items():
+            self._versions[name] = _version(state_dict[key])
 
     def _load_module_proxy(self, module_proxy, tag):
 
         # We'll use the state_dict() method to figure out what keys are needed
-        state_dict = {}
-        for key, orig_tensor in module_proxy.state_dict().items():
+        orig_state_dict = module_proxy.state_dict()
+        frozen = self._frozen_keys(module_proxy)
+        names = {key: join_not_none(self.block.separator, [self.get_obj_name(module_proxy), *key.split('.')])
+                 for key in orig_state_dict if key not in frozen}
 
-            # Get the keys
-            backend_key = join_not_none(self.block.separator, [self.get_obj_name(module_proxy), *key.split('.'), tag])
+        # One bulk read per tag instead of one read per tensor
+        values = self._get_tagged(names.values(), tag)
 
-            raise_if(backend_key not in self.backend,
-                     PersisterError(f"Key {backend_key} is not contained in the backend"))
+        state_dict = {}
+        for key, name in names.items():
+            raise_if(name not in values,
+                     PersisterError(f"Key {name} is not contained in the backend for tags {_as_tags(tag)}"))
 
             # Restore the tensors on the current target device
-            state_dict[key] = self.backend[backend_key].to(orig_tensor.device)
+            state_dict[key] = values[name].to(orig_state_dict[key].device)
+
+        if self.zero_copy:
+            module = module_proxy.module__
+            targets = dict(module.named_parameters())
+            targets.update(module.named_buffers())
+
+            for key, tensor in list(state_dict.items()):
+                target = targets.get(key)
+                if target is not None and self._can_share(tensor, target):
+                    target.data = state_dict.pop(key)
+
+            # Whatever could not be shared is copied as usual
+            if state_dict:
+                module.load_state_dict(state_dict=state_dict, strict=False)
+        elif frozen:
+            module_proxy.module__.load_state_dict(state_dict=state_dict, strict=False)
+        else:
+            module_proxy.load_state_dict(state_dict=state_dict)
 
-        module_proxy.load_state_dict(state_dict=state_dict)
+        # The module now matches the checkpoint, so the next incremental save starts from here
+        current = module_proxy.state_dict()
+        for key, name in names.items():
+            self._versions[name] = _version(current[key])
+
+    def _skipped(self, tensor_proxy) -> bool:
+        return self.skip_frozen and isinstance(tensor_proxy, ParameterProxy) and not tensor_proxy.requires_grad
 
     def _save_tensor_proxy(self, tensor_proxy, tag):
 
-        key = join_not_none(self.block.separator, [self.get_obj_name(tensor_proxy), tag])
+        name = self.get_obj_name(tensor_proxy)
+        tensor = tensor_proxy.tensor
+        if self._skipped(tensor_proxy) or self._unchanged(name, tensor):
+            return
 
-        # Store the tensors as if they were on the cpu
-        self.backend[key] = tensor_proxy.tensor.detach().cpu()
+        # Store the tensors as if they were on the cpu (see _save_module_proxy)
+        self.backend[join_not_none(self.block.separator, [name, tag])] = tensor.detach().to('cpu', copy=True)
+        self._versions[name] = _version(tensor)
 
     def _load_tensor_proxy(self, tensor_proxy, tag):
 
-        key = join_not_none(self.block.separator, [self.get_obj_name(tensor_proxy), tag])
-        raise_if(key not in self.backend,
-                 PersisterError(f"Key {key} is not contained in the backend"))
+        if self._skipped(tensor_proxy):
+            return
+
+        name = self.get_obj_name(tensor_proxy)
+        values = self._get_tagged([name], tag)
+        raise_if(name not in values,
+                 PersisterError(f"Key {name} is not contained in the backend for tags {_as_tags(tag)}"))
 
-        tensor = self.backend[key]
+        tensor = values[name]
 
         # See torch.nn.Module._load_from_state_dict
         # Backward compatibility: loading 1-dim tensor from 0.3.* to version 0.4+
@@ -85,9 +195,15 @@ class ParameterPersister(Persister):
             tensor = tensor[0]
 
         raise_if(tensor.shape != tensor_proxy.tensor.shape,
-                 PersisterError(f"Tensor shape mishmatch for {key}: given {tensor.shape} "
+                 PersisterError(f"Tensor shape mishmatch for {name}: given {tensor.shape} "
                                 f"expected {tensor_proxy.tensor.shape}"))
 
+        # Share the loaded tensor's memory instead of copying it
+        if self._can_share(tensor, tensor_proxy.tensor):
+            tensor_proxy.tensor.data = tensor
+            self._versions[name] = _version(tensor_proxy.tensor)
+            return
+
         # TODO - Why doesn't torch complain when loading a module?
         # Allow in-place copying
         tensor_proxy.requires_grad, requires_grad = False, tensor_proxy.requires_grad
@@ -97,3 +213,4 @@ class ParameterPersister(Persister):
         tensor_proxy.tensor.copy_(tensor)
 
         tensor_proxy.requires_grad = requires_grad
+        self._versions[name] = _version(tensor_proxy.tensor)
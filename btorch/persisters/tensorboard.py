@@ -4,20 +4,318 @@ from blox_old.core.block.base import Port, _Block
 from blox_old.core.block.base import Sink
 from torch.utils.tensorboard import SummaryWriter
 from blox_old.core.engine import Session
+from collections import defaultdict
 from enum import Enum
+import typing as T
+import threading
+import weakref
+import queue
+import time
+import torch
 
 
 class SummaryType(Enum):
     SCALAR = 0,
+    HISTOGRAM = 1,
+
+
+_REDUCTIONS = {
+    'mean': lambda values: values.mean(),
+    'min': lambda values: values.min(),
+    'max': lambda values: values.max(),
+}
+
+
+class _Group:
+    """ The values of one tag collected over (up to) aggregate steps """
+
+    def __init__(self, summary_type: SummaryType, tag: str):
+        self.summary_type = summary_type
+        self.tag = tag
+        self.values = []
+        self.step = None
+        self.walltime = None
+
+    def add(self, value, step, walltime):
+        self.values.append(value)
+        self.step = step
+        self.walltime = walltime
+
+
+def _snapshot(value):
+    """ Keeps tensors on their device (no sync). The copy protects against later in-place updates """
+    if isinstance(value, torch.Tensor):
+        return value.detach().clone()
+    return torch.as_tensor(value)
+
+
+class _Metrics:
+    """
+    The collected values and the writing thread of a MetricsWriter. The thread and the finalizer of the writer
+    refer to this object only, so that the writer itself can be garbage-collected
+    """
+
+    def __init__(self, writer: SummaryWriter, aggregate: int, reductions: T.Tuple[str, ...],
+                 flush_every: int, flush_secs: float, max_queue: int):
+        self.writer = writer
+        self.aggregate = aggregate
+        self.reductions = reductions
+        self.flush_every = flush_every
+        self.flush_secs = flush_secs
+
+        self._groups: T.Dict[T.Tuple[SummaryType, str], _Group] = dict()
+        self._ready: T.List[_Group] = []
+        self._last_flush = time.perf_counter()
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._write_lock = threading.Lock()
+        self._thread = None
+        self._error = None
+        self._closed = False
+
+    # ----------------------------------------------------------------------------------------------------
+    # Collecting
+    # ----------------------------------------------------------------------------------------------------
+
+    def add(self, summary_type, tag, value, step, walltime):
+        self.raise_error()
+        value = _snapshot(value)
+        walltime = walltime if walltime is not None else time.time()
+
+        with self._lock:
+            if self._closed:
+                raise PersisterError("MetricsWriter is closed")
+
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._serve, daemon=True, name=f"MetricsWriter-{id(self)}")
+                self._thread.start()
+
+            group = self._groups.get((summary_type, tag))
+            if group is None:
+                group = self._groups[summary_type, tag] = _Group(summary_type, tag)
+
+            group.add(value, step, walltime)
+            if len(group.values) >= self.aggregate:
+                self._ready.append(self._groups.pop((summary_type, tag)))
+
+            batch = None
+            if len(self._ready) >= self.flush_every or time.perf_counter() - self._last_flush >= self.flush_secs:
+                batch = self._take_ready()
+
+        # Outside the lock: the queue may be full, and the thread takes the lock to write by itself
+        if batch:
+            self._queue.put(batch)
+
+    def flush(self, wait=False):
+        with self._lock:
+            self._ready.extend(self._groups.values())
+            self._groups.clear()
+            batch = self._take_ready()
+
+        if batch:
+            self._queue.put(batch)
+
+        if wait:
+            self._queue.join()
+            with self._write_lock:     # A batch the thread picked up by itself
+                pass
+            self.raise_error()
+
+    def close(self):
+        if self._closed:
+            return
+
+        self.flush()
+        with self._lock:
+            self._closed = True
+            thread = self._thread
+
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+        self.writer.close()
+        self.raise_error()
+
+    def _take_ready(self) -> T.List[_Group]:
+        """ Called under the lock """
+        self._last_flush = time.perf_counter()
+        batch, self._ready = self._ready, []
+        return batch
+
+    def raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise PersisterError(f"Writing the metrics failed: {error}") from error
+
+    # ----------------------------------------------------------------------------------------------------
+    # Writing
+    # ----------------------------------------------------------------------------------------------------
+
+    def _serve(self):
+        while True:
+            try:
+                batch = self._queue.get(timeout=self.flush_secs)
+            except queue.Empty:
+                self._write_ready()
+                continue
+
+            try:
+                if batch is None:
+                    return
+                self._write(batch)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _write_ready(self):
+        """ Writes the complete groups nobody handed over within flush_secs """
+        with self._write_lock:
+            with self._lock:
+                if time.perf_counter() - self._last_flush < self.flush_secs:
+                    return
+                batch = self._take_ready()
+
+            try:
+                if batch:
+                    self._write(batch)
+            except Exception as e:
+                self._error = e
+
+    @staticmethod
+    def _to_cpu(batch: T.List[_Group]) -> T.Dict[int, T.List[torch.Tensor]]:
+        """ Copies the values of the groups to the cpu, concatenating them per device to sync only once """
+        flat = defaultdict(list)
+        for n, group in enumerate(batch):
+            for value in group.values:
+                flat[value.device].append((n, value))
+
+        values = defaultdict(list)
+        for device, items in flat.items():
+            sizes = [value.numel() for _, value in items]
+            merged = torch.cat([value.reshape(-1).float() for _, value in items]).cpu()
+            for (n, value), part in zip(items, torch.split(merged, sizes)):
+                values[n].append(part.reshape(value.shape))
+
+        return values
+
+    def _write(self, batch: T.List[_Group]):
+        values = self._to_cpu(batch)
+
+        for n, group in enumerate(batch):
+            if group.summary_type is SummaryType.SCALAR:
+                scalars = torch.stack([value.reshape(()) for value in values[n]])
+                if len(scalars) == 1:
+                    self.writer.add_scalar(group.tag, scalars[0].item(), global_step=group.step,
+                                           walltime=group.walltime)
+                    continue
+
+                for reduction in self.reductions:
+                    tag = group.tag if reduction == 'mean' else f"{group.tag}/{reduction}"
+                    self.writer.add_scalar(tag, _REDUCTIONS[reduction](scalars).item(), global_step=group.step,
+                                           walltime=group.walltime)
+
+            else:
+                self.writer.add_histogram(group.tag, torch.cat([value.reshape(-1) for value in values[n]]),
+                                          global_step=group.step, walltime=group.walltime)
+
+
+class MetricsWriter:
+    """
+    A buffered, asynchronous front of a SummaryWriter.
+
+    add_scalar and add_histogram only record the (detached) values, and don't wait for the device.
+    With aggregate > 1, the values of each tag are collected over aggregate steps and written once at the
+    last step: scalars as their reductions (the mean under the tag itself, the others under tag/min, tag/max)
+    and histograms as the histogram of all their values.
+
+    The collected groups are handed to a background thread every flush_every groups (or flush_secs seconds),
+    which copies all the tensors of the batch to the cpu at once (a single sync per device) and writes them.
+    At most max_queue batches wait for the thread, after which the callers block. The thread also picks up
+    the complete groups by itself when nothing was handed to it for flush_secs, so they are written even
+    when no more values are added; incomplete aggregations are only written by flush and close.
+    A writer that isn't closed is closed when it is garbage-collected or at the interpreter exit.
+    """
+
+    def __init__(self, writer: T.Optional[SummaryWriter] = None,
+                 aggregate: int = 1,
+                 reductions: T.Sequence[str] = ('mean', 'min', 'max'),
+                 flush_every: int = 100,
+                 flush_secs: float = 10.,
+                 max_queue: int = 4,
+                 **kwargs):
+
+        if aggregate < 1:
+            raise ValueError(f"aggregate must be positive (given {aggregate})")
+
+        unknown = set(reductions) - set(_REDUCTIONS)
+        if unknown:
+            raise ValueError(f"Unknown reductions: {sorted(unknown)}")
+
+        self._metrics = _Metrics(writer=writer if writer is not None else SummaryWriter(**kwargs),
+                                 aggregate=aggregate,
+                                 reductions=tuple(reductions),
+                                 flush_every=flush_every,
+                                 flush_secs=flush_secs,
+                                 max_queue=max_queue)
+
+        # Refers to the metrics only. Called at most once: by close, on garbage collection or at exit
+        self._finalizer = weakref.finalize(self, self._metrics.close)
+
+    @property
+    def writer(self) -> SummaryWriter:
+        return self._metrics.writer
+
+    @property
+    def aggregate(self) -> int:
+        return self._metrics.aggregate
+
+    @property
+    def reductions(self) -> T.Tuple[str, ...]:
+        return self._metrics.reductions
+
+    @property
+    def flush_every(self) -> int:
+        return self._metrics.flush_every
+
+    @property
+    def flush_secs(self) -> float:
+        return self._metrics.flush_secs
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def add_scalar(self, tag: str, scalar_value, global_step=None, walltime=None):
+        self._metrics.add(SummaryType.SCALAR, tag, scalar_value, global_step, walltime)
+
+    def add_histogram(self, tag: str, values, global_step=None, walltime=None):
+        self._metrics.add(SummaryType.HISTOGRAM, tag, values, global_step, walltime)
+
+    def flush(self, wait=False):
+        """ Hands all the collected values (including incomplete aggregations) to the writing thread """
+        self._metrics.flush(wait=wait)
+
+    def close(self):
+        """ Writes the remaining values and stops the writing thread """
+        self._finalizer()
 
 
 class TensorBoardPersister(Persister):
+    """
+    Writes the values of sinks to TensorBoard. The writes go through a MetricsWriter, so saving doesn't wait
+    for the device or the disk (see MetricsWriter for aggregate, flush_every and flush_secs).
+    """
 
     def __init__(self, name: str, block: _Block, save_enabled=True,
-                 log_dir=None, *args, **kwargs):
+                 log_dir=None, aggregate=1, flush_every=100, flush_secs=10., *args, **kwargs):
         super(TensorBoardPersister, self).__init__(name=name, block=block, backend=None, final=False,
                                                    load_enabled=False, save_enabled=save_enabled)
-        self._writer = SummaryWriter(log_dir=log_dir, *args, **kwargs)
+        self._writer = MetricsWriter(SummaryWriter(log_dir=log_dir, *args, **kwargs),
+                                     aggregate=aggregate, flush_every=flush_every, flush_secs=flush_secs)
 
     def can_save(self, obj, *args, **kwargs):
         return super(TensorBoardPersister, self).can_save(obj, *args, **kwargs) and isinstance(obj, Sink)
@@ -36,13 +334,22 @@ class TensorBoardPersister(Persister):
         value = obj.get(session)
 
         summary_type = SummaryType[summary_type.upper()]
+        tag = join_not_none(self.block.separator, [self.get_obj_name(obj), tag])
 
         if summary_type is SummaryType.SCALAR:
-            tag = join_not_none(self.block.separator, [self.get_obj_name(obj), tag])
-            self._writer.add_scalar(tag=tag, scalar_value=value, *args, **kwargs)
+            self._writer.add_scalar(tag, value, *args, **kwargs)
+
+        elif summary_type is SummaryType.HISTOGRAM:
+            self._writer.add_histogram(tag, value, *args, **kwargs)
 
         else:
             raise NotImplementedError
 
     def load(self, obj: Sink, *args, **kwargs):
         raise NotImplementedError
+
+    def flush(self, wait=False):
+        self._writer.flush(wait=wait)
+
+    def close(self):
+        self._writer.close()
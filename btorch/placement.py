@@ -0,0 +1,197 @@
+from __future__ import annotations
+from blox_old.core.block.base import AtomicFunction, Block, BlockError
+from blox_old.btorch.module import TorchModule, torch_modules
+from blox_old.btorch.device import to_device
+from blox_old.utils import raise_if
+from more_itertools import prepend
+import typing as T
+import torch
+
+
+class PlacementError(BlockError):
+    pass
+
+
+def module_memory(module: TorchModule) -> int:
+    """ The memory (in bytes) taken by the parameters and buffers of the module """
+    tensors = list(module.module__.parameters()) + list(module.module__.buffers())
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+def module_cost(module: TorchModule) -> float:
+    """ A rough estimate of the compute of the module: the number of parameter elements (at least 1) """
+    return max(sum(param.numel() for param in module.module__.parameters()), 1)
+
+
+class Transfer(AtomicFunction):
+    """
+    Moves its input to a device.
+
+    By default it runs in the engine's thread pool, so that transfers overlap with the computation of
+    other blocks, and copies asynchronously (non_blocking) when the device allows it
+    """
+
+    def __init__(self, device, non_blocking=True, executor='thread', name=None, **kwargs):
+        super(Transfer, self).__init__(name=name, In=1, Out=1, executor=executor, **kwargs)
+        self.lock_ports = True
+        self.device = torch.device(device)
+        self.non_blocking = non_blocking
+
+    def fn(self, value):
+        return to_device(value, self.device, non_blocking=self.non_blocking)
+
+
+class Placement:
+    """
+    An assignment of TorchModule blocks to devices.
+
+    Devices are identified by their position in the list, so the same torch device may appear several
+    times (e.g. several 'cpu' entries simulate a multi-device setup, and transfers are still inserted
+    between them).
+    """
+
+    def __init__(self, devices: T.Sequence, assignment: T.Dict[TorchModule, int]):
+        self.devices = [torch.device(device) for device in devices]
+        self.assignment = assignment
+
+    def device_of(self, module: TorchModule) -> torch.device:
+        return self.devices[self.assignment[module]]
+
+    def modules_on(self, index: int) -> T.List[TorchModule]:
+        return [module for module, n in self.assignment.items() if n == index]
+
+    def memory(self, fn=module_memory) -> T.List[int]:
+        """ The memory taken on each device """
+        return [sum(map(fn, self.modules_on(n))) for n in range(len(self.devices))]
+
+    def load(self, fn=module_cost) -> T.List[float]:
+        """ The estimated compute on each device """
+        return [sum(map(fn, self.modules_on(n))) for n in range(len(self.devices))]
+
+    def apply(self, block: Block, threaded=False) -> T.List[Transfer]:
+        """
+        Moves the modules to their devices and inserts Transfer blocks on the links between devices.
+        With threaded, the torch modules run in the engine's thread pool, so that blocks on different
+        devices run concurrently. Returns the inserted transfers
+        """
+        for module, n in self.assignment.items():
+            module.to(self.devices[n])
+            if threaded:
+                module.executor = 'thread'
+
+        slots = self.__propagate_slots(block)
+        transfers = []
+
+        for consumer, slot in list(slots.items()):
+            # Blocks on the host only read host values (see __propagate_slots)
+            if slot is None:
+                continue
+
+            for port in list(consumer.In):
+                producer = _producer(port)
+                if producer is None:
+                    continue
+
+                source_slot = slots.get(producer.block)
+                if source_slot == slot or (source_slot is None and self.devices[slot].type == 'cpu'):
+                    continue
+
+                transfers.append(self.__insert_transfer(port, self.devices[slot]))
+
+        return transfers
+
+    def __propagate_slots(self, block: Block) -> T.Dict[Block, T.Optional[int]]:
+        """
+        Assigns a device to every atomic block. Blocks that aren't torch modules (e.g. Lambda or a loss
+        reading a target and a prediction) compute on the device of their first input that is on a device,
+        and on the host (None) if all of their inputs are (e.g. sources, with no inputs)
+        """
+        slots = {module: n for module, n in self.assignment.items()}
+
+        def slot_of(root: Block):
+            # Iterative (depth first), since chains of non-torch blocks may be long
+            stack = [root]
+            visiting = set()
+            while stack:
+                atomic = stack[-1]
+                if atomic in slots:
+                    stack.pop()
+                    continue
+
+                producers = [producer.block for producer in map(_producer, atomic.In) if producer is not None]
+                pending = [b for b in producers if b not in slots and b not in visiting]
+                if pending and atomic not in visiting:
+                    visiting.add(atomic)
+                    stack.extend(pending)
+                    continue
+
+                # The producers are resolved (or are part of a cycle)
+                slots[atomic] = next((slots[b] for b in producers if slots.get(b) is not None), None)
+                stack.pop()
+
+            return slots[root]
+
+        for node in prepend(block, block.blocks.descendants):
+            if isinstance(node, Block) and node.atomic:
+                slot_of(node)
+
+        return slots
+
+    @staticmethod
+    def __insert_transfer(port, device) -> Transfer:
+        upstream = port.upstream()
+        owner = port.upstream.port_graph__.block
+
+        transfer = Transfer(device=device, name=f'{port.block.name}_{port.name}_transfer')
+        transfer.parent = owner
+        transfer.In[0] = upstream
+        port.section[port.name] = transfer.Out()
+        return transfer
+
+
+def _producer(port):
+    """ The output port of the atomic block computing the port's value (None if it isn't connected) """
+    while port.upstream() is not None:
+        port = port.upstream()
+    return None if port.is_in else port
+
+
+def plan_placement(block: Block, devices: T.Sequence,
+                   memory_limits: T.Optional[T.Sequence[T.Optional[int]]] = None,
+                   cost_fn: T.Callable[[TorchModule], float] = module_cost,
+                   memory_fn: T.Callable[[TorchModule], int] = module_memory) -> Placement:
+    """
+    Splits the TorchModule blocks under the block into contiguous stages (in the order of the block tree),
+    one per device, of roughly equal estimated compute. Contiguous stages keep the links between devices
+    few, as in pipeline parallelism. A stage ends early when the device's memory limit would be exceeded.
+    """
+    raise_if(len(devices) == 0, PlacementError("No devices were given"))
+    memory_limits = list(memory_limits) if memory_limits is not None else [None] * len(devices)
+    raise_if(len(memory_limits) != len(devices),
+             PlacementError(f"Expected {len(devices)} memory limits, got {len(memory_limits)}"))
+
+    modules = torch_modules(block)
+    costs = [cost_fn(module) for module in modules]
+    target = sum(costs) / len(devices)
+
+    assignment = dict()
+    used = [0] * len(devices)
+    slot = 0
+    cumulative = 0.
+
+    for module, cost in zip(modules, costs):
+        memory = memory_fn(module)
+
+        # The stage that the middle of the module falls into (stages never go back)
+        if target > 0:
+            slot = max(slot, min(int((cumulative + cost / 2) // target), len(devices) - 1))
+
+        while memory_limits[slot] is not None and used[slot] + memory > memory_limits[slot]:
+            slot += 1
+            raise_if(slot == len(devices), PlacementError(f"The module {module} doesn't fit on any device"))
+
+        assignment[module] = slot
+        used[slot] += memory
+        cumulative += cost
+
+    return Placement(devices=devices, assignment=assignment)
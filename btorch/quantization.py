@@ -0,0 +1,213 @@
+from __future__ import annotations
+from blox_old.core.block.base import Block
+from blox_old.btorch.module import TorchModule, TorchModuleError, torch_modules, replace_blocks
+from blox_old.btorch.compile import CompiledGraph
+from blox_old.utils import raise_if
+from itertools import islice
+from torch import nn
+import typing as T
+import warnings
+import copy
+import time
+import torch
+
+
+class QuantizationError(TorchModuleError):
+    pass
+
+
+# The module types quantized by default
+DYNAMIC_TYPES = (nn.Linear, nn.LSTM, nn.GRU)
+STATIC_TYPES = (nn.Conv1d, nn.Conv2d, nn.Conv3d, nn.Linear)
+
+# Modules that run on quantized tensors as they are (besides those converted to quantized modules)
+_QUANTIZED_PASSTHROUGH = (nn.Identity, nn.ReLU, nn.ReLU6, nn.Dropout, nn.Flatten,
+                          nn.MaxPool1d, nn.MaxPool2d, nn.MaxPool3d, nn.AvgPool1d, nn.AvgPool2d, nn.AvgPool3d,
+                          nn.AdaptiveAvgPool1d, nn.AdaptiveAvgPool2d, nn.AdaptiveAvgPool3d)
+
+
+class QuantizedModule(TorchModule):
+    """ A quantized replacement of a TorchModule block (takes and returns float tensors) """
+
+    def __init__(self, module: nn.Module, name=None):
+        super(QuantizedModule, self).__init__(name=name, module=module, In=1, Out=1)
+        self.lock_ports = True
+
+
+def _contains(module: nn.Module, types) -> bool:
+    return any(isinstance(m, types) for m in module.modules())
+
+
+def _has_quantized_kernels(module: nn.Module, mappings) -> bool:
+    """
+    Whether every operation of the module runs on quantized tensors. Only (nested) nn.Sequential containers
+    are looked into, since the forward of other modules may use operations (e.g. add) without quantized kernels
+    """
+    if isinstance(module, nn.Sequential):
+        return all(_has_quantized_kernels(m, mappings) for m in module)
+    return type(module) in mappings or isinstance(module, _QUANTIZED_PASSTHROUGH)
+
+
+def _batches(source, num_batches):
+    """ Batches from a data source block (with fn(), e.g. AtomicDataLoader) or from an iterable """
+    if hasattr(source, 'fn') and callable(source.fn):
+        return (source.fn() for _ in range(num_batches))
+    return islice(iter(source), num_batches)
+
+
+def _default_input_fn(num_inputs):
+    def input_fn(batch):
+        # (inputs..., targets) as returned by most data loaders
+        if isinstance(batch, (tuple, list)):
+            return tuple(batch[:num_inputs])
+        return (batch, )
+    return input_fn
+
+
+def _graph(block: Block) -> CompiledGraph:
+    outputs = block.Out() if len(block.Out) == 1 else list(block.Out)
+    return CompiledGraph(outputs=outputs, inputs=list(block.In))
+
+
+def quantize(block: Block,
+             mode: str = 'dynamic',
+             calibration=None,
+             num_batches: int = 10,
+             input_fn: T.Optional[T.Callable] = None,
+             backend: str = 'x86',
+             dtype: torch.dtype = torch.qint8,
+             types: T.Optional[T.Tuple[type, ...]] = None,
+             strict: bool = False) -> Block:
+    """
+    Returns a copy of the block tree, in which the TorchModule blocks containing modules of the given types
+    are replaced with int8-quantized blocks. The ports of the copy are the same as those of the block.
+
+    Only blocks with a single input and a single output (and no port_map) are quantized. For static
+    quantization, so are only the blocks whose modules run entirely on quantized kernels (quantizable
+    modules and e.g. activations and pooling, possibly in nn.Sequential containers). The other blocks
+    containing modules of the given types are left in floating point with a warning, or, with strict,
+    a QuantizationError is raised before anything is quantized.
+
+    mode
+        'dynamic': weights are quantized ahead of time and activations on the fly (suits Linear and RNNs).
+        'static': activations are quantized too, with ranges observed on calibration data. Each block
+        quantizes its input and dequantizes its output, since blocks exchange float tensors.
+
+    calibration
+        For static quantization: a data source block (e.g. AtomicDataLoader, whose fn() returns batches)
+        or an iterable of batches, of which num_batches are evaluated. input_fn converts a batch to the
+        inputs of the block (by default the leading elements of tuple batches).
+
+    backend
+        The quantized engine (e.g. 'x86', 'fbgemm' or 'qnnpack' for ARM).
+    """
+    from torch.ao import quantization as tq
+
+    raise_if(mode not in ('dynamic', 'static'), QuantizationError(f"Unknown quantization mode {mode}"))
+    raise_if(mode == 'static' and calibration is None,
+             QuantizationError("Static quantization requires calibration data"))
+
+    if backend in torch.backends.quantized.supported_engines:
+        torch.backends.quantized.engine = backend
+
+    quantized = copy.deepcopy(block)
+    types = types or (DYNAMIC_TYPES if mode == 'dynamic' else STATIC_TYPES)
+    mappings = tq.get_default_static_quant_module_mappings()
+
+    targets, skipped = [], []
+    for module in torch_modules(quantized):
+        if not _contains(module.module__, types):
+            continue
+
+        if len(module.In) != 1 or len(module.Out) != 1 or module.port_map is not None:
+            skipped.append((module, "it has several ports"))
+        elif mode == 'static' and not _has_quantized_kernels(module.module__, mappings):
+            skipped.append((module, "some of its operations have no quantized kernels"))
+        else:
+            targets.append(module)
+
+    if skipped:
+        report = '; '.join(f"{module.full_name}: {reason}" for module, reason in skipped)
+        raise_if(strict, QuantizationError(f"Cannot quantize {report}"))
+        warnings.warn(f"Not quantized (left in floating point): {report}")
+
+    if mode == 'dynamic':
+        for target in targets:
+            # Quantization swaps child modules, so the module is wrapped (it may be e.g. an nn.Linear itself)
+            module = tq.quantize_dynamic(nn.Sequential(target.module__).eval(), qconfig_spec=set(types), dtype=dtype)
+            replace_blocks([target], QuantizedModule(module, name=target.name))
+        return quantized
+
+    # Static: observe the activations of every target while running the calibration data through the copy
+    prepared = dict()
+    for target in targets:
+        wrapper = nn.Sequential(tq.QuantStub(), target.module__, tq.DeQuantStub()).eval()
+        wrapper.qconfig = tq.get_default_qconfig(backend)
+        # Not in place: the prepared copy is called instead of the original module during calibration
+        prepared[target] = tq.prepare(wrapper)
+        target.module__.forward = prepared[target].forward
+
+    input_fn = input_fn or _default_input_fn(len(quantized.In))
+    graph = _graph(quantized)
+    with torch.no_grad():
+        for batch in _batches(calibration, num_batches):
+            graph(*input_fn(batch))
+
+    for target, observed in prepared.items():
+        del target.module__.forward
+        replace_blocks([target], QuantizedModule(tq.convert(observed), name=target.name))
+
+    return quantized
+
+
+def compare(original: Block, quantized: Block, data, num_batches: int = 10,
+            input_fn: T.Optional[T.Callable] = None) -> T.Dict[str, float]:
+    """
+    Evaluates both block trees on the same batches and reports their mean latency (seconds per batch),
+    the speedup, the maximal and mean absolute differences of the first output and, for outputs of
+    shape (batch, classes), the fraction of samples with the same top class
+    """
+    input_fn = input_fn or _default_input_fn(len(original.In))
+    graphs = [_graph(original), _graph(quantized)]
+
+    # The graphs hold the blocks' own modules, whose modes are restored afterwards
+    training = [(module, module.training) for graph in graphs for module in graph.modules()]
+    for graph in graphs:
+        graph.eval()
+
+    times = [0., 0.]
+    max_error, error_sum, elements, agree, samples, batches = 0., 0., 0, 0, 0, 0
+
+    try:
+        with torch.inference_mode():
+            for batch in _batches(data, num_batches):
+                inputs = input_fn(batch)
+                outputs = []
+                for n, graph in enumerate(graphs):
+                    start = time.perf_counter()
+                    output = graph(*inputs)
+                    times[n] += time.perf_counter() - start
+                    outputs.append(output[0] if isinstance(output, tuple) else output)
+
+                expected, actual = (output.float() for output in outputs)
+                difference = (actual - expected).abs()
+                max_error = max(max_error, difference.max().item())
+                error_sum += difference.sum().item()
+                elements += difference.numel()
+
+                if expected.dim() == 2:
+                    agree += (expected.argmax(dim=1) == actual.argmax(dim=1)).sum().item()
+                    samples += expected.shape[0]
+                batches += 1
+    finally:
+        for module, mode in training:
+            module.train(mode)
+
+    raise_if(batches == 0, QuantizationError("No batches were evaluated"))
+
+    return dict(original_latency=times[0] / batches,
+                quantized_latency=times[1] / batches,
+                speedup=times[0] / max(times[1], 1e-12),
+                max_abs_error=max_error,
+                mean_abs_error=error_sum / max(elements, 1),
+                top1_agreement=agree / samples if samples else float('nan'))
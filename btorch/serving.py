@@ -0,0 +1,55 @@
+from blox.api.batching import BatchingMap
+from blox_old.btorch.device import to_device
+from torch import nn
+import torch
+import typing as T
+
+
+def stack(samples: T.List[torch.Tensor]) -> torch.Tensor:
+    return torch.stack([torch.as_tensor(sample) for sample in samples])
+
+
+def unbind(batch: torch.Tensor, size: int) -> T.List[torch.Tensor]:
+    samples = list(torch.unbind(batch))
+    if len(samples) != size:
+        raise ValueError(f"Expected a batched result of {size} samples, got {len(samples)}")
+    return samples
+
+
+class TorchBatchingServer(BatchingMap):
+    """
+    Serves a btorch graph (or any torch module) to single-sample requests with dynamic batching
+    (see BatchingMap).
+
+    The samples are stacked to batches (optionally moved to a device), the model is evaluated once
+    under torch.inference_mode() in eval mode, and the outputs are unbound back to the samples.
+    The model is either a torch module (e.g. a graph compiled with btorch.compile) or a block,
+    which is evaluated with its map() method.
+    """
+
+    def __init__(self, model, max_batch_size=32, max_latency=0.005, device=None, num_outputs=1, **kwargs):
+        fn = model if isinstance(model, nn.Module) else model.map
+        kwargs.setdefault('collate', stack)
+        kwargs.setdefault('split', unbind)
+        super(TorchBatchingServer, self).__init__(fn, max_batch_size=max_batch_size, max_latency=max_latency,
+                                                  **kwargs)
+
+        self.model = model
+        self.num_outputs = num_outputs
+        self.device = None if device is None else torch.device(device)
+
+        if isinstance(model, nn.Module):
+            model.eval()
+        elif hasattr(model, 'blocks'):
+            from blox_old.btorch.module import set_mode
+            set_mode(model, train=False)
+
+    def _run(self, *inputs):
+        if self.device is not None:
+            inputs = to_device(inputs, self.device, non_blocking=True)
+
+        with torch.inference_mode():
+            result = super(TorchBatchingServer, self)._run(*inputs)
+
+        # The samples are returned on the cpu, as they were given
+        return to_device(result, 'cpu') if self.device is not None else result
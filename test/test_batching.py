@@ -0,0 +1,108 @@
+import unittest
+import threading
+from blox.core.compute import Computable, AtomicFunction
+from blox.api.batching import BatchingMap
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class Double(AtomicFunction):
+
+    calls = 0
+
+    def __init__(self, name=None):
+        super(Double, self).__init__(name=name, In='in', Out='out')
+
+    def callback(self, ports, meta, params):
+        Double.calls += 1
+        return ports[self.In()] * 2
+
+
+@unittest.skipIf(np is None, 'numpy is not installed')
+class TestBatchingMap(unittest.TestCase):
+
+    def setUp(self):
+        Double.calls = 0
+        self.world = Computable(name='world', In='x', Out='y')
+        self.world.Out['y'] = Double(name='double')(self.world.In['x'])
+
+    def test_single(self):
+        with BatchingMap(self.world, max_latency=0.) as fn:
+            self.assertTrue(np.array_equal(fn(np.arange(3)), [0, 2, 4]))
+
+    def test_concurrent_requests_are_batched(self):
+        results = dict()
+        barrier = threading.Barrier(8)
+
+        with BatchingMap(self.world, max_batch_size=4, max_latency=0.5) as fn:
+            def request(n):
+                barrier.wait()
+                results[n] = fn(np.full(2, n))
+
+            threads = [threading.Thread(target=request, args=(n, )) for n in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            stats = fn.stats()
+
+        for n in range(8):
+            self.assertTrue(np.array_equal(results[n], [2 * n, 2 * n]))
+
+        self.assertEqual(stats['samples'], 8)
+        self.assertEqual(stats['batches'], Double.calls)
+        self.assertLess(Double.calls, 8)
+        self.assertLessEqual(max(record.size for record in fn.records), 4)
+
+    def test_close_flushes_queued_requests(self):
+        fn = BatchingMap(self.world, max_batch_size=16, max_latency=10.)
+        futures = [fn.submit(np.array(n)) for n in range(3)]
+        fn.close()
+
+        self.assertListEqual([int(future.result()) for future in futures], [0, 2, 4])
+        self.assertEqual(Double.calls, 1)
+        with self.assertRaises(RuntimeError):
+            fn.submit(np.array(0))
+
+    def test_errors_reach_every_request(self):
+        def fail(batch):
+            raise ValueError('bad batch')
+
+        with BatchingMap(fail, max_batch_size=2, max_latency=10.) as fn:
+            futures = [fn.submit(n) for n in range(2)]
+            for future in futures:
+                with self.assertRaises(ValueError):
+                    future.result()
+
+    def test_function_with_several_inputs(self):
+        with BatchingMap(lambda a, b: a + b, max_latency=0.) as fn:
+            self.assertEqual(fn(1, 2), 3)
+
+    def test_cancelled_requests_are_dropped(self):
+        fn = BatchingMap(self.world, max_batch_size=16, max_latency=0.2)
+        futures = [fn.submit(np.array(n)) for n in range(3)]
+        self.assertTrue(futures[1].cancel())
+
+        self.assertEqual(int(futures[2].result(timeout=2)), 4)
+        self.assertEqual(int(fn(np.array(5))), 10)
+        self.assertTrue(futures[1].cancelled())
+        fn.close()
+
+    def test_unexpected_errors_fail_pending_requests(self):
+        fn = BatchingMap(lambda x: x, max_latency=0.)
+
+        def fail():
+            raise RuntimeError('broken queue')
+
+        fn._next_batch = fail
+        future = fn.submit(1)
+        with self.assertRaises(RuntimeError):
+            future.result(timeout=2)
+        fn._thread.join(timeout=2)
+
+        with self.assertRaises(RuntimeError):
+            fn.submit(2)
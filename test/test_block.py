@@ -1,5 +1,6 @@
 import unittest
 from blox.core.block import Block
+from blox.core.port import Port
 from blox.etc.errors import NameCollisionError
 
 
@@ -78,3 +79,50 @@ class TestBlockRename(unittest.TestCase):
         self.z.name = 'new_name'
         with self.assertRaises(NameCollisionError):
             self.y.parent = self.x
+
+
+class TaggedPort(Port):
+    """ A port subclass with an instance __dict__ """
+
+
+class TestBlockLayout(unittest.TestCase):
+
+    def test_no_instance_dict(self):
+        from blox.core.special import Const
+        x = Const(1)
+        self.assertFalse(hasattr(x, '__dict__'))
+        self.assertFalse(hasattr(x.Out['out'], '__dict__'))
+
+    def test_lazy_tables(self):
+        x = Block()
+        self.assertIsNone(x._children)
+        self.assertIsNone(x._meta)
+        self.assertEqual(len(x.blocks), 0)
+        self.assertIsNone(x._children)
+
+        x.blocks['y'] = y = Block()
+        self.assertListEqual(list(x.blocks), [y])
+        del x.blocks['y']
+        self.assertIsNone(x._children)
+
+    def test_pickle(self):
+        import pickle
+        x = Block(In='a', Out='b')
+        x.blocks['y'] = Block(In='a', Out='b')
+        x.meta['key'] = 'value'
+        x.Out['b'] = x['y'](x.In['a'])
+
+        x = pickle.loads(pickle.dumps(x))
+        self.assertEqual(x.meta['key'], 'value')
+        self.assertIs(x.Out['b'].upstream, x['y'].Out['b'])
+        self.assertIn(x['y'].In['a'], x.In['a'].downstream)
+
+    def test_pickle_port_subclass(self):
+        import copy
+        import pickle
+
+        port = TaggedPort('p')
+        port.label = 'label'
+        for clone in (pickle.loads(pickle.dumps(port)), copy.copy(port), copy.deepcopy(port)):
+            self.assertEqual(clone.label, 'label')
+            self.assertEqual(clone.name, 'p')
@@ -0,0 +1,137 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from blox.core.compute import Computable, AtomicFunction
+from blox.core.state import State
+from blox.core.cache import ResultCache
+
+
+class Square(AtomicFunction):
+
+    cacheable = True
+    calls = 0
+
+    def __init__(self, name=None, offset=0):
+        super(Square, self).__init__(name=name, In='in', Out='out')
+        self.offset = offset
+
+    def callback(self, ports, meta, params):
+        Square.calls += 1
+        return ports[self.In()] ** 2 + self.offset + params.get('shift', 0)
+
+
+def _offset():
+    return 1
+
+
+class Helped(AtomicFunction):
+
+    cacheable = True
+
+    def callback(self, ports, meta, params):
+        return self.helper()
+
+    def helper(self):
+        return _offset()
+
+
+class HelpedChanged(Helped):
+
+    def helper(self):
+        return _offset() + 1
+
+
+class ModuleHelperChanged(Helped):
+
+    def helper(self):
+        return _offset2()
+
+
+def _offset2():
+    return 2
+
+
+class TestResultCache(unittest.TestCase):
+
+    def setUp(self):
+        Square.calls = 0
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cache = ResultCache(self.temp_dir.name)
+
+        self.world = Computable(name='world', In='x', Out='y')
+        self.world['first'] = Square(name='first')
+        self.world['second'] = Square(name='second')
+        self.world.Out['y'] = self.world['second'](self.world['first'](self.world.In['x']))
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def run_world(self, x=2, cache=None):
+        state = State()
+        state.cache = cache if cache is not None else ResultCache(self.temp_dir.name)
+        state[self.world.In['x']] = x
+        return state(self.world.Out['y'])
+
+    def test_reuse_across_states(self):
+        self.assertEqual(self.run_world(), 16)
+        self.assertEqual(self.run_world(), 16)
+        self.assertEqual(Square.calls, 2)
+
+    def test_inputs_change(self):
+        self.run_world(x=2)
+        self.assertEqual(self.run_world(x=3), 81)
+        self.assertEqual(Square.calls, 4)
+
+    def test_downstream_change(self):
+        self.run_world()
+        self.world['second'].offset = 1
+        self.assertEqual(self.run_world(), 17)
+        self.assertEqual(Square.calls, 3)
+
+    def test_params(self):
+        self.run_world()
+        state = State()
+        state.cache = self.cache
+        state[self.world.In['x']] = 2
+        state[self.world['first']].params['shift'] = 1
+        self.assertEqual(state(self.world.Out['y']), 25)
+        self.assertEqual(Square.calls, 4)
+
+    def test_eviction(self):
+        cache = ResultCache(self.temp_dir.name, max_size=0)
+        self.run_world(cache=cache)
+        self.assertEqual(len(list(cache._entries())), 0)
+
+        self.run_world()
+        self.assertEqual(Square.calls, 4)
+
+    def test_replaced_entries_are_counted_once(self):
+        cache = ResultCache(self.temp_dir.name, max_size=1 << 20)
+        cache.put('key', (1, ))
+        for _ in range(3):
+            cache.put('key', (2, ))
+        self.assertEqual(cache._size, sum(size for _, size, _ in cache._entries()))
+
+    def test_key_digest(self):
+        self.assertNotEqual(self.cache.digest(1), self.cache.digest(1.0))
+        self.assertEqual(self.cache.digest({'a': [1, 2]}), self.cache.digest({'a': [1, 2]}))
+
+    def test_code_digest_covers_methods(self):
+        digests = {self.cache._code_digest(cls) for cls in (Helped, HelpedChanged, ModuleHelperChanged)}
+        self.assertEqual(len(digests), 3)
+
+    def test_sets_and_dicts_are_canonical(self):
+        self.assertEqual(self.cache.digest({'a', 'b', 'c'}), self.cache.digest({'c', 'b', 'a'}))
+        self.assertEqual(self.cache.digest({'a': 1, 'b': 2}), self.cache.digest({'b': 2, 'a': 1}))
+        self.assertNotEqual(self.cache.digest({'a': 1}), self.cache.digest({'a': 2}))
+
+        # The iteration order of sets of strings depends on the hash seed
+        script = ('from blox.core.cache import ResultCache; import sys; '
+                  'print(ResultCache(sys.argv[1]).digest({"x", "y", "z", "w"}).hex())')
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        digests = {subprocess.run([sys.executable, '-c', script, self.temp_dir.name], capture_output=True, text=True,
+                                  check=True, cwd=root, env=dict(os.environ, PYTHONHASHSEED=str(seed))).stdout
+                   for seed in range(4)}
+        self.assertEqual(len(digests), 1)
@@ -0,0 +1,66 @@
+import unittest
+from blox.core.compute import Computable, Function, AtomicFunction
+from blox.core.state import State
+
+
+class Count(AtomicFunction):
+    """ Adds one to its input and counts its calls """
+
+    def __init__(self, name=None):
+        super(Count, self).__init__(name=name, In='in', Out='out')
+        self.calls = 0
+
+    def callback(self, ports, meta, params):
+        self.calls += 1
+        return ports[self.In()] + 1
+
+
+class TwoHeads(Function):
+    """ A trunk feeding two heads. The second head also reads the second input """
+
+    def __init__(self, name=None):
+        super(TwoHeads, self).__init__(name=name, In=('x', 'y'), Out=('head1', 'head2'))
+        self.trunk = Count(name='trunk')
+        self.head1 = Count(name='head1')
+        self.head2 = Count(name='head2')
+
+        trunk = self.trunk(self.In['x'])
+        self.Out['head1'] = self.head1(trunk)
+        self.Out['head2'] = self.head2(trunk) + self.In['y']
+
+
+class TestDependencyCone(unittest.TestCase):
+
+    def setUp(self):
+        self.world = Computable(name='world', In=('x', 'y'), Out=('head1', 'head2'))
+        self.world['model'] = self.model = TwoHeads()
+        self.world.Out['*'] = self.model(*self.world.In())
+
+        self.state = State()
+        self.state[self.world.In['x']] = 1
+
+    def test_cone(self):
+        cone = self.model.dependency_cone([self.model.Out['head1']])
+        self.assertTupleEqual(cone.inputs, (self.model.In['x'], ))
+        self.assertListEqual([child for child, _ in cone.children], [self.model.trunk, self.model.head1])
+
+    def test_pull_single_head(self):
+        # The second input is not set, so pulling the second head would fail
+        self.assertEqual(self.state(self.world.Out['head1']), 3)
+        self.assertEqual(self.model.trunk.calls, 1)
+        self.assertEqual(self.model.head1.calls, 1)
+        self.assertEqual(self.model.head2.calls, 0)
+
+    def test_pull_both_heads(self):
+        self.state[self.world.In['y']] = 10
+        self.assertEqual(self.state(self.world.Out['head1']), 3)
+        self.assertEqual(self.state(self.world.Out['head2']), 13)
+        self.assertEqual(self.model.trunk.calls, 1)
+        self.assertEqual(self.model.head2.calls, 1)
+
+    def test_cone_reset_on_link_change(self):
+        self.model.dependency_cone([self.model.Out['head1']])
+        self.model.Out['head1'] = self.model.In['x']
+        cone = self.model.dependency_cone([self.model.Out['head1']])
+        self.assertTupleEqual(cone.children, ())
+        self.assertEqual(self.state(self.world.Out['head1']), 1)
@@ -0,0 +1,37 @@
+import os
+import re
+import subprocess
+import sys
+import unittest
+
+# Generous, so that a slow machine doesn't fail the test. The import usually takes well under 100 ms.
+IMPORT_TIME_BUDGET = 1.0
+
+# These are loaded only when needed (e.g. networkx when a composite block is first computed)
+DEFERRED_MODULES = ('networkx', 'scalpl', 'events', 'more_itertools', 'boltons', 'numpy')
+
+
+def import_times(statement):
+    """ Runs the statement in a fresh interpreter and returns the cumulative import times (in seconds) """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=root)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement],
+                            cwd=root, env=env, capture_output=True, text=True, check=True)
+
+    times = dict()
+    for line in result.stderr.splitlines():
+        match = re.match(r'import time:\s*(\d+) \|\s*(\d+) \| (\s*)(\S+)', line)
+        if match:
+            times[match.group(4)] = int(match.group(2)) / 1e6
+    return times
+
+
+class TestImportTime(unittest.TestCase):
+
+    def test_import(self):
+        times = import_times('import blox.core.compute, blox.core.state, blox.api.map')
+
+        for module in times:
+            self.assertNotIn(module.split('.')[0], DEFERRED_MODULES)
+
+        self.assertLess(times['blox.core.compute'], IMPORT_TIME_BUDGET)
@@ -0,0 +1,126 @@
+import unittest
+from blox.core.compute import Computable
+from blox.core.state import State
+
+try:
+    import numpy as np
+    from blox.core.numeric import numpy_operators, NumpyBinaryOperator, NumpyDivmod, Reduce, Where, Clip, Cast
+except ImportError:
+    np = None
+
+
+@unittest.skipIf(np is None, 'numpy is not installed')
+class TestNumpyOperators(unittest.TestCase):
+
+    def setUp(self):
+        self.world = Computable(name='world', In=('a', 'b'), Out='c')
+        self.state = State()
+        self.state[self.world.In['a']] = np.arange(6, dtype=np.float32).reshape(2, 3)
+        self.state[self.world.In['b']] = np.ones(3, dtype=np.float32)
+
+    def test_port_syntax(self):
+        a, b = self.world.In()
+        with numpy_operators():
+            self.world.Out['c'] = -(a * b) + 1
+
+        self.assertIsInstance(self.world['mul'], NumpyBinaryOperator)
+        result = self.state(self.world.Out['c'])
+        self.assertTrue(np.array_equal(result, 1 - np.arange(6).reshape(2, 3)))
+        self.assertEqual(result.dtype, np.float32)
+
+    def test_reduce(self):
+        self.world.Out['c'] = Reduce('sum', axis=1, dtype=np.float64)(self.world.In['a'])
+        result = self.state(self.world.Out['c'])
+        self.assertTrue(np.array_equal(result, [3., 12.]))
+        self.assertEqual(result.dtype, np.float64)
+
+    def test_where(self):
+        a, b = self.world.In()
+        self.world.Out['c'] = Where()(NumpyBinaryOperator('greater')(a, b), a, b)
+        result = self.state(self.world.Out['c'])
+        self.assertTrue(np.array_equal(result, [[1, 1, 2], [3, 4, 5]]))
+
+    def test_clip_and_cast(self):
+        self.world.Out['c'] = Cast(np.int8)(Clip(a_min=1, a_max=4)(self.world.In['a']))
+        result = self.state(self.world.Out['c'])
+        self.assertTrue(np.array_equal(result, [[1, 1, 2], [3, 4, 4]]))
+        self.assertEqual(result.dtype, np.int8)
+
+    def test_preallocate(self):
+        op = NumpyBinaryOperator('add', preallocate=True)
+        self.world.Out['c'] = op(*self.world.In())
+
+        first = self.state(self.world.Out['c'])
+        state = State()
+        state[self.world.In['a']] = np.zeros((2, 3), dtype=np.float32)
+        state[self.world.In['b']] = np.zeros(3, dtype=np.float32)
+        second = state(self.world.Out['c'])
+
+        self.assertIs(first, second)
+        self.assertTrue(np.array_equal(second, np.zeros((2, 3))))
+
+    def test_inplace(self):
+        a = self.state[self.world.In['a']]
+        self.world.Out['c'] = NumpyBinaryOperator('add', inplace=True)(*self.world.In())
+        self.assertIs(self.state(self.world.Out['c']), a)
+
+    def test_inplace_reduce(self):
+        a = self.state[self.world.In['a']].copy()
+        self.world.Out['c'] = Reduce('sum', axis=1, inplace=True)(self.world.In['a'])
+        result = self.state(self.world.Out['c'])
+        self.assertTrue(np.array_equal(result, [3., 12.]))
+        self.assertTrue(np.array_equal(self.state[self.world.In['a']], a))
+
+    def test_inplace_matmul(self):
+        self.state[self.world.In['b']] = np.ones((3, 4), dtype=np.float32)
+        self.world.Out['c'] = NumpyBinaryOperator('matmul', inplace=True)(*self.world.In())
+        result = self.state(self.world.Out['c'])
+        self.assertEqual(result.shape, (2, 4))
+        self.assertTrue(np.array_equal(result[:, 0], [3., 12.]))
+
+    def test_inplace_comparison(self):
+        a = self.state[self.world.In['a']].copy()
+        self.world.Out['c'] = NumpyBinaryOperator('less', inplace=True)(*self.world.In())
+        result = self.state(self.world.Out['c'])
+        self.assertEqual(result.dtype, np.bool_)
+        self.assertTrue(np.array_equal(result, a < 1))
+        self.assertTrue(np.array_equal(self.state[self.world.In['a']], a))
+
+    def test_inplace_scalar(self):
+        a = self.state[self.world.In['a']]
+        with numpy_operators():
+            self.world.Out['c'] = self.world.In['a'] * 2.5
+        self.world['mul'].inplace = True
+        self.assertIs(self.state(self.world.Out['c']), a)
+
+    def test_divmod_port_syntax(self):
+        a, b = self.world.In()
+        with numpy_operators():
+            quotient, remainder = divmod(a, b + 1)
+        self.assertIsInstance(self.world['divmod'], NumpyDivmod)
+
+        self.world.Out['c'] = remainder
+        result = self.state(self.world.Out['c'])
+        self.assertTrue(np.array_equal(result, np.arange(6).reshape(2, 3) % 2))
+
+    def test_divmod_inplace(self):
+        a = self.state[self.world.In['a']]
+        self.state[self.world.In['b']] = np.full(3, 4, dtype=np.float32)
+        quotient, remainder = NumpyDivmod(inplace=True)(*self.world.In())
+        self.world.Out['c'] = remainder
+        result = self.state(self.world.Out['c'])
+        self.assertTrue(np.array_equal(result, np.arange(6).reshape(2, 3) % 4))
+        self.assertTrue(np.array_equal(a, np.arange(6).reshape(2, 3) // 4))
+
+    def test_divmod_preallocate(self):
+        quotient, remainder = NumpyDivmod(preallocate=True)(*self.world.In())
+        self.world.Out['c'] = remainder
+        first = self.state(self.world.Out['c'])
+
+        state = State()
+        state[self.world.In['a']] = np.full((2, 3), 3, dtype=np.float32)
+        state[self.world.In['b']] = np.full(3, 2, dtype=np.float32)
+        second = state(self.world.Out['c'])
+
+        self.assertIs(first, second)
+        self.assertTrue(np.array_equal(second, np.ones((2, 3))))
@@ -0,0 +1,143 @@
+import gc
+import os
+import tempfile
+import unittest
+from blox.core.compute import Computable, AtomicFunction
+from blox.core.serializers import PickleSerializer
+from blox.core.spill import SpillingState, SpilledValue
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class CountingSerializer(PickleSerializer):
+
+    def __init__(self):
+        super(CountingSerializer, self).__init__()
+        self.dumps = 0
+
+    def dump(self, value, path):
+        self.dumps += 1
+        super(CountingSerializer, self).dump(value, path)
+
+
+class Concat(AtomicFunction):
+    """ Concatenates its input with itself """
+
+    def __init__(self, name=None):
+        super(Concat, self).__init__(name=name, In='in', Out='out')
+
+    def callback(self, ports, meta, params):
+        x = ports[self.In()]
+        return x + x
+
+
+class TestSpillingState(unittest.TestCase):
+
+    def setUp(self):
+        self.world = Computable(name='world', In='x', Out='y')
+        y = self.world.In['x']
+        for n in range(4):
+            y = Concat(name=f'concat{n}')(y)
+        self.world.Out['y'] = y
+
+        self.serializer = CountingSerializer()
+
+    def test_budget(self):
+        state = SpillingState(memory_budget=2000, serializers=[self.serializer], min_size=100)
+        state[self.world.In['x']] = b'a' * 500
+
+        self.assertEqual(state(self.world.Out['y']), b'a' * 8000)
+        self.assertLessEqual(state.memory_used, 2000)
+        self.assertGreater(self.serializer.dumps, 0)
+        self.assertIsInstance(state.peek(self.world.Out['y']), SpilledValue)
+        self.assertEqual(state[self.world.Out['y']], b'a' * 8000)
+
+    def test_small_values_are_not_spilled(self):
+        state = SpillingState(memory_budget=0, serializers=[self.serializer], min_size=1 << 20)
+        state[self.world.In['x']] = b'a'
+        self.assertEqual(state(self.world.Out['y']), b'a' * 16)
+        self.assertEqual(self.serializer.dumps, 0)
+        self.assertEqual(state.memory_used, 0)
+
+    def test_files_are_removed(self):
+        with tempfile.TemporaryDirectory() as directory:
+            state = SpillingState(memory_budget=0, directory=directory, min_size=0)
+            state[self.world.In['x']] = b'a' * 100
+            self.assertEqual(len(os.listdir(directory)), 1)
+
+            del state[self.world.In['x']]
+            self.assertEqual(len(os.listdir(directory)), 0)
+
+    @unittest.skipIf(np is None, 'numpy is not installed')
+    def test_numpy(self):
+        state = SpillingState(memory_budget=1 << 12, min_size=0)
+        state[self.world.In['x']] = np.ones((64, 64))
+
+        y = state(self.world.Out['y'])
+        self.assertTrue(np.array_equal(y, 16 * np.ones((64, 64))))
+        self.assertTrue(state.peek(self.world.Out['y']).path.endswith('.npy'))
+
+    def test_shared_values_counted_once(self):
+        state = SpillingState(memory_budget=1 << 20, serializers=[self.serializer], min_size=100)
+        value = b'a' * 500
+        state[self.world.In['x']] = value
+        state[self.world.Out['y']] = value
+        self.assertEqual(state.memory_used, state._spiller._entries[id(value)].size)
+
+        del state[self.world.In['x']]
+        self.assertGreater(state.memory_used, 0)
+        del state[self.world.Out['y']]
+        self.assertEqual(state.memory_used, 0)
+
+    def test_spilled_for_every_port(self):
+        state = SpillingState(memory_budget=1000, serializers=[self.serializer], min_size=100)
+        other = Computable(name='other', In='z')
+        value = b'a' * 800
+        state[self.world.In['x']] = value
+        state[self.world.Out['y']] = value
+        state[other.In['z']] = b'b' * 800
+
+        self.assertEqual(self.serializer.dumps, 1)
+        self.assertIs(state.peek(self.world.In['x']), state.peek(self.world.Out['y']))
+        self.assertEqual(state[self.world.In['x']], value)
+
+    def test_fork(self):
+        state = SpillingState(memory_budget=2000, serializers=[self.serializer], min_size=100)
+        state[self.world.In['x']] = b'a' * 500
+        state['step'] = 1
+        state(self.world.Out['y'])
+        dumps = self.serializer.dumps
+
+        child = state.fork()
+        self.assertIsInstance(child, SpillingState)
+        self.assertEqual(child[self.world.Out['y']], b'a' * 8000)
+        self.assertEqual(child['step'], 1)
+        self.assertEqual(self.serializer.dumps, dumps)
+
+        child[self.world.In['x']] = b'b'
+        child['step'] = 2
+        self.assertEqual(state[self.world.In['x']], b'a' * 500)
+        self.assertEqual(state['step'], 1)
+        self.assertLessEqual(child.memory_used, 2000)
+
+    def test_fork_outlives_parent(self):
+        state = SpillingState(memory_budget=0, serializers=[self.serializer], min_size=0)
+        state[self.world.In['x']] = b'a' * 500
+        state(self.world.Out['y'])
+        ports = [self.world.In['x'], self.world.Out['y']]
+        expected = {port: state[port] for port in ports}
+        path = state.peek(self.world.Out['y']).path
+
+        child = state.fork()
+        del state
+        gc.collect()
+
+        for port in ports:
+            self.assertEqual(child[port], expected[port])
+
+        del child
+        gc.collect()
+        self.assertFalse(os.path.exists(os.path.dirname(path)))
@@ -0,0 +1,272 @@
+import os
+import tempfile
+import unittest
+from concurrent.futures import Future
+from blox.core.compute import Computable, AtomicFunction
+from blox.core.state import State, XPathState, LazyValue
+from blox.core.columnar import ColumnarXPathState, Missing
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+class TestColumnarXPathState(unittest.TestCase):
+
+    def setUp(self):
+        self.world = Computable(name='world', In=('a', 'b'), Out='c')
+        self.world.Out['c'] = self.world.In['a'] + self.world.In['b']
+
+        self.states = []
+        for n in range(3):
+            state = State()
+            state[self.world.In['a']] = n
+            state[self.world.In['b']] = 10 * n
+            state.meta['step'] = n
+            state[self.world['add']].params['scale'] = 0.5 * n
+            state(self.world.Out['c'])
+            self.states.append(state)
+
+    def test_shared_schema(self):
+        columnar = ColumnarXPathState.from_states(self.states, self.world)
+        self.assertEqual(len(columnar), 3)
+        self.assertEqual(len(columnar.keys), len(set(columnar.keys)))
+        self.assertListEqual(columnar.column('Out:c'), [0, 11, 22])
+        self.assertListEqual(columnar.column('@meta/step'), [0, 1, 2])
+        self.assertListEqual(columnar.column('add/scale'), [0., 0.5, 1.])
+
+    def test_round_trip(self):
+        columnar = ColumnarXPathState.from_states(self.states, self.world)
+        for state, restored in zip(self.states, columnar.to_states(self.world)):
+            self.assertEqual(restored.state_id, state.state_id)
+            self.assertEqual(restored[self.world.Out['c']], state[self.world.Out['c']])
+            self.assertEqual(restored['step'], state['step'])
+            self.assertEqual(restored[self.world['add']].params['scale'],
+                             state[self.world['add']].params['scale'])
+
+    def test_missing_keys(self):
+        columnar = ColumnarXPathState()
+        columnar.append(XPathState(x=1))
+        columnar.append(XPathState(y=2))
+        self.assertListEqual(columnar.column('x'), [1, Missing])
+        self.assertListEqual(columnar.column('y'), [Missing, 2])
+        self.assertDictEqual(dict(columnar[1]), {'y': 2})
+
+    @unittest.skipIf(np is None, 'numpy is not installed')
+    def test_npz(self):
+        columnar = ColumnarXPathState.from_states(self.states, self.world)
+        columnar.append(XPathState(image=np.zeros((2, 2)), label='cat'))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'states.npz')
+            columnar.save_npz(path)
+            loaded = ColumnarXPathState.load_npz(path)
+
+        self.assertTupleEqual(loaded.keys, columnar.keys)
+        self.assertTupleEqual(loaded.state_ids, columnar.state_ids)
+        self.assertListEqual(loaded.column('Out:c'), [0, 11, 22, Missing])
+        self.assertListEqual(loaded.column('label'), [Missing, Missing, Missing, 'cat'])
+        self.assertTrue(np.array_equal(loaded.column('image')[3], np.zeros((2, 2))))
+
+    @unittest.skipIf(np is None, 'numpy is not installed')
+    def test_npz_native_columns(self):
+        columnar = ColumnarXPathState.from_xpath_states(XPathState(x=np.full(3, n)) for n in range(4))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'states.npz')
+            columnar.save_npz(path)
+            with np.load(path) as arrays:
+                self.assertTupleEqual(arrays['col0'].shape, (4, 3))
+
+    @unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_parquet(self):
+        columnar = ColumnarXPathState.from_states(self.states, self.world)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'states.parquet')
+            columnar.save_parquet(path)
+            loaded = ColumnarXPathState.load_parquet(path)
+
+        self.assertTupleEqual(loaded.keys, columnar.keys)
+        self.assertDictEqual(loaded.columns(), columnar.columns())
+
+
+class TestStateAccessors(unittest.TestCase):
+
+    def setUp(self):
+        self.world = Computable(name='world', In='a', Out='b')
+        self.state = State()
+
+    def test_port_accessors(self):
+        port = self.world.In['a']
+        self.assertFalse(self.state.has_port(port))
+
+        self.state.set_port(port, 1)
+        self.assertTrue(self.state.has_port(port))
+        self.assertEqual(self.state.get_port(port), 1)
+        self.assertEqual(self.state[port], 1)
+
+        self.state.del_port(port)
+        self.assertFalse(port in self.state)
+
+    def test_has_port_does_not_create_block_states(self):
+        self.state.has_port(self.world.In['a'])
+        self.assertEqual(len(self.state._block_states), 0)
+
+    def test_set_meta(self):
+        self.state['step'] = 3
+        self.assertEqual(self.state['step'], 3)
+        self.assertEqual(self.state.meta['step'], 3)
+
+
+class TestStateFork(unittest.TestCase):
+
+    def setUp(self):
+        self.world = Computable(name='world', In=('a', 'b'), Out='c')
+        self.world.Out['c'] = self.world.In['a'] + self.world.In['b']
+        self.a, self.b = self.world.In()
+
+        self.state = State()
+        self.state[self.a] = 1
+        self.state[self.b] = 2
+        self.state['step'] = 0
+        self.state(self.world.Out['c'])
+
+    def test_shared_values(self):
+        child = self.state.fork()
+        self.assertNotEqual(child.state_id, self.state.state_id)
+        self.assertEqual(child[self.world.Out['c']], 3)
+        self.assertEqual(child['step'], 0)
+        self.assertSetEqual(set(child.ports()), set(self.state.ports()))
+
+    def test_copy_on_write(self):
+        base = State()
+        base[self.a] = 1
+        child = base.fork()
+        child[self.b] = 10
+        self.assertEqual(child(self.world.Out['c']), 11)
+        self.assertNotIn(self.b, base)
+        self.assertNotIn(self.world.Out['c'], base)
+
+        child = self.state.fork()
+        child['step'] = 1
+        self.state[self.a] = 5
+        self.assertEqual(self.state[self.b], 2)
+        self.assertEqual(self.state['step'], 0)
+        self.assertEqual(self.state[self.world.Out['c']], 3)
+        self.assertEqual(child[self.a], 1)
+
+    def test_deleted_keys(self):
+        child = self.state.fork()
+        del child[self.a]
+        del child['step']
+        self.assertNotIn(self.a, child)
+        self.assertNotIn('step', child)
+        self.assertEqual(len(child.meta), 0)
+        self.assertIn(self.a, self.state)
+
+    def test_repeated_forks_do_not_stack(self):
+        for n in range(10):
+            child = self.state.fork()
+            child[self.b] = n
+            self.assertEqual(child(self.world.Out['c']), 3)
+        self.assertIsNone(self.state._block_states._base._base)
+
+        # Reading creates empty block states, which are not changes either
+        state = State()
+        state.fork()
+        state.block_state(self.world)
+        state.fork()
+        self.assertIsNone(state._block_states._base._base)
+
+    def test_changed_parent_forked_in_a_loop(self):
+        children = []
+        for n in range(1500):
+            self.state[self.a] = n
+            self.state['step'] = n
+            children.append(self.state.fork())
+
+        self.assertTrue(self.state.has_port(self.a))
+        self.assertEqual(self.state[self.a], 1499)
+        self.assertEqual(self.state['step'], 1499)
+        self.assertEqual(children[10][self.a], 10)
+        self.assertEqual(children[10]['step'], 10)
+        self.assertEqual(children[-1][self.b], 2)
+        self.assertLessEqual(self.state._block_states._depth, 16)
+
+    def test_chain_of_forks(self):
+        state = self.state
+        for n in range(1500):
+            state = state.fork()
+            state[self.b] = n
+
+        self.assertEqual(state[self.a], 1)
+        self.assertEqual(state[self.b], 1499)
+        self.assertLessEqual(state._block_states._depth, 16)
+        self.assertEqual(self.state[self.b], 2)
+
+
+class MainAndAux(AtomicFunction):
+    """ Publishes a cheap main output and an expensive lazy auxiliary output """
+
+    def __init__(self, name=None):
+        super(MainAndAux, self).__init__(name=name, In='in', Out=('main', 'aux'))
+        self.aux_calls = 0
+
+    def _aux(self, x):
+        self.aux_calls += 1
+        return 100 * x
+
+    def callback(self, ports, meta, params):
+        x = ports[self.In()]
+        return x + 1, LazyValue(self._aux, x)
+
+
+class Ignore(AtomicFunction):
+    """ Does not read its input """
+
+    def __init__(self, name=None):
+        super(Ignore, self).__init__(name=name, In='in', Out='out')
+
+    def callback(self, ports, meta, params):
+        return 0
+
+
+class TestLazyValues(unittest.TestCase):
+
+    def setUp(self):
+        self.world = Computable(name='world', In='x', Out=('main', 'aux', 'ignored'))
+        self.block = MainAndAux(name='block')
+        main, aux = self.block(self.world.In['x'])
+        self.world.Out['main'] = main
+        self.world.Out['aux'] = aux
+        self.world.Out['ignored'] = Ignore(name='ignore')(aux)
+
+        self.state = State()
+        self.state[self.world.In['x']] = 2
+
+    def test_unread_output_is_not_computed(self):
+        self.assertEqual(self.state(self.world.Out['main']), 3)
+        self.assertEqual(self.block.aux_calls, 0)
+
+    def test_consumer_that_does_not_read(self):
+        self.assertEqual(self.state(self.world.Out['ignored']), 0)
+        self.assertEqual(self.block.aux_calls, 0)
+
+    def test_resolved_on_read_and_cached(self):
+        self.assertEqual(self.state(self.world.Out['aux']), 200)
+        self.assertEqual(self.state[self.block.Out['aux']], 200)
+        self.assertEqual(self.block.aux_calls, 1)
+        self.assertNotIsInstance(self.state.peek(self.block.Out['aux']), LazyValue)
+
+    def test_future(self):
+        future = Future()
+        self.state[self.world.In['x']] = future
+        future.set_result(5)
+        self.assertEqual(self.state(self.world.Out['main']), 6)
@@ -0,0 +1,72 @@
+import unittest
+from blox.core.compute import Computable, AtomicFunction
+from blox.core.state import XPathState
+from blox.api.sweep import Sweep, ParamGrid
+
+
+class Scale(AtomicFunction):
+
+    def __init__(self, name=None):
+        super(Scale, self).__init__(name=name, In='in', Out='out')
+
+    def callback(self, ports, meta, params):
+        return ports[self.In()] * params.get('factor', 1) + meta.get('offset', 0)
+
+
+class Counter(AtomicFunction):
+
+    calls = 0
+
+    def __init__(self, name=None):
+        super(Counter, self).__init__(name=name, In='in', Out='out')
+
+    def callback(self, ports, meta, params):
+        Counter.calls += 1
+        return ports[self.In()] + 1
+
+
+class TestSweep(unittest.TestCase):
+
+    def setUp(self):
+        Counter.calls = 0
+        self.world = Computable(name='world', In='x', Out='y')
+        self.world.Out['y'] = Scale(name='scale')(Counter(name='counter')(self.world.In['x']))
+        self.xpstate = XPathState(**{'In:x': 1})
+
+    def test_grid(self):
+        grid = ParamGrid({'scale/factor': [1, 2], '@meta/offset': [0, 10, 20]})
+        self.assertEqual(len(grid), 6)
+        self.assertEqual(len(list(grid)), 6)
+
+    def test_sweep_params(self):
+        results = Sweep(self.world, 'Out:y')(ParamGrid({'scale/factor': [1, 2, 3]}), self.xpstate)
+        self.assertListEqual(results.column('Out:y'), [2, 4, 6])
+        self.assertListEqual(results.column('scale/factor'), [1, 2, 3])
+
+    def test_shared_upstream(self):
+        Sweep(self.world, 'Out:y')(ParamGrid({'scale/factor': [1, 2, 3]}), self.xpstate)
+        self.assertEqual(Counter.calls, 1)
+
+    def test_sweep_meta(self):
+        results = Sweep(self.world, 'Out:y')([{'@meta/offset': 0}, {'@meta/offset': 5}], self.xpstate)
+        self.assertListEqual(results.column('Out:y'), [2, 7])
+        self.assertEqual(Counter.calls, 2)
+
+    def test_sweep_processes(self):
+        grid = ParamGrid({'scale/factor': [1, 2, 3, 4]})
+        results = Sweep(self.world, ['Out:y'], max_workers=2)(grid, self.xpstate)
+        self.assertListEqual(results.column('Out:y'), [2, 4, 6, 8])
+
+    def test_base_meta_and_params(self):
+        xpstate = XPathState(**{'In:x': 1, '@meta/offset': 100})
+        results = Sweep(self.world, 'Out:y')(ParamGrid({'scale/factor': [1, 2, 3]}), xpstate)
+        self.assertListEqual(results.column('Out:y'), [102, 104, 106])
+
+        xpstate = XPathState(**{'In:x': 1, 'scale/factor': 10})
+        results = Sweep(self.world, 'Out:y')([{'@meta/offset': 0}, {'@meta/offset': 5}], xpstate)
+        self.assertListEqual(results.column('Out:y'), [20, 25])
+
+    def test_base_meta_and_params_processes(self):
+        xpstate = XPathState(**{'In:x': 1, '@meta/offset': 100})
+        results = Sweep(self.world, 'Out:y', max_workers=2)(ParamGrid({'scale/factor': [1, 2, 3]}), xpstate)
+        self.assertListEqual(results.column('Out:y'), [102, 104, 106])